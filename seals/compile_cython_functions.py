@@ -2,9 +2,18 @@ from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Distutils import build_ext
 import numpy
+import os
+import sys
+
+# The OpenMP flags of the parallel allocation kernel come from setup.py, one dir up, so both builds stay the same.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from setup import get_openmp_args
+openmp_compile_args, openmp_link_args = get_openmp_args()
 
 ext_modules = [Extension('seals_cython_functions',
                          ['seals_cython_functions.pyx'],
+                         extra_compile_args=openmp_compile_args,
+                         extra_link_args=openmp_link_args,
                          )]
 
 returned = setup(
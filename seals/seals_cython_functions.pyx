@@ -5,7 +5,7 @@ from libc.math cimport log
 import hazelbean as hb
 import os
 import time
-from cython.parallel cimport prange
+from cython.parallel cimport prange, threadid
 import scipy.ndimage
 import cython
 cimport cython
@@ -14,6 +14,7 @@ cimport numpy as np
 from numpy cimport ndarray
 from libc.math cimport sin
 from libc.math cimport fabs
+from libc.math cimport ceil
 import math, time   
 
 @cython.cdivision(False)
@@ -30,7 +31,11 @@ def seals_allocation_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_cha
                      str output_dir,
                      double cython_reporting_level,
                      str call_string,
+                     class_suitability_3d=None,
                      ):
+    """If class_suitability_3d (n_allocation_classes x rows x cols, e.g. one candidate of
+    seals_utils.calc_candidate_suitabilities) is given, it is ranked instead of the suitability built here from
+    spatial_layers_3d and spatial_layer_coefficients_2d. The masks are applied to it all the same."""
 
     cdef size_t n_coarse_rows = coarse_change_matrix_4d.shape[0]
     cdef size_t n_coarse_cols = coarse_change_matrix_4d.shape[1]
@@ -75,6 +80,9 @@ def seals_allocation_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_cha
     cdef int write_fine_c = 0
 
     cdef int rankings_precached = 0
+    cdef np.int64_t n_regressors_to_apply = len(spatial_layers_3d)
+    if class_suitability_3d is not None:
+        n_regressors_to_apply = 0
     cdef int print_regressor_modifications = 0
 
     cdef np.ndarray[np.float64_t, ndim=3] current_to_rank_arrays = np.zeros((n_allocation_classes, resolution, resolution), dtype=np.float64)
@@ -138,7 +146,10 @@ def seals_allocation_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_cha
 
                     else:
 
-                        for regressor_k in range(len(spatial_layers_3d)):
+                        if class_suitability_3d is not None:
+                            current_to_rank_arrays[from_class] = class_suitability_3d[from_class, current_fine_starting_r: current_fine_starting_r + resolution, current_fine_starting_c: current_fine_starting_c + resolution]
+
+                        for regressor_k in range(n_regressors_to_apply):
 
                             if spatial_layer_function_types_1d[regressor_k] == 2 and spatial_layer_coefficients_2d[from_class, regressor_k] != 0:  # Additive
 
@@ -153,7 +164,7 @@ def seals_allocation_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_cha
                         # If you have a coefficient of 0, then values with 1 cannot have that cell. But if you try multiplicative
                         # on a continuous, 0 to 1 value we end up subtracting 1 - (0 - 1) * -1 * 0.25 = 0.75. You may want to clarifiy the difference between a
                         # multiplicative binary and multipliciative continuous.
-                        for regressor_k in range(len(spatial_layers_3d)):
+                        for regressor_k in range(n_regressors_to_apply):
                             if spatial_layer_function_types_1d[regressor_k] == 1:  # Multiplicative
 
                                 current_to_rank_arrays[from_class] *= 1.0 - (
@@ -207,8 +218,8 @@ def seals_allocation_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_cha
                     if cython_reporting_level >= 5:  # Write rank arrays
                         counter = 0
                         for i in range(n_fine_grid_cells_per_coarse_cell):
-                            if output_to_rank_arrays[from_class, current_fine_starting_r + current_raveled[from_class, i] / resolution, current_fine_starting_c + current_raveled[from_class, i] % resolution] <= 999999:
-                                current_rank_arrays[from_class, current_raveled[from_class, i] / resolution, <int> (current_raveled[from_class, i] % resolution)] = counter
+                            if output_to_rank_arrays[from_class, current_fine_starting_r + current_raveled[from_class, i] // resolution, current_fine_starting_c + current_raveled[from_class, i] % resolution] <= 999999:
+                                current_rank_arrays[from_class, current_raveled[from_class, i] // resolution, <int> (current_raveled[from_class, i] % resolution)] = counter
                                 counter += 1
                         output_rank_arrays[from_class, current_fine_starting_r: current_fine_starting_r + resolution, current_fine_starting_c: current_fine_starting_c + resolution] = current_rank_arrays[from_class]
 
@@ -224,7 +235,7 @@ def seals_allocation_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_cha
 
                                     if current_to_rank_arrays[from_class, <int> (current_raveled[from_class, current_positions[from_class]] / resolution), current_raveled[from_class, current_positions[from_class]] % resolution] < 999999999.0:
                                         # Get current position OVERALL (i.e., including current_fine_starting_x) based on dividing and moduloing the current id.
-                                        current_fine_r = current_fine_starting_r + current_raveled[to_class, current_positions[to_class]] / resolution
+                                        current_fine_r = current_fine_starting_r + current_raveled[to_class, current_positions[to_class]] // resolution
                                         current_fine_c = current_fine_starting_c + current_raveled[to_class, current_positions[to_class]] % resolution
 
                                         # Write 0-1 to output_change_arrays (3dim) specific to this fine location and this expansion class.
@@ -262,249 +273,560 @@ def seals_allocation_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_cha
 
     return projected_lulc
 
-@cython.cdivision(False)
-@cython.boundscheck(True)
-@cython.wraparound(True)
-def seals_allocation_gridded_input(ndarray[np.float64_t, ndim=3] coarse_change_3d not None,
-                     ndarray[np.int64_t, ndim=2] input_lulc not None,
-                     ndarray[np.float64_t, ndim=3] spatial_layers_3d not None,
-                     ndarray[np.float64_t, ndim=2] spatial_layer_coefficients_2d not None,
-                     ndarray[np.int64_t, ndim=1] spatial_layer_function_types_1d not None,
-                     ndarray[np.int64_t, ndim=2] valid_mask_array not None,
-                     ndarray[np.int64_t, ndim=1] changing_class_indices not None,
+# The gridded allocation runs either on full-width arrays or, in compact mode, on uint8 class codes and 0-1 masks with
+# float32 regressors and suitability. Class codes and masks always share one dtype, as do regressors and suitability.
+ctypedef fused lulc_t:
+    np.int64_t
+    np.uint8_t
+
+ctypedef fused suitability_t:
+    np.float64_t
+    np.float32_t
+
+
+cdef inline bint _ranks_before(suitability_t* keys, np.int64_t a, np.int64_t b) noexcept nogil:
+    # Ties are broken by raster order so that the ranking is deterministic regardless of how many threads are used.
+    return keys[a] < keys[b] or (keys[a] == keys[b] and a < b)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef np.int64_t _partition_by_key(suitability_t* keys, np.int64_t* order, np.int64_t lo, np.int64_t hi) noexcept nogil:
+    # Hoare partition of order[lo:hi] around a median-of-three pivot. Returns j such that everything in order[lo:j + 1]
+    # ranks before everything in order[j + 1:hi]. Requires hi - lo >= 3.
+    cdef np.int64_t i, j, mid, pivot, tmp
+
+    mid = lo + (hi - lo) // 2
+
+    # Median of three, which also leaves sentinels at both ends for the partition.
+    if _ranks_before(keys, order[mid], order[lo]):
+        tmp = order[mid]; order[mid] = order[lo]; order[lo] = tmp
+    if _ranks_before(keys, order[hi - 1], order[lo]):
+        tmp = order[hi - 1]; order[hi - 1] = order[lo]; order[lo] = tmp
+    if _ranks_before(keys, order[hi - 1], order[mid]):
+        tmp = order[hi - 1]; order[hi - 1] = order[mid]; order[mid] = tmp
+    pivot = order[mid]
+
+    i = lo
+    j = hi - 1
+    while True:
+        while _ranks_before(keys, order[i], pivot):
+            i += 1
+        while _ranks_before(keys, pivot, order[j]):
+            j -= 1
+        if i >= j:
+            return j
+        tmp = order[i]; order[i] = order[j]; order[j] = tmp
+        i += 1
+        j -= 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _insertion_sort_by_key(suitability_t* keys, np.int64_t* order, np.int64_t lo, np.int64_t hi) noexcept nogil:
+    cdef np.int64_t i, j, tmp
+    for i in range(lo + 1, hi):
+        tmp = order[i]
+        j = i - 1
+        while j >= lo and _ranks_before(keys, tmp, order[j]):
+            order[j + 1] = order[j]
+            j -= 1
+        order[j + 1] = tmp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _sort_by_key(suitability_t* keys, np.int64_t* order, np.int64_t lo, np.int64_t hi) noexcept nogil:
+    # Quicksort order[lo:hi] so that keys[order[i]] ascends. Recurses on the smaller side only to keep the stack shallow.
+    cdef np.int64_t j
+
+    while hi - lo > 16:
+        j = _partition_by_key(keys, order, lo, hi)
+        if j + 1 - lo < hi - j - 1:
+            _sort_by_key(keys, order, lo, j + 1)
+            lo = j + 1
+        else:
+            _sort_by_key(keys, order, j + 1, hi)
+            hi = j + 1
+
+    _insertion_sort_by_key(keys, order, lo, hi)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _select_by_key(suitability_t* keys, np.int64_t* order, np.int64_t lo, np.int64_t hi, np.int64_t kth) noexcept nogil:
+    # Quickselect: reorder order[lo:hi] so that order[lo:kth] holds the best-ranked kth - lo entries (in no particular
+    # order) and everything in order[kth:hi] ranks after them.
+    cdef np.int64_t j
+
+    while hi - lo > 16:
+        j = _partition_by_key(keys, order, lo, hi)
+        if kth <= j + 1:
+            hi = j + 1
+        else:
+            lo = j + 1
+
+    _insertion_sort_by_key(keys, order, lo, hi)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _allocate_coarse_cell(np.int64_t coarse_r,
+                                np.int64_t coarse_c,
+                                np.int64_t resolution,
+                                np.float64_t[:, :, :] coarse_change_3d,
+                                lulc_t[:, :] input_lulc,
+                                suitability_t[:, :, :] spatial_layers_3d,
+                                np.float64_t[:, :] spatial_layer_coefficients_2d,
+                                np.int64_t[:] spatial_layer_function_types_1d,
+                                lulc_t[:, :] valid_mask_array,
+                                np.int64_t[:] changing_class_indices,
+                                np.int64_t[:] class_indices_to_class_positions,
+                                const np.float64_t[:, :] hectares_per_grid_cell,
+                                np.int64_t allow_contracting,
+                                bint write_suitability_arrays,
+                                bint write_rank_arrays,
+                                bint partial_ranking,
+                                suitability_t[:, :] current_to_rank,
+                                np.int64_t[:, :] current_raveled,
+                                np.float64_t[:] current_goal_left,
+                                np.int64_t[:] current_positions,
+                                np.int64_t[:] current_n_eligible,
+                                np.int64_t[:] current_n_sorted,
+                                lulc_t[:, :] projected_lulc,
+                                lulc_t[:, :] change_happened,
+                                suitability_t[:, :, :] output_to_rank_arrays,
+                                np.uint16_t[:, :, :] output_rank_arrays,
+                                ) noexcept nogil:
+    # Rank and allocate a single coarse cell. Everything written here is inside the coarse cell's own fine window or in
+    # the per-thread scratch buffers, which is what makes it safe to call from a prange over coarse cells.
+    cdef np.int64_t n_allocation_classes = coarse_change_3d.shape[0]
+    cdef np.int64_t n_regressors = spatial_layers_3d.shape[0]
+    cdef np.int64_t n_class_lookup = class_indices_to_class_positions.shape[0]
+    cdef np.int64_t n_fine_grid_cells_per_coarse_cell = resolution * resolution
+    cdef np.int64_t current_fine_starting_r = coarse_r * resolution
+    cdef np.int64_t current_fine_starting_c = coarse_c * resolution
+    cdef np.int64_t class_position, regressor_k, block_fine_r, block_fine_c, current_fine_r, current_fine_c, i, while_counter, counter
+    cdef np.int64_t class_displaced, class_displaced_position
+    cdef np.int64_t n_eligible, n_to_sort, n_cells_needed_all_classes
+    cdef np.float64_t total_absolute_change_needed = 0.0
+    cdef np.float64_t value, min_hectares_per_grid_cell, n_cells_needed
+    cdef bint any_goal_left
+
+    # First check if there's any allocation to do, skipping if not for speed
+    for class_position in range(n_allocation_classes):
+        total_absolute_change_needed += fabs(coarse_change_3d[class_position, coarse_r, coarse_c])
+    if total_absolute_change_needed == 0.0:
+        return
+
+    ## Create the arrays to rank. A class that isn't expanding here is never allocated, so unless its suitability is
+    ## being reported it is left out entirely.
+    for class_position in range(n_allocation_classes):
+        if not write_suitability_arrays and not coarse_change_3d[class_position, coarse_r, coarse_c] > 0:
+            continue
+        for block_fine_r in range(resolution):
+            current_fine_r = current_fine_starting_r + block_fine_r
+            for block_fine_c in range(resolution):
+                current_fine_c = current_fine_starting_c + block_fine_c
+                value = 0.0
+
+                # NOTE: we iterate through regressors first for additive, then for multiplicative because the formula really is (a + b + c + d +...) * e * f
+                for regressor_k in range(n_regressors):
+                    if spatial_layer_function_types_1d[regressor_k] == 2 and spatial_layer_coefficients_2d[class_position, regressor_k] != 0: # Additive
+                        value = value + spatial_layer_coefficients_2d[class_position, regressor_k] * spatial_layers_3d[regressor_k, current_fine_r, current_fine_c]
+
+                # NOTE THE VERY SPECIFIC and potentially strange logic of booleans that actually aren't booleans.
+                # If you have a coefficient of 0, then values with 1 cannot have that cell. But if you try multiplicative
+                # on a continuous, 0 to 1 value we end up subtracting 1 - (0 - 1) * -1 * 0.25 = 0.75. You may want to clarifiy the difference between a
+                # multiplicative binary and multipliciative continuous.
+                for regressor_k in range(n_regressors):
+                    if spatial_layer_function_types_1d[regressor_k] == 1:
+                        value = value * (1.0 - (((spatial_layer_coefficients_2d[class_position, regressor_k] - 1) * -1.0) * spatial_layers_3d[regressor_k, current_fine_r, current_fine_c]))
+
+                # Also mask invalid now
+                value = value * valid_mask_array[current_fine_r, current_fine_c]
+
+                # Set locations that already have class_position as its type to zero
+                if <np.int64_t> input_lulc[current_fine_r, current_fine_c] == changing_class_indices[class_position]:
+                    value = value * 0.0
+
+                # Flip so that we start from highest value
+                value = value * -1.0
+
+                # Set zeros (and values so close to zero that they are floating point noise) to high value for ranking purposes.
+                # NOTE LOGIC, low values ranked first, but areas with ZERO are used as no data, so we don't want them in the rank between pos and neg values.
+                # NaNs are sent to the same sentinel so that they cannot break the ordering.
+                if value == 0.0 or (value < 1.e-14 and value > -1.e-14) or value < -9999999999999999.0 or value != value:
+                    value = 9.e9
+
+                current_to_rank[class_position, block_fine_r * resolution + block_fine_c] = <suitability_t> value
+
+                # For visualization, also save to full-extent array
+                if write_suitability_arrays:
+                    output_to_rank_arrays[class_position, current_fine_r, current_fine_c] = <suitability_t> value
+
+    # Do the ranking. Only cells below the sentinel can ever be allocated, so first compact their indices (in raster
+    # order). Unless every rank is needed for reporting, a class then only needs as many ranked candidates as its own
+    # hectare goal can consume plus those the other classes can take from under it, which is bounded by the total
+    # number of cells all classes need. Those are found with a quickselect and only they get sorted. If the allocation
+    # loop walks past them (e.g. because allow_contracting raised a goal), the remainder is sorted then.
+    min_hectares_per_grid_cell = hectares_per_grid_cell[current_fine_starting_r, current_fine_starting_c]
+    for block_fine_r in range(resolution):
+        for block_fine_c in range(resolution):
+            if hectares_per_grid_cell[current_fine_starting_r + block_fine_r, current_fine_starting_c + block_fine_c] < min_hectares_per_grid_cell:
+                min_hectares_per_grid_cell = hectares_per_grid_cell[current_fine_starting_r + block_fine_r, current_fine_starting_c + block_fine_c]
+
+    n_cells_needed_all_classes = 0
+    for class_position in range(n_allocation_classes):
+        if coarse_change_3d[class_position, coarse_r, coarse_c] > 0 and min_hectares_per_grid_cell > 0:
+            n_cells_needed = ceil(coarse_change_3d[class_position, coarse_r, coarse_c] / min_hectares_per_grid_cell)
+            if n_cells_needed > n_fine_grid_cells_per_coarse_cell:
+                n_cells_needed = n_fine_grid_cells_per_coarse_cell
+            n_cells_needed_all_classes += <np.int64_t> n_cells_needed
+        elif coarse_change_3d[class_position, coarse_r, coarse_c] > 0:
+            n_cells_needed_all_classes += n_fine_grid_cells_per_coarse_cell
+
+    for class_position in range(n_allocation_classes):
+        n_eligible = 0
+        if not write_rank_arrays and not coarse_change_3d[class_position, coarse_r, coarse_c] > 0:
+            current_n_eligible[class_position] = 0
+            current_n_sorted[class_position] = 0
+            continue
+        for i in range(n_fine_grid_cells_per_coarse_cell):
+            if current_to_rank[class_position, i] < 999999999.0:
+                current_raveled[class_position, n_eligible] = i
+                n_eligible += 1
+        current_n_eligible[class_position] = n_eligible
+
+        if write_rank_arrays or not partial_ranking:
+            n_to_sort = n_eligible
+        elif coarse_change_3d[class_position, coarse_r, coarse_c] > 0:
+            n_to_sort = n_cells_needed_all_classes
+            if n_to_sort > n_eligible:
+                n_to_sort = n_eligible
+        else:
+            n_to_sort = 0  # A class that isn't expanding is never allocated, so it doesn't need to be ranked.
+
+        if n_to_sort < n_eligible:
+            _select_by_key(&current_to_rank[class_position, 0], &current_raveled[class_position, 0], 0, n_eligible, n_to_sort)
+        _sort_by_key(&current_to_rank[class_position, 0], &current_raveled[class_position, 0], 0, n_to_sort)
+        current_n_sorted[class_position] = n_to_sort
+
+        if write_rank_arrays: # Write rank arrays. Ranks are within the coarse window, so they saturate at the uint16 max.
+            counter = 0
+            for i in range(n_eligible):
+                if current_to_rank[class_position, current_raveled[class_position, i]] <= 999999:
+                    output_rank_arrays[class_position, current_fine_starting_r + current_raveled[class_position, i] // resolution, current_fine_starting_c + current_raveled[class_position, i] % resolution] = <np.uint16_t> (counter if counter < 65535 else 65535)
+                    counter += 1
+
+    # Do the allocation
+    for class_position in range(n_allocation_classes):
+        current_goal_left[class_position] = coarse_change_3d[class_position, coarse_r, coarse_c]
+        current_positions[class_position] = 0
+
+    for while_counter in range(n_fine_grid_cells_per_coarse_cell):
+        any_goal_left = False
+        for class_position in range(n_allocation_classes):
+            # A class that has run out of eligible cells can't allocate anything else in this coarse cell.
+            if current_goal_left[class_position] > 0 and current_positions[class_position] < current_n_eligible[class_position]:
+                any_goal_left = True
+
+                # Ran out of sorted candidates, so fall back to sorting the rest. The selection guarantees they all
+                # rank after the ones already used.
+                if current_positions[class_position] == current_n_sorted[class_position]:
+                    _sort_by_key(&current_to_rank[class_position, 0], &current_raveled[class_position, 0], current_n_sorted[class_position], current_n_eligible[class_position])
+                    current_n_sorted[class_position] = current_n_eligible[class_position]
+
+                block_fine_r = current_raveled[class_position, current_positions[class_position]] // resolution
+                block_fine_c = current_raveled[class_position, current_positions[class_position]] % resolution
+
+                current_fine_r = current_fine_starting_r + block_fine_r
+                current_fine_c = current_fine_starting_c + block_fine_c
+
+                class_displaced = <np.int64_t> input_lulc[current_fine_r, current_fine_c]
+                if class_displaced >= 0 and class_displaced < n_class_lookup:
+                    class_displaced_position = class_indices_to_class_positions[class_displaced]
+                else:
+                    class_displaced_position = -1
+
+                if change_happened[current_fine_r, current_fine_c] == 0 and class_displaced_position != class_position:
+
+                    # Record where change has happened. Together with projected_lulc this is also enough to
+                    # rebuild the per-class allocation arrays, so they aren't written here.
+                    change_happened[current_fine_r, current_fine_c] = 1
+
+                    # Write the class_position's label value to the projected lulc map
+                    projected_lulc[current_fine_r, current_fine_c] = <lulc_t> changing_class_indices[class_position]
+
+                    # Reduce the current class's goal by the amount of hectares in that
+                    current_goal_left[class_position] -= hectares_per_grid_cell[current_fine_r, current_fine_c]
+
+                    # If a class that also was supposed to expand got booted from the cell, increment it's goal left UP
+                    if allow_contracting and class_displaced_position >= 0:
+                        if current_goal_left[class_displaced_position] > 0:
+                            current_goal_left[class_displaced_position] += hectares_per_grid_cell[current_fine_r, current_fine_c]
+
+                # WHETHER OR NOT IT MADE THE CHANGE,
+                # Increment the current allocation position by 1, moving the the next best cell.
+                current_positions[class_position] += 1
+
+        # Once every goal is met nothing else can change in this cell, so stop walking down the ranks.
+        if not any_goal_left:
+            break
+
+
+def build_active_coarse_cell_index(coarse_change_3d):
+    """Return the sparse index of coarse cells that have change to allocate, as an (n_active, 3) int64 array of
+    (coarse_r, coarse_c, class_position) rows sorted by cell. coarse_change_3d is n_changing_classes x coarse rows x
+    coarse cols. Zeros, NaNs and the -9999 nodata value don't count as change."""
+    coarse_change_3d = np.asarray(coarse_change_3d)
+    has_change = (coarse_change_3d != 0) & (coarse_change_3d != -9999.) & (~np.isnan(coarse_change_3d))
+    class_positions, coarse_rs, coarse_cs = np.nonzero(has_change)
+    order = np.lexsort((class_positions, coarse_cs, coarse_rs))
+    return np.stack((coarse_rs[order], coarse_cs[order], class_positions[order]), axis=1).astype(np.int64)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def calc_class_suitability_3d(suitability_t[:, :, :] spatial_layers_3d not None,
+                              np.float64_t[:, :] spatial_layer_coefficients_2d not None,
+                              np.int64_t[:] spatial_layer_function_types_1d not None,
+                              int num_threads=1):
+    """Return the n_changing_classes x rows x cols suitability of each class before any of the per-year masks (the
+    valid mask and the class's own current cells) are applied, in the dtype of spatial_layers_3d.
+
+    This is the same arithmetic seals_allocation_gridded_input does, so passing the result as additive layers with an
+    identity coefficient table allocates exactly as passing the layers and coefficients would."""
+    cdef np.int64_t n_allocation_classes = spatial_layer_coefficients_2d.shape[0]
+    cdef np.int64_t n_regressors = spatial_layers_3d.shape[0]
+    cdef np.int64_t n_fine_rows = spatial_layers_3d.shape[1]
+    cdef np.int64_t n_fine_cols = spatial_layers_3d.shape[2]
+    cdef np.int64_t class_position, regressor_k, fine_r, fine_c
+    cdef double value
+
+    if num_threads < 1:
+        num_threads = os.cpu_count() or 1
+
+    if suitability_t is np.float32_t:
+        suitability_dtype = np.float32
+    else:
+        suitability_dtype = np.float64
+    class_suitability_3d = np.zeros((n_allocation_classes, n_fine_rows, n_fine_cols), dtype=suitability_dtype)
+    cdef suitability_t[:, :, :] class_suitability_3d_view = class_suitability_3d
+
+    for fine_r in prange(n_fine_rows, nogil=True, schedule='static', num_threads=num_threads):
+        for class_position in range(n_allocation_classes):
+            for fine_c in range(n_fine_cols):
+                value = 0.0
+                for regressor_k in range(n_regressors):
+                    if spatial_layer_function_types_1d[regressor_k] == 2 and spatial_layer_coefficients_2d[class_position, regressor_k] != 0: # Additive
+                        value = value + spatial_layer_coefficients_2d[class_position, regressor_k] * spatial_layers_3d[regressor_k, fine_r, fine_c]
+                for regressor_k in range(n_regressors):
+                    if spatial_layer_function_types_1d[regressor_k] == 1: # Multiplicative
+                        value = value * (1.0 - (((spatial_layer_coefficients_2d[class_position, regressor_k] - 1) * -1.0) * spatial_layers_3d[regressor_k, fine_r, fine_c]))
+                class_suitability_3d_view[class_position, fine_r, fine_c] = <suitability_t> value
+
+    return class_suitability_3d
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def seals_allocation_gridded_input(np.float64_t[:, :, :] coarse_change_3d not None,
+                     lulc_t[:, :] input_lulc not None,
+                     suitability_t[:, :, :] spatial_layers_3d not None,
+                     np.float64_t[:, :] spatial_layer_coefficients_2d not None,
+                     np.int64_t[:] spatial_layer_function_types_1d not None,
+                     lulc_t[:, :] valid_mask_array not None,
+                     np.int64_t[:] changing_class_indices not None,
                      list changing_class_labels not None, # Not speed dependent
-                     ndarray[np.float64_t, ndim=2] hectares_per_grid_cell not None,
+                     const np.float64_t[:, :] hectares_per_grid_cell not None,
                      str output_dir,
                      double cython_reporting_level,
                      np.int64_t allow_contracting,
                      str output_match_path,
                      str call_string,
+                     int num_threads=1,
+                     bint partial_ranking=True,
+                     active_coarse_cells=None,
+                     bint return_change_arrays=True,
                      ):
+    """Allocate the coarse change in coarse_change_3d (n_changing_classes x coarse rows x coarse cols) onto the fine
+    input_lulc. Coarse cells only ever touch their own fine window, so they are processed in a nogil prange across
+    num_threads OpenMP threads, each of which gets its own ranking scratch buffers.
 
+    With partial_ranking, each class only sorts the eligible cells its goal can use instead of the whole window. This
+    gives the same allocation as a full sort; set it to False to force full sorts, e.g. when comparing.
 
+    Only the coarse cells listed in active_coarse_cells (see build_active_coarse_cell_index) are visited. If it is None,
+    the index is built here from coarse_change_3d.
 
-    cdef size_t n_coarse_rows = coarse_change_3d[0].shape[0]
-    cdef size_t n_coarse_cols = coarse_change_3d[0].shape[1]
+    The full-extent diagnostic arrays are only allocated when cython_reporting_level will write them: the suitability
+    being ranked at 5 and above, the within-window ranks (uint16) at 11 and above. The per-class 0-1 allocation arrays
+    are rebuilt from projected_lulc and change_happened afterwards (as uint8) if return_change_arrays, otherwise None is
+    returned in their place.
 
-    cdef size_t n_fine_rows = input_lulc.shape[0]
-    cdef size_t n_fine_cols = input_lulc.shape[1]
+    input_lulc and valid_mask_array are either both int64 or both uint8, and spatial_layers_3d is float64 or float32.
+    The compact combination (uint8 and float32) ranks in float32 and returns uint8 projected_lulc and change_happened,
+    which shrinks the working set of the tile several times over. Suitabilities that round to the same float32 can
+    rank (and so allocate) differently from the float64 path, so results only match that path within a tolerance.
 
-    cdef size_t current_n_ranked = 0
+    hectares_per_grid_cell is only read, so it can be a broadcast view, e.g. the per-row vector of
+    seals_utils.calc_ha_per_cell_rows broadcast to the fine shape without materializing it."""
 
-    cdef np.int64_t coarse_r, coarse_c, class_position, fine_r, fine_c, chunk_r, chunk_c, class_i, class_j, i, j, current_fine_starting_r, current_fine_starting_c, interior_allocation_step, k, regressor_k
-    cdef np.int64_t class_displaced, class_displaced_position, max_class_index
-    cdef long long counter = 1
-    cdef long long while_counter = 1
+    cdef np.int64_t n_coarse_rows = coarse_change_3d.shape[1]
+    cdef np.int64_t n_coarse_cols = coarse_change_3d.shape[2]
+
+    cdef np.int64_t n_fine_rows = input_lulc.shape[0]
+    cdef np.int64_t n_fine_cols = input_lulc.shape[1]
 
-    cdef np.int64_t resolution = input_lulc.shape[1] / coarse_change_3d[0].shape[1]
-    cdef np.int64_t other_resolution = input_lulc.shape[0] / coarse_change_3d[0].shape[0]
+    cdef np.int64_t resolution = n_fine_cols // n_coarse_cols
+    cdef np.int64_t other_resolution = n_fine_rows // n_coarse_rows
     if not resolution == other_resolution:
         print ('WARNING, resolutions not amicable.', resolution, other_resolution)
 
-    cdef size_t n_allocation_classes = coarse_change_3d.shape[0]
-
-    cdef np.float64_t total_absolute_change_needed = 0.0
-
-    cdef np.int64_t n_fine_grid_cells_per_coarse_cell = <int> (resolution * resolution)
-
-    cdef np.ndarray[np.int64_t, ndim=2] current_raveled = np.zeros((n_allocation_classes, n_fine_grid_cells_per_coarse_cell), dtype=np.int64)
-
-    cdef np.ndarray[np.float64_t, ndim=3] current_to_rank_arrays = np.zeros((n_allocation_classes, resolution, resolution), dtype=np.float64)
-    cdef np.ndarray[np.float64_t, ndim=3] current_rank_arrays = np.zeros((n_allocation_classes, resolution, resolution), dtype=np.float64)
-
-    cdef np.ndarray[np.float64_t, ndim=1] current_goals = np.zeros(n_allocation_classes, dtype=np.float64)
-    cdef np.ndarray[np.float64_t, ndim=1] current_goal_left = np.zeros(n_allocation_classes, dtype=np.float64)
-    cdef np.ndarray[np.int64_t, ndim=1] current_positions = np.zeros(n_allocation_classes, dtype=np.int64)
-
-    cdef np.ndarray[np.float64_t, ndim=3] output_to_rank_arrays = np.zeros((n_allocation_classes, n_fine_rows, n_fine_cols), dtype=np.float64)
-    cdef np.ndarray[np.float64_t, ndim=3] output_rank_arrays = np.zeros((n_allocation_classes, n_fine_rows, n_fine_cols), dtype=np.float64)
-    cdef np.ndarray[np.int64_t, ndim=3] output_change_arrays = np.zeros((n_allocation_classes, n_fine_rows, n_fine_cols), dtype=np.int64)
-    cdef np.ndarray[np.int64_t, ndim=2] change_happened = np.zeros((n_fine_rows, n_fine_cols), dtype=np.int64)
-    cdef np.ndarray[np.int64_t, ndim=2] projected_lulc = np.copy(input_lulc).astype(np.int64)
-
-    
-    cdef np.ndarray[np.int64_t, ndim=1] changing_class_positions = np.arange(n_allocation_classes, dtype=np.int64)
-    
+    cdef np.int64_t n_allocation_classes = coarse_change_3d.shape[0]
+    cdef np.int64_t n_fine_grid_cells_per_coarse_cell = resolution * resolution
+    cdef np.int64_t cell_i, thread_i, i
+    cdef bint write_suitability_arrays = cython_reporting_level >= 5
+    cdef bint write_rank_arrays = cython_reporting_level >= 11
+
+    if num_threads < 1:
+        num_threads = os.cpu_count() or 1
+
+    if lulc_t is np.uint8_t:
+        lulc_dtype = np.uint8
+        if np.max(changing_class_indices) > 255:
+            raise NameError('Compact allocation stores class codes as uint8, so changing_class_indices must be below 256.')
+    else:
+        lulc_dtype = np.int64
+    if suitability_t is np.float32_t:
+        suitability_dtype = np.float32
+    else:
+        suitability_dtype = np.float64
+
+    # Per-thread scratch. Each thread only ever indexes its own first-axis slice.
+    cdef suitability_t[:, :, :] current_to_rank_arrays = np.zeros((num_threads, n_allocation_classes, n_fine_grid_cells_per_coarse_cell), dtype=suitability_dtype)
+    cdef np.int64_t[:, :, :] current_raveled = np.zeros((num_threads, n_allocation_classes, n_fine_grid_cells_per_coarse_cell), dtype=np.int64)
+    cdef np.float64_t[:, :] current_goal_left = np.zeros((num_threads, n_allocation_classes), dtype=np.float64)
+    cdef np.int64_t[:, :] current_positions = np.zeros((num_threads, n_allocation_classes), dtype=np.int64)
+    cdef np.int64_t[:, :] current_n_eligible = np.zeros((num_threads, n_allocation_classes), dtype=np.int64)
+    cdef np.int64_t[:, :] current_n_sorted = np.zeros((num_threads, n_allocation_classes), dtype=np.int64)
+
+    # Diagnostic arrays that won't be written are left as a placeholder that the kernel never touches.
+    if write_suitability_arrays:
+        output_to_rank_arrays = np.zeros((n_allocation_classes, n_fine_rows, n_fine_cols), dtype=suitability_dtype)
+    else:
+        output_to_rank_arrays = np.zeros((1, 1, 1), dtype=suitability_dtype)
+    if write_rank_arrays:
+        output_rank_arrays = np.zeros((n_allocation_classes, n_fine_rows, n_fine_cols), dtype=np.uint16)
+    else:
+        output_rank_arrays = np.zeros((1, 1, 1), dtype=np.uint16)
+    change_happened = np.zeros((n_fine_rows, n_fine_cols), dtype=lulc_dtype)
+    projected_lulc = np.array(input_lulc, dtype=lulc_dtype, copy=True)
+
+    cdef suitability_t[:, :, :] output_to_rank_arrays_view = output_to_rank_arrays
+    cdef np.uint16_t[:, :, :] output_rank_arrays_view = output_rank_arrays
+    cdef lulc_t[:, :] change_happened_view = change_happened
+    cdef lulc_t[:, :] projected_lulc_view = projected_lulc
+
+    # A little surprsing here, but this is an optimization to avoid a dictionary lookup. However,
+    # it assumes that the max_class_index will be smallish. Classes that aren't changing map to -1.
     max_class_index = np.max(changing_class_indices) + 1
-    cdef np.ndarray[np.int64_t, ndim=1] class_indices_to_class_positions = np.zeros(max_class_index + 1, dtype=np.int64)
-    
-    # A little surprsing here, but this is an optimization to avoid a dictionary lookup. However, 
-    # it assumes that the max_class_index will be smallish
-    counter = 0
-    for i in changing_class_indices:
-        class_indices_to_class_positions[i] = counter
-        counter += 1
-
-    
-    if call_string is not '': 
-        pass
-        # print ('Cython call_string: ' + call_string)  
-
-    # Get to correct coarse cell
-    for coarse_r in range(n_coarse_rows):
-        for coarse_c in range(n_coarse_cols):  
-            
-            # First check if there's any allocation to do, skipping if not for speed
-            for class_position in changing_class_positions:
-                total_absolute_change_needed += abs(coarse_change_3d[class_position, coarse_r, coarse_c])
-
-            if total_absolute_change_needed > 0.0:
-                current_to_rank_arrays = np.zeros((n_allocation_classes, resolution, resolution), dtype=np.float64)
-                current_rank_arrays = np.zeros((n_allocation_classes, resolution, resolution), dtype=np.float64)
-                current_fine_starting_r = coarse_r * resolution
-                current_fine_starting_c = coarse_c * resolution
-
-                ## Create the arrays to rank
-
-                # Add in all within-cell regressors
-                for class_position in changing_class_positions: 
-
-                    # NOTE: we iterate through regressors first for additive, then for multiplicative because the formula really is (a + b + c + d +...) * e * f
-                    for regressor_k in range(len(spatial_layers_3d)):
-                        if spatial_layer_function_types_1d[regressor_k] == 2 and spatial_layer_coefficients_2d[class_position, regressor_k] != 0: # Additive
-                            current_to_rank_arrays[class_position] += (spatial_layer_coefficients_2d[class_position, regressor_k] *
-                                                            spatial_layers_3d[regressor_k, current_fine_starting_r: current_fine_starting_r + resolution,
-                                                            current_fine_starting_c: current_fine_starting_c + resolution])
-
-                    # NOTE THE VERY SPECIFIC and potentially strange logic of booleans that actually aren't booleans.
-                    # If you have a coefficient of 0, then values with 1 cannot have that cell. But if you try multiplicative
-                    # on a continuous, 0 to 1 value we end up subtracting 1 - (0 - 1) * -1 * 0.25 = 0.75. You may want to clarifiy the difference between a
-                    # multiplicative binary and multipliciative continuous.
-                    for regressor_k in range(len(spatial_layers_3d)):
-                        if spatial_layer_function_types_1d[regressor_k] == 1:
-                            
-                            current_to_rank_arrays[class_position] *= 1.0 - (
-                                ((spatial_layer_coefficients_2d[class_position, regressor_k] - 1) * -1.0) *
-                                    spatial_layers_3d[regressor_k, current_fine_starting_r: current_fine_starting_r + resolution, current_fine_starting_c: current_fine_starting_c + resolution]
-                            )
-
-
-                    # Also mask invalid now
-                    current_to_rank_arrays[class_position] *= valid_mask_array[current_fine_starting_r: current_fine_starting_r + resolution, current_fine_starting_c: current_fine_starting_c + resolution]
-
-                    # Set locations that already have class_position as its type to zero
-                    current_to_rank_arrays[class_position] *= np.where(input_lulc[current_fine_starting_r: current_fine_starting_r + resolution, current_fine_starting_c: current_fine_starting_c + resolution] == changing_class_indices[class_position], 0, 1)
-
-                    # Flip array so that we start from highest value
-                    # TODOO this could be optimized by changing the inputs
-                    current_to_rank_arrays[class_position] *= -1.0
-
-                    # Set zeros to high value for ranking purposes
-                    current_to_rank_arrays[class_position][current_to_rank_arrays[class_position] == 0] = 9.e9  # NOTE LOGIC, low values ranked first, but areas with ZERO are used as no data, so we don't want them in the rank between pos and neg values.
-
-                    # Values very close to zero no longer have smooth ranking surfaces due to floating point errors.
-                    current_to_rank_arrays[class_position][(current_to_rank_arrays[class_position] < 1.e-14) & (current_to_rank_arrays[class_position] > -1.e-14)] = 9.e9  # NOTE LOGIC, low values ranked first, but areas with ZERO are used as no data, so we don't want them in the rank between pos and neg values.
-                    current_to_rank_arrays[class_position][current_to_rank_arrays[class_position] < -9999999999999999] = 9.e9 # NOTE, necessary to fix what I think was an underflow error. was getting a lot of 1e-35 numbers.
-                    # For visualization, also save to full-extent array
-                    output_to_rank_arrays[class_position, current_fine_starting_r: current_fine_starting_r + resolution, current_fine_starting_c: current_fine_starting_c + resolution] = current_to_rank_arrays[class_position]
-
-                # Do the ranking
-                for class_position in changing_class_positions:
-
-                    # Sort each class_position array
-                    current_raveled[class_position] = current_to_rank_arrays[class_position].argsort(axis=None)
-
-                    # TODOO Abandonded start: It is trickier than expected to "rerank"
-                    # the rank to eliminate edges because it calls adjacent cells. Need to have a new instantiat9ion of the tiling-system
-                    # that includes single-read memory blocking of all 9 cells.
-                    # HOWEVER, probably the fastest approach would be to embrace both the clibration (on the fly) calculatinon of everything
-                    # but then also a preprocesed version of the allocation for speed. the preprocessin gstep then could do the smoothing.
-                    # if smooth_rank:
-                    #     current_raveled[class_position] = current_to_rank_arrays[class_position].argsort(axis=None)
-
-
-
-                    if cython_reporting_level >= 5: # Write rank arrays
-                        counter = 0
-                        for i in range(n_fine_grid_cells_per_coarse_cell):
+    cdef np.int64_t[:] class_indices_to_class_positions = np.full(max_class_index + 1, -1, dtype=np.int64)
+    for i in range(n_allocation_classes):
+        class_indices_to_class_positions[changing_class_indices[i]] = i
 
-                            if output_to_rank_arrays[class_position, current_fine_starting_r + current_raveled[class_position, i] / resolution, current_fine_starting_c + current_raveled[class_position, i] % resolution] <= 999999:
-                                current_rank_arrays[class_position, current_raveled[class_position, i] / resolution, <int> (current_raveled[class_position, i] % resolution)] = counter
-                                counter += 1
-                        output_rank_arrays[class_position, current_fine_starting_r: current_fine_starting_r + resolution, current_fine_starting_c: current_fine_starting_c + resolution] = current_rank_arrays[class_position]
-
-                # Do the allocation
-                for class_position in changing_class_positions:
-                    current_goals[class_position] = coarse_change_3d[class_position, coarse_r, coarse_c]
-                    current_goal_left[class_position] = current_goals[class_position]
-                    current_positions[class_position] = 0
-
-                for while_counter in range(n_fine_grid_cells_per_coarse_cell):
-                    for class_position in changing_class_positions:
-                        if current_goal_left[class_position] > 0:
-
-                            block_fine_r = <int> (current_raveled[class_position, current_positions[class_position]] / resolution)
-                            block_fine_c = <int> (current_raveled[class_position, current_positions[class_position]] % resolution)                        
-
-                            current_fine_r = current_fine_starting_r + block_fine_r
-                            current_fine_c = current_fine_starting_c + block_fine_c
-
-                            class_displaced = input_lulc[current_fine_r, current_fine_c]
-                            if class_displaced in changing_class_indices:
-                                class_displaced_position = class_indices_to_class_positions[class_displaced]
-                            else:
-                                class_displaced_position = -1
-
-                            #if while_counter % 10000 == 0:
-                            #    print('checking if change_happened', current_fine_r, current_fine_c, np.sum(change_happened), change_happened[current_fine_r, current_fine_c], 'current goal', current_goal_left[class_position] )
-                            if current_to_rank_arrays[class_position, block_fine_r, block_fine_c] < 999999999.0 and change_happened[current_fine_r, current_fine_c] == 0 and class_displaced_position != class_position:
-
-                                # Record where change has happened. This is used
-                                change_happened[current_fine_r, current_fine_c] = 1
-
-                                # Write 0-1 to output_change_arrays (3dim) specific to this fine location and this expansion class.
-                                output_change_arrays[class_position, current_fine_r, current_fine_c] = 1
-
-                                # Write the class_position's label value to the projected lulc map
-                                projected_lulc[current_fine_r, current_fine_c] = changing_class_indices[class_position]
-
-                                # Reduce the current class's goal by the amount of hectares in that
-                                current_goal_left[class_position] -= hectares_per_grid_cell[current_fine_r, current_fine_c]
-
-                                # If a class that also was supposed to expand got booted from the cell, increment it's goal left UP
-                                if allow_contracting:
-                                    if current_goal_left[class_displaced_position] > 0:
-                                        current_goal_left[class_displaced_position] += hectares_per_grid_cell[current_fine_r, current_fine_c]
-                                        #print('class ' + str(class_position) + ': ' + changing_class_labels[class_position] + ' replaced EXPANDING class ' + str(class_displaced_position) + ': ' + changing_class_labels[class_displaced_position]  + ' who had goals of ' + str(current_goal_left[class_position]) + ' and ' + str(current_goal_left[class_displaced_position ]) + ' left at location ' + str(current_fine_r) + ' ' + str(current_fine_c))
-                                    #else:
-                                        #print('class ' + str(class_position) + ': ' + changing_class_labels[class_position] + ' replaced CONTRACTING class ' + str(class_displaced_position) + ': ' + changing_class_labels[class_displaced_position]  + ' who had goals of ' + str(current_goal_left[class_position]) + ' and ' + str(current_goal_left[class_displaced_position ]) + ' left at location ' + str(current_fine_r) + ' ' + str(current_fine_c))
-                            
-                            # WHETHER OR NOT IT MADE THE CHANGE, 
-                            # Increment the current allocation position by 1, moving the the next best cell.
-                            current_positions[class_position] += 1
+    if call_string is not '':
+        pass
+        # print ('Cython call_string: ' + call_string)
 
-    if cython_reporting_level >= 11:
-        for i in changing_class_positions:
+    # Only visit coarse cells that have some change, rather than the dense coarse grid.
+    if active_coarse_cells is None:
+        active_coarse_cells = build_active_coarse_cell_index(coarse_change_3d)
+    cdef np.int64_t[:, :] active_cells = np.ascontiguousarray(np.unique(np.asarray(active_coarse_cells, dtype=np.int64).reshape(-1, 3)[:, :2], axis=0))
+    cdef np.int64_t n_active_cells = active_cells.shape[0]
+
+    # Get to correct coarse cell. Dynamic scheduling because the amount of work per cell varies a lot.
+    for cell_i in prange(n_active_cells, nogil=True, schedule='dynamic', num_threads=num_threads):
+        thread_i = threadid()
+        _allocate_coarse_cell(active_cells[cell_i, 0],
+                              active_cells[cell_i, 1],
+                              resolution,
+                              coarse_change_3d,
+                              input_lulc,
+                              spatial_layers_3d,
+                              spatial_layer_coefficients_2d,
+                              spatial_layer_function_types_1d,
+                              valid_mask_array,
+                              changing_class_indices,
+                              class_indices_to_class_positions,
+                              hectares_per_grid_cell,
+                              allow_contracting,
+                              write_suitability_arrays,
+                              write_rank_arrays,
+                              partial_ranking,
+                              current_to_rank_arrays[thread_i],
+                              current_raveled[thread_i],
+                              current_goal_left[thread_i],
+                              current_positions[thread_i],
+                              current_n_eligible[thread_i],
+                              current_n_sorted[thread_i],
+                              projected_lulc_view,
+                              change_happened_view,
+                              output_to_rank_arrays_view,
+                              output_rank_arrays_view)
+
+    if write_rank_arrays:
+        for i in range(n_allocation_classes):
 
             # hb.show(output_rank_arrays[i], output_path=hb.ruri(os.path.join(output_dir, 'output_rank_for_class_' + str(i) + '.png')), title='output_rank for class ' + str(i))
-            hb.save_array_as_geotiff(output_rank_arrays[i], hb.suri(os.path.join(output_dir, 'output_rank_for_class_' + changing_class_labels[i] + '.tif'), call_string), output_match_path, data_type=7)
-    if cython_reporting_level >= 5:
-        for i in changing_class_positions:
+            hb.save_array_as_geotiff(output_rank_arrays[i], hb.suri(os.path.join(output_dir, 'output_rank_for_class_' + changing_class_labels[i] + '.tif'), call_string), output_match_path, data_type=2)
+    if write_suitability_arrays:
+        for i in range(n_allocation_classes):
             # hb.show(np.where(output_to_rank_arrays[i] > 9.e9, np.nan, output_to_rank_arrays[i]), vmin=0, vmax=100, output_path=hb.ruri(os.path.join(output_dir, 'overall_suitability_for_class_' + str(i) + '.png')), data_type = 7, title='overall_suitability for class ' + str(i))
-            hb.save_array_as_geotiff(output_to_rank_arrays[i], hb.suri(os.path.join(output_dir, 'output_to_rank_for_class_' + changing_class_labels[i] + '.tif'), call_string), output_match_path, data_type=7)
+            hb.save_array_as_geotiff(output_to_rank_arrays[i], hb.suri(os.path.join(output_dir, 'output_to_rank_for_class_' + changing_class_labels[i] + '.tif'), call_string), output_match_path, data_type=6 if suitability_t is np.float32_t else 7)
 
+    # Each fine cell is allocated at most once, so a class's allocations are exactly where change happened to it.
+    if return_change_arrays:
+        output_change_arrays = np.zeros((n_allocation_classes, n_fine_rows, n_fine_cols), dtype=np.uint8)
+        for i in range(n_allocation_classes):
+            output_change_arrays[i] = (change_happened == 1) & (projected_lulc == changing_class_indices[i])
+    else:
+        output_change_arrays = None
 
     return projected_lulc, output_change_arrays, change_happened
 
+
 @cython.cdivision(False)
 @cython.boundscheck(True)
 @cython.wraparound(True)
 def calibrate(ndarray[np.float64_t, ndim=3] coarse_change_3d not None,
-                     ndarray[np.int64_t, ndim=2] input_lulc not None,
-                     ndarray[np.float64_t, ndim=3] spatial_layers_3d not None,
+                     ndarray input_lulc not None, # int64 or uint8, see seals_allocation_gridded_input
+                     ndarray spatial_layers_3d not None, # float64 or float32
                      ndarray[np.float64_t, ndim=2] spatial_layer_coefficients_2d not None,
                      ndarray[np.int64_t, ndim=1] spatial_layer_function_types_1d not None,
-                     ndarray[np.int64_t, ndim=2] valid_mask_array not None,
+                     ndarray valid_mask_array not None, # same dtype as input_lulc
                      ndarray[np.int64_t, ndim=1] changing_class_indices not None,
                      list changing_class_labels not None,
                      ndarray[np.int64_t, ndim=2] observed_lulc_array not None,
-                     ndarray[np.float64_t, ndim=2] hectares_per_grid_cell not None,
+                     ndarray hectares_per_grid_cell not None, # float64, see seals_allocation_gridded_input
                      str output_dir,
                      double cython_reporting_level,
                      np.int64_t allow_contracting,
                      np.float64_t sigma,
                      str output_match_path,
                      str call_string,
+                     int num_threads=1,
+                     active_coarse_cells=None,
+                     bint return_change_arrays=True,
+                     loss_function=None, # A CalibrationLossFunction for input_lulc, observed_lulc_array, changing_class_indices and sigma, to use instead of calc_fit_of_projected_against_observed_loss_function
               ):
 
 
@@ -521,10 +843,16 @@ def calibrate(ndarray[np.float64_t, ndim=3] coarse_change_3d not None,
                                             cython_reporting_level,
                                             allow_contracting,
                                             output_match_path,
-                                            call_string,)
+                                            call_string,
+                                            num_threads=num_threads,
+                                            active_coarse_cells=active_coarse_cells,
+                                            return_change_arrays=return_change_arrays)
 
-    overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
-        calc_fit_of_projected_against_observed_loss_function(input_lulc, projected_lulc_array, observed_lulc_array, list(changing_class_indices), sigma)
+    if loss_function is not None:
+        overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots = loss_function(projected_lulc_array)
+    else:
+        overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
+            calc_fit_of_projected_against_observed_loss_function(input_lulc, projected_lulc_array, observed_lulc_array, list(changing_class_indices), sigma)
 
     if cython_reporting_level >= 10:
         for i in range(len(class_similarity_plots)):
@@ -549,6 +877,8 @@ def calibrate_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_change_mat
                      double cython_reporting_level,
                      np.float64_t sigma,
                      str call_string,
+                     loss_function=None, # A CalibrationLossFunction for input_lulc, observed_lulc_array, change_class_ids and sigma, to use instead of calc_fit_of_projected_against_observed_loss_function
+                     class_suitability_3d=None, # Precomputed suitability to rank instead of the layers and coefficients, see seals_allocation_from_change_matrix
               ):
 
 
@@ -562,10 +892,14 @@ def calibrate_from_change_matrix(ndarray[np.float64_t, ndim=4] coarse_change_mat
                                             hectares_per_grid_cell,
                                             output_dir,
                                             cython_reporting_level,
-                                            call_string,)
+                                            call_string,
+                                            class_suitability_3d=class_suitability_3d)
 
-    overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
-        calc_fit_of_projected_against_observed_loss_function(input_lulc, projected_lulc_array, observed_lulc_array, list(change_class_ids), sigma)
+    if loss_function is not None:
+        overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots = loss_function(projected_lulc_array)
+    else:
+        overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
+            calc_fit_of_projected_against_observed_loss_function(input_lulc, projected_lulc_array, observed_lulc_array, list(change_class_ids), sigma)
 
     if cython_reporting_level >= 10:
         for i in range(len(class_similarity_plots)):
@@ -623,6 +957,80 @@ def calc_fit_of_projected_against_observed_loss_function(baseline_array, project
     overall_similarity_score = sum(class_similarity_scores)
     return overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots
 
+
+class CalibrationLossFunction(object):
+    """Same loss as calc_fit_of_projected_against_observed_loss_function, for the fixed baseline, observed lulc, classes
+    and sigma that every try of a calibration zone uses. The blurred observed expansions and contractions of each class
+    only depend on those, so they are computed once here and calling the object with a projected lulc only blurs the
+    projected side, with expansions in dtype. The blurred projected fields of the previous call are kept, and a call
+    only re-blurs the window around the pixels whose expansions or contractions changed since then (or everything, if
+    that window covers most of the array). The window reaches twice the filter radius past the changes and only the
+    part within one radius is updated, so the result is the same as blurring the whole field again."""
+
+    def __init__(self, baseline_array, observed_array, similarity_class_ids, sigma, dtype=np.float64):
+        self.similarity_class_ids = list(similarity_class_ids)
+        self.sigma = sigma
+        self.dtype = np.dtype(dtype)
+        self.radius = int(4.0 * float(sigma) + 0.5)  # That of scipy.ndimage.gaussian_filter with its default truncate.
+        self.baseline_binaries = []
+        self.observed_expansions_blurred = []
+        self.observed_contractions_blurred = []
+        for id in self.similarity_class_ids:
+            baseline_binary = np.where(baseline_array == id, 1, 0).astype(self.dtype)
+            observed_binary = np.where(observed_array == id, 1, 0).astype(self.dtype)
+            ob_expansions = np.where(baseline_binary == 0, observed_binary, 0)
+            ob_contractions = np.where((baseline_binary == 1) & (observed_binary == 0), 1, 0)
+            self.baseline_binaries.append(baseline_binary)
+            self.observed_expansions_blurred.append(scipy.ndimage.gaussian_filter(ob_expansions, sigma=sigma))
+            self.observed_contractions_blurred.append(scipy.ndimage.gaussian_filter(ob_contractions, sigma=sigma))
+        self.previous_projected_fields = [None] * len(self.similarity_class_ids)
+        self.previous_projected_fields_blurred = [None] * len(self.similarity_class_ids)
+
+    def blur_updating_previous(self, field, previous_field, previous_field_blurred):
+        if previous_field is None:
+            return scipy.ndimage.gaussian_filter(field, sigma=self.sigma)
+        changed = field != previous_field
+        changed_rows, changed_cols = np.nonzero(np.any(changed, axis=1))[0], np.nonzero(np.any(changed, axis=0))[0]
+        if len(changed_rows) == 0:
+            return previous_field_blurred
+        n_r, n_c = field.shape
+        r_min, r_max, c_min, c_max = int(changed_rows.min()), int(changed_rows.max()), int(changed_cols.min()), int(changed_cols.max())
+        window = (max(r_min - 2 * self.radius, 0), min(r_max + 2 * self.radius + 1, n_r), max(c_min - 2 * self.radius, 0), min(c_max + 2 * self.radius + 1, n_c))
+        if (window[1] - window[0]) * (window[3] - window[2]) > 0.5 * n_r * n_c:
+            return scipy.ndimage.gaussian_filter(field, sigma=self.sigma)
+        inner = (max(r_min - self.radius, 0), min(r_max + self.radius + 1, n_r), max(c_min - self.radius, 0), min(c_max + self.radius + 1, n_c))
+        window_blurred = scipy.ndimage.gaussian_filter(field[window[0]: window[1], window[2]: window[3]], sigma=self.sigma)
+        field_blurred = previous_field_blurred.copy()
+        field_blurred[inner[0]: inner[1], inner[2]: inner[3]] = window_blurred[inner[0] - window[0]: inner[1] - window[0], inner[2] - window[2]: inner[3] - window[2]]
+        return field_blurred
+
+    def __call__(self, projected_array):
+        overall_similarity_plot = np.zeros(projected_array.shape, dtype=np.float64)
+        class_similarity_scores = []
+        class_similarity_plots = []
+
+        for c, id in enumerate(self.similarity_class_ids):
+            baseline_binary = self.baseline_binaries[c]
+            projected_binary = np.where(projected_array == id, 1, 0).astype(self.dtype)
+            pb_expansions = np.where(baseline_binary == 0, projected_binary, 0)
+            pb_contractions = np.where((baseline_binary == 1) & (projected_binary == 0), 1, 0)
+
+            previous_fields = self.previous_projected_fields[c] or (None, None)
+            previous_fields_blurred = self.previous_projected_fields_blurred[c] or (None, None)
+            pb_expansions_blurred = self.blur_updating_previous(pb_expansions, previous_fields[0], previous_fields_blurred[0])
+            pb_contractions_blurred = self.blur_updating_previous(pb_contractions, previous_fields[1], previous_fields_blurred[1])
+            self.previous_projected_fields[c] = (pb_expansions, pb_contractions)
+            self.previous_projected_fields_blurred[c] = (pb_expansions_blurred, pb_contractions_blurred)
+
+            l1_gaussian = abs(pb_expansions_blurred - self.observed_expansions_blurred[c]) + abs(pb_contractions_blurred - self.observed_contractions_blurred[c])
+            class_similarity_plots.append(l1_gaussian)
+            class_similarity_scores.append(np.sum(l1_gaussian))
+
+            overall_similarity_plot += l1_gaussian
+
+        overall_similarity_score = sum(class_similarity_scores)
+        return overall_similarity_score, overall_similarity_plot, class_similarity_scores, class_similarity_plots
+
 #
 # # cython: cdivision=True
 # # define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
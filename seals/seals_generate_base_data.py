@@ -115,6 +115,9 @@ def lulc_clip(p):
                         p.lulc_src_paths[year] = p.aoi_lulc_src_paths[year] 
                         
 
+                        if p.use_fused_lulc_preprocessing:
+                            fused_lulc_preprocessing(p, year)
+
                         if not hb.path_exists(p.aoi_lulc_src_paths[year]):
                             hb.create_directories(p.aoi_lulc_src_paths[year])
                             hb.clip_raster_by_bb(p.base_data_lulc_src_paths[year], p.bb, p.aoi_lulc_src_paths[year])
@@ -134,6 +137,61 @@ def lulc_clip(p):
                             hb.create_directories(p.aoi_lulc_src_paths[year])
                             hb.clip_raster_by_bb(p.base_data_lulc_src_paths[year], p.bb, p.aoi_lulc_src_paths[year])
 
+                        if p.use_fused_lulc_preprocessing:
+                            fused_lulc_preprocessing(p, year)
+
+
+def fused_lulc_preprocessing(p, year):
+    """Write the clipped lulc, the simplified lulc and the class binaries for year that lulc_clip, lulc_simplifications
+    and lulc_binaries would otherwise each make with a separate pass over the fine lulc, all from one read of it.
+    Uses the same paths as those tasks so they find the outputs and skip them. Outputs that already exist, or that
+    those tasks would clip from base_data, are left to them."""
+    simplified_filename_start = 'lulc_' + p.lulc_src_label + '_' + p.lulc_simplification_label + '_'
+    binary_filename_start = 'binary_' + p.lulc_src_label + '_' + p.lulc_simplification_label + '_'
+    simplified_search_path = os.path.join('lulc', p.lulc_src_label, p.lulc_simplification_label, simplified_filename_start + str(year) + '.tif')
+    binaries_search_dir = os.path.join('lulc', p.lulc_src_label, p.lulc_simplification_label, 'binaries', str(year))
+
+    binary_class_ids_by_path = {}
+    if p.aoi != 'global':
+        clipped_path = p.aoi_lulc_src_paths[year]
+        simplified_path = os.path.join(p.fine_processed_inputs_dir, simplified_search_path)
+        if hb.path_exists(os.path.join(p.base_data_dir, simplified_search_path)):
+            simplified_path = None
+        for class_label in p.all_class_labels:
+            binary_search_path = os.path.join(binaries_search_dir, binary_filename_start + str(year) + '_' + class_label + '.tif')
+            if not hb.path_exists(os.path.join(p.base_data_dir, binary_search_path)):
+                binary_class_ids_by_path[os.path.join(p.fine_processed_inputs_dir, binary_search_path)] = int(p.lulc_correspondence_dict['dst_labels_to_ids'][class_label])
+    else:
+        clipped_path = None
+        simplified_path = hb.get_first_extant_path(simplified_search_path, [p.fine_processed_inputs_dir, p.input_dir, p.base_data_dir])
+        for class_label in p.all_class_labels:
+            binary_search_path = os.path.join(binaries_search_dir, binary_filename_start + str(year) + '_' + class_label + '.tif')
+            binary_path = hb.get_first_extant_path(binary_search_path, [p.fine_processed_inputs_dir, p.input_dir, p.base_data_dir])
+            binary_class_ids_by_path[binary_path] = int(p.lulc_correspondence_dict['dst_labels_to_ids'][class_label])
+
+    if clipped_path is not None and hb.path_exists(clipped_path):
+        clipped_path = None
+    if simplified_path is not None and hb.path_exists(simplified_path):
+        simplified_path = None
+    binary_class_ids_by_path = {k: v for k, v in binary_class_ids_by_path.items() if not hb.path_exists(k)}
+    if clipped_path is None and simplified_path is None and not binary_class_ids_by_path:
+        return
+
+    # Read from the already-clipped lulc if there is one, otherwise from the window of the base_data lulc.
+    if p.aoi != 'global' and clipped_path is not None:
+        src_path, bb = p.base_data_lulc_src_paths[year], p.bb
+    else:
+        src_path, bb = p.lulc_src_paths[year], None
+
+    hb.log('Writing ' + str(int(clipped_path is not None) + int(simplified_path is not None) + len(binary_class_ids_by_path)) + ' preprocessed lulc rasters for ' + str(year) + ' in one pass over ' + src_path)
+    try:
+        seals_utils.write_lulc_preprocessing_in_one_pass(src_path, bb, p.lulc_correspondence_dict['src_to_dst_reclassification_dict'],
+                                                         clipped_path=clipped_path, simplified_path=simplified_path, binary_class_ids_by_path=binary_class_ids_by_path,
+                                                         num_threads=min(p.num_workers, 8) if p.num_workers else 4)
+    except NameError as e:
+        # E.g. classes that don't fit the uint8 lookup table. Nothing was written, so the separate tasks make the outputs.
+        hb.log('Could not preprocess the lulc for ' + str(year) + ' in one pass, leaving it to lulc_clip, lulc_simplifications and lulc_binaries: ' + str(e))
+
 
 
 def lulc_clip_quick(p):
@@ -329,6 +387,7 @@ def lulc_convolutions(p):
         # p.starting_coefficients_df = pd.read_csv(p.regressors_starting_values_path)
 
         parallel_iterable = []
+        batched_convolutions = {}
 
         # if nyi:
         #     years_to_convolve = list(set([p.training_start_year, p.training_end_year, p.base_year]))
@@ -378,8 +437,47 @@ def lulc_convolutions(p):
 
                         hb.log('  Starting FFT Gaussian (in parallel) on ' + current_input_binary_path + ' and saving to ' + p.lulc_simplified_convolution_paths[current_convolution_name])
                         parallel_iterable.append([current_input_binary_path, kernel_path, p.lulc_simplified_convolution_paths[current_convolution_name], -9999.0, True])
-
-        if len(parallel_iterable) > 0 and p.run_this:
+                        batched_convolutions.setdefault(year, []).append((current_input_binary_path, kernel_path, p.lulc_simplified_convolution_paths[current_convolution_name]))
+
+        memory_budget_bytes = int(p.convolution_memory_budget_gb * 1024 ** 3) if p.convolution_memory_budget_gb is not None else None
+
+        if len(parallel_iterable) > 0 and p.run_this and p.convolution_filter_backend == 'sum_of_gaussians':
+            # Kernels that a sum of gaussians fits closely enough, checked against the FFT convolution of a sample of the
+            # binaries, are applied as separable recursive filters without reading the kernel rasters. Any others are left
+            # to the FFT convolution below.
+            for year, convolutions in batched_convolutions.items():
+                kernel_terms_by_path = {}
+                for sigma in p.gaussian_sigmas_to_test:
+                    kernel_path = os.path.join(p.fine_processed_inputs_dir, 'generated_kernels', 'gaussian_' + str(sigma) + '.tif')
+                    if kernel_path not in [i[1] for i in convolutions]:
+                        continue
+                    kernel_array = seals_utils.get_array_from_two_dim_first_order_kernel_function(int(sigma * 9.0), 1.0, sigma)
+                    kernel_terms, kernel_error = seals_utils.get_sum_of_gaussians_kernel_terms(kernel_array, sigma)
+                    filter_error = seals_utils.get_sum_of_gaussians_filter_error(convolutions[0][0], kernel_array, kernel_terms)
+                    hb.log('  Sum of gaussians for sigma ' + str(sigma) + ' is within ' + str(filter_error) + ' of the FFT convolution (relative to its maximum).')
+                    if filter_error <= p.sum_of_gaussians_convolution_tolerance:
+                        kernel_terms_by_path[kernel_path] = kernel_terms
+
+                separable_convolutions = [i for i in convolutions if i[1] in kernel_terms_by_path]
+                if len(separable_convolutions) > 0:
+                    signal_paths, kernel_paths, target_paths = seals_utils.get_signal_by_kernel_target_paths(separable_convolutions)
+                    hb.log('  Starting sum of gaussians filtering of ' + str(len(signal_paths)) + ' binaries with ' + str(len(kernel_paths)) + ' kernels for ' + str(year))
+                    seals_utils.filter_signals_with_sum_of_gaussians(signal_paths, [kernel_terms_by_path[i] for i in kernel_paths], target_paths, target_nodata=-9999.0, memory_budget_bytes=memory_budget_bytes)
+
+            parallel_iterable = [i for i in parallel_iterable if not os.path.exists(i[2])]
+            batched_convolutions = {year: [i for i in convolutions if not os.path.exists(i[2])] for year, convolutions in batched_convolutions.items()}
+
+        if len(parallel_iterable) > 0 and p.run_this and p.use_batched_convolutions:
+            # All the binaries of a year are on one grid, so they can go through one batched convolution, which transforms
+            # each binary once for all sigmas.
+            for year, convolutions in batched_convolutions.items():
+                if len(convolutions) == 0:
+                    continue
+                signal_paths, kernel_paths, target_paths = seals_utils.get_signal_by_kernel_target_paths(convolutions)
+                hb.log('  Starting batched FFT convolution of ' + str(len(signal_paths)) + ' binaries with ' + str(len(kernel_paths)) + ' kernels for ' + str(year))
+                seals_utils.convolve_signals_with_kernels(signal_paths, kernel_paths, target_paths, target_nodata=-9999.0, memory_budget_bytes=memory_budget_bytes)
+
+        elif len(parallel_iterable) > 0 and p.run_this:
             num_workers = max(min(multiprocessing.cpu_count() - 1, len(parallel_iterable)), 1)
             worker_pool = multiprocessing.Pool(num_workers)  # NOTE, worker pool and results are LOCAL variabes so that they aren't pickled when we pass the project object.
             result = worker_pool.starmap_async(seals_utils.fft_gaussian, parallel_iterable)
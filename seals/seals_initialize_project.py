@@ -34,6 +34,108 @@ def set_advanced_options(p):
 
     p.num_workers = None  # None sets it to max available. Otherwise, set to an integer.
 
+    # Number of OpenMP threads each allocation tile uses to process its coarse cells in parallel. Setting this to 0 uses
+    # all available cores, which is useful when running few (or one) tiles at a time on a large node. When tiles
+    # are already spread across num_workers processes, leave this at 1 to avoid oversubscribing the cores.
+    p.allocation_num_threads = 1
+
+    # Dtypes the allocation runs in. float64 uses int64 class codes and masks and float64 regressors. compact uses uint8
+    # class codes and masks and float32 regressors and suitability, which cuts each tile's working set several times and
+    # so allows a larger processing_resolution. Cells whose suitabilities only differ beyond float32 precision can be
+    # ranked differently, so compact results match float64 ones within a tolerance rather than exactly.
+    p.allocation_dtype_mode = 'float64'
+
+    # If True, the per-class suitability of each allocation block is saved in intermediate/suitability_cache the first
+    # time it is computed and reused by every scenario and year with the same coefficients and regressor files. This
+    # replaces reading every regressor per tile-year with reading one layer per changing class, at the cost of storing
+    # n_changing_classes fine-resolution layers per block (in the allocation_dtype_mode dtype).
+    p.use_suitability_cache = False
+
+    # How allocation walks the scenarios, years and blocks. year_major runs every block of a year before starting the
+    # next year, and each block finds its previous year's lulc and cumulative change on disk. tile_major gives each
+    # allocation_zones worker one block for all years of a scenario, chaining the lulc, cumulative change and loaded
+    # inputs in memory and writing each year's outputs in the background. Both write the same per-year tile outputs.
+    p.allocation_execution_mode = 'year_major'
+
+    # If True, the regressors of each allocation and calibration block are stacked into one bundle in
+    # intermediate/regressor_bundles (a .npy in the layout the block uses, with a .json header of layer names, paths and
+    # dtype) the first time the block is loaded. Later runs of the block read the bundle sequentially instead of doing
+    # one windowed read per regressor in the global rasters. Costs one stack of regressors per block on disk.
+    p.use_regressor_bundles = False
+
+    # If True, allocation_zones reads the AOI-wide coarse change rasters of the current scenario and year (all years in
+    # tile_major mode) and the coarse ha per cell once into shared memory, and every allocation worker takes its block's
+    # coarse cells from there instead of opening each raster. Needs room for those rasters as float64 in shared memory
+    # (/dev/shm on Linux, which is small by default in some containers).
+    p.use_shared_coarse_inputs = False
+
+    # If True, allocation and calibration compute the hectares of each fine cell from the block's geotransform (on the
+    # WGS84 ellipsoid, one value per row) instead of reading a window of the fine ha_per_cell raster. The values match
+    # the raster up to its storage precision. block_ha_per_cell_fine.tif is then not written.
+    p.use_analytic_ha_per_cell = False
+
+    # If True, each allocation block writes its lulc into a live mosaic of its scenario and year (an uncompressed, sparse,
+    # tiled GeoTIFF on the grid of the base map) as soon as it finishes, so the map can be looked at during the run.
+    # Stitching then writes the stitched map as a COG in a single pass over the base map with the live mosaic on top,
+    # instead of stitching through a VRT and converting to COG afterwards.
+    p.use_live_mosaic = False
+
+    # Stitched global maps are converted to COGs in parallel, starting each conversion only while the estimated peak
+    # memory of the running ones fits in this many GB (None for half the physical memory), and never more than
+    # cog_conversion_max_workers at once.
+    p.cog_conversion_memory_budget_gb = None
+    p.cog_conversion_max_workers = 16
+
+    # If True, lulc_clip writes the clipped, simplified and binary fine lulc maps of each year from a single read of the
+    # source lulc, instead of lulc_clip, lulc_simplifications and lulc_binaries each making a full pass over it. Maps
+    # available in base_data are still clipped from there.
+    p.use_fused_lulc_preprocessing = False
+
+    # If True, lulc_convolutions convolves all binaries of a year with all kernels in one batched FFT pass: each tile of
+    # a binary is transformed once and reused for every sigma, instead of one full convolution per class and sigma in
+    # a process pool. Tiles are as large as fit in convolution_memory_budget_gb (None for a quarter of physical memory).
+    p.use_batched_convolutions = False
+    p.convolution_memory_budget_gb = None
+
+    # Backend for lulc_convolutions. 'fft' convolves with the kernel rasters from generated_kernels. 'sum_of_gaussians'
+    # fits each kernel with a sum of separable gaussians and applies them as recursive filters, whose cost and memory per
+    # pixel don't grow with sigma. It is only used for a kernel if its result on a sample of the binaries is within
+    # sum_of_gaussians_convolution_tolerance of the FFT result (relative to its maximum); other kernels fall back to 'fft'.
+    p.convolution_filter_backend = 'fft'
+    p.sum_of_gaussians_convolution_tolerance = 0.01
+
+    # Number of processes that evaluate the independent candidate coefficients of each calibration generation (the +/-
+    # sweep) in parallel, sharing the zone's inputs through shared memory. None uses all cores. This only helps when the
+    # calibration zones run serially (run_in_parallel off, or a single zone): zones run by a parallel iterator are already
+    # worker processes, which can't start a pool, so there the sweep stays serial whatever this is set to. It defaults to
+    # 1 on purpose, as the zones are usually what runs in parallel. Candidates from the pool are scored with calibration
+    # reporting off, so their per-try files aren't written.
+    p.calibration_candidate_workers = 1
+
+    # If True, the serially evaluated candidates of each calibration generation get their suitabilities from one matrix
+    # product of the regressors with the coefficients of many candidates at once, batched to fit in
+    # candidate_suitability_memory_budget_gb (None for a quarter of physical memory), instead of each allocation
+    # rebuilding them layer by layer. Matches the per-layer suitability to rounding.
+    p.use_batched_candidate_suitability = False
+    p.candidate_suitability_memory_budget_gb = None
+
+    # How calibration_zones searches the additive coefficients of each generation. 'sweep' is the +/- sweep followed by
+    # combining and rescaling the improvements. 'nelder_mead', 'evolution_strategy' (CMA-ES) and 'golden_section'
+    # (line search per coefficient) are the gradient-free optimizers of seals_utils.calibration_optimizers, which stop
+    # after calibration_optimizer_max_evaluations allocations or once they improve by less than
+    # calibration_optimizer_tolerance (relative). The calls and score of each generation are written to
+    # calibration_evaluations_zone_<zone>.csv for every optimizer, including the sweep.
+    p.calibration_optimizer = 'sweep'
+    p.calibration_optimizer_max_evaluations = 200
+    p.calibration_optimizer_tolerance = 0.01
+
+    # If True, calibration_zones keeps the score of every coefficient table it tries in calibration_evaluation_cache.jsonl
+    # in the zone's dir, keyed by a hash of the zone, the coefficients, the regressors and the loss settings, and looks
+    # tables up there before allocating them. This skips tables the search revisits and, because the cache persists,
+    # the ones already scored before a rerun. The hit rate of each generation is written to
+    # calibration_evaluations_zone_<zone>.csv.
+    p.use_calibration_evaluation_cache = False
+
     # Determine if overviews should be written.
     p.write_global_lulc_overviews_and_tifs = True
 
@@ -51,6 +153,13 @@ def set_advanced_options(p):
     # happening, but it can lead to funnylooking total-flip cells.
     p.allow_contracting = 0
 
+    # Whether allocation also scores the projected lulc against the observed lulc with the calibration loss function.
+    # This costs several full-extent gaussian blurs per class per tile and scenario runs don't use the score, so it is
+    # off by default. One of never, always, validation (only when output_writing_level >= 5) or sampled (a repeatable
+    # allocation_fit_sample_fraction of tiles). Scores are written to allocation_fit.csv in the tile dir.
+    p.allocation_fit_mode = 'never'
+    p.allocation_fit_sample_fraction = 0.01
+
     # Change how many generations of training to allow. A generation is an exhaustive search so relatievely few generations are required to get to a point
     # where no more improvements can be found.
     p.num_generations = 1
@@ -63,6 +172,12 @@ def set_advanced_options(p):
     # However doing so can cause confusing cache-invalidation situations for troubleshooting so it's off by default.
     p.skip_created_downscaling_zones = 0
 
+    # Allocation records each finished block in a completion ledger with the size, mtime and sha1 of its outputs (hashed
+    # by the tile writer, after the outputs are written). Restarting, skipping and stitching always check the size and
+    # mtime. If True, they also check the sha1, which catches outputs corrupted in place at the cost of reading every
+    # recorded output in full.
+    p.verify_completion_ledger_checksums = False
+
     # For testing,it may be useful to just run the first element of each iterator for speed.
     p.run_only_first_element_of_each_iterator = 0
 
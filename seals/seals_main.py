@@ -1,4 +1,5 @@
 import collections
+import concurrent.futures
 import copy
 import logging
 import math
@@ -7,6 +8,7 @@ import os
 import sys
 import time
 import warnings
+import zlib
 from collections import OrderedDict
 
 import hazelbean as hb
@@ -945,6 +947,7 @@ def calibration_zones(passed_p=None):
         p.generation_parameter_notations = OrderedDict()
 
         generation_best_parameters = None
+        calibration_loss_function = None
 
         additive_coefficients_modulo = .1
         additive_coefficients_modulo = 1.
@@ -970,32 +973,45 @@ def calibration_zones(passed_p=None):
 
 
         normalize_inputs = True
-        for c, path in enumerate(spatial_layer_paths):
-            hb.debug('Loading spatial layer at path ' + path)
-            current_bb = hb.get_bounding_box(path)
-            if current_bb == hb.global_bounding_box:
-                correct_fine_block_list = p.global_fine_blocks_list
-                correct_coarse_block_list = p.global_coarse_blocks_list
-            else:
-                correct_fine_block_list = p.fine_blocks_list
-                correct_coarse_block_list = p.coarse_blocks_list
-            if spatial_layer_types[c] == 'additive' or spatial_layer_types[c] == 'multiplicative':
-                if normalize_inputs is True:
-                    spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
+        # With use_regressor_bundles the stacked (and normalized) regressors of this block are read from one bundle file,
+        # written the first time the block is loaded, instead of one windowed read per regressor.
+        if p.use_regressor_bundles:
+            regressor_bundle_path = seals_utils.get_regressor_bundle_path(os.path.join(p.intermediate_dir, 'regressor_bundles'), spatial_layer_paths, p.fine_blocks_list, p.global_fine_blocks_list, np.float64, normalize_inputs)
+        else:
+            regressor_bundle_path = None
+        if regressor_bundle_path is not None and hb.path_exists(regressor_bundle_path):
+            hb.debug('Loading regressor bundle ' + regressor_bundle_path)
+            spatial_layers_3d = seals_utils.load_regressor_bundle(regressor_bundle_path, spatial_layer_names)
+        else:
+            for c, path in enumerate(spatial_layer_paths):
+                hb.debug('Loading spatial layer at path ' + path)
+                current_bb = hb.get_bounding_box(path)
+                if current_bb == hb.global_bounding_box:
+                    correct_fine_block_list = p.global_fine_blocks_list
+                    correct_coarse_block_list = p.global_coarse_blocks_list
                 else:
-                    spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
-            elif spatial_layer_types[c][0:8] == 'gaussian':
-                # updated_path = os.path.join(p.calibration_zones_dir, 'class_' + spatial_layer_names[c].split('_')[1] + '_gaussian_' + spatial_layer_names[c].split('_')[3] + '_convolution.tif')
-                # L.debug('updated_path', updated_path)
-                L.debug('path', path)
-                if normalize_inputs is True:
-                    spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
+                    correct_fine_block_list = p.fine_blocks_list
+                    correct_coarse_block_list = p.coarse_blocks_list
+                if spatial_layer_types[c] == 'additive' or spatial_layer_types[c] == 'multiplicative':
+                    if normalize_inputs is True:
+                        spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
+                    else:
+                        spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
+                elif spatial_layer_types[c][0:8] == 'gaussian':
+                    # updated_path = os.path.join(p.calibration_zones_dir, 'class_' + spatial_layer_names[c].split('_')[1] + '_gaussian_' + spatial_layer_names[c].split('_')[3] + '_convolution.tif')
+                    # L.debug('updated_path', updated_path)
+                    L.debug('path', path)
+                    if normalize_inputs is True:
+                        spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
+                    else:
+                        L.debug('fine_blocks_list', p.fine_blocks_list)
+                        spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)  # NOTE assumes already clipped
+                        # spatial_layers_3d[c] = hb.as_array(path)  # NOTE assumes already clipped
                 else:
-                    L.debug('fine_blocks_list', p.fine_blocks_list)
-                    spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)  # NOTE assumes already clipped
-                    # spatial_layers_3d[c] = hb.as_array(path)  # NOTE assumes already clipped
-            else:
-                raise NameError('unspecified type')
+                    raise NameError('unspecified type')
+
+            if regressor_bundle_path is not None:
+                seals_utils.write_regressor_bundle(regressor_bundle_path, spatial_layers_3d, spatial_layer_names, spatial_layer_paths)
 
 
         # Set how much change for each class needs to be allocated.
@@ -1042,8 +1058,80 @@ def calibration_zones(passed_p=None):
             seals_visualization_functions.plot_coarse_change_3d(p.cur_dir, observed_coarse_change_3d)
 
 
+        # The number of calibrate_from_change_matrix calls, cache hits and the final score of each generation, written next
+        # to the trained coefficients so that the optimizers and the search schedule can be compared.
+        calibration_evaluations_rows = []
+        calibration_evaluation_counts = {'calls': 0, 'cache_hits': 0}
+
+        # With use_calibration_evaluation_cache, the score of every coefficient table tried is kept in a cache in the zone's
+        # dir, keyed by the coefficients, the zone, the regressors, the training lulc and change matrix files and the loss
+        # settings, so that no table is allocated twice, including when a zone is rerun after being interrupted.
+        if p.use_calibration_evaluation_cache:
+            zone_id = os.path.split(os.path.split(p.cur_dir)[0])[1]
+            calibration_input_paths = [p.lulc_simplified_paths['lulc_esa_' + p.lulc_simplification_label + '_' + str(p.training_start_year)],
+                                       p.lulc_simplified_paths['lulc_esa_' + p.lulc_simplification_label + '_' + str(p.training_end_year)],
+                                       p.calibration_full_change_matrix_path]
+            calibration_loss_settings = {'sigma': float(p.loss_function_sigma), 'dtype': 'float32' if p.allocation_dtype_mode == 'compact' else 'float64',
+                                         'class_indices': [int(i) for i in p.class_indices], 'training_start_year': p.training_start_year, 'training_end_year': p.training_end_year,
+                                         'lulc_simplification_label': p.lulc_simplification_label, 'fine_blocks_list': [str(i) for i in p.fine_blocks_list],
+                                         'input_files': seals_utils.get_paths_fingerprint(calibration_input_paths),
+                                         'use_analytic_ha_per_cell': bool(p.use_analytic_ha_per_cell), 'allow_contracting': int(p.allow_contracting)}
+            calibration_settings_key = seals_utils.get_calibration_evaluation_settings_key(zone_id, spatial_layer_names, spatial_layer_paths, spatial_layer_types, calibration_loss_settings)
+            calibration_evaluation_cache_path = seals_utils.get_calibration_evaluation_cache_path(p.cur_dir)
+            calibration_evaluation_cache = seals_utils.read_calibration_evaluation_cache(calibration_evaluation_cache_path)
+            hb.log('Loaded ' + str(len(calibration_evaluation_cache)) + ' cached calibration evaluations from ' + calibration_evaluation_cache_path)
+        else:
+            calibration_evaluation_cache = None
+
+        def get_cached_calibration_score(spatial_layer_coefficients_2d, count_hit=True):
+            # Return the cached weighted score of spatial_layer_coefficients_2d, or None if it hasn't been scored yet.
+            if calibration_evaluation_cache is None:
+                return None
+            score = calibration_evaluation_cache.get(seals_utils.get_calibration_evaluation_key(calibration_settings_key, spatial_layer_coefficients_2d))
+            if score is not None and count_hit:
+                calibration_evaluation_counts['cache_hits'] += 1
+            return score
+
+        def cache_calibration_score(spatial_layer_coefficients_2d, score):
+            if calibration_evaluation_cache is not None:
+                key = seals_utils.get_calibration_evaluation_key(calibration_settings_key, spatial_layer_coefficients_2d)
+                if key not in calibration_evaluation_cache:
+                    calibration_evaluation_cache[key] = score
+                    seals_utils.append_to_calibration_evaluation_cache(calibration_evaluation_cache_path, key, score)
+
+        def calibrate_and_score(spatial_layer_coefficients_2d, class_suitability_3d=None):
+            # Return the weighted score calibration ranks coefficients by, the number of changed cells over the loss plus
+            # one, from the cache if these coefficients have been scored before.
+            cached_score = get_cached_calibration_score(spatial_layer_coefficients_2d)
+            if cached_score is not None:
+                return cached_score
+
+            overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
+                calibrate_from_change_matrix(coarse_change_matrix_4d,
+                          lulc_baseline_array,
+                          spatial_layers_3d,
+                          spatial_layer_coefficients_2d,
+                          spatial_layer_function_types_1d,
+                          valid_mask_array,
+                          p.change_class_labels,
+                          observed_lulc_array,
+                          hectares_per_grid_cell,
+                          p.cur_dir,
+                          p.calibration_reporting_level,
+                          p.loss_function_sigma,
+                          p.call_string,
+                          loss_function=calibration_loss_function,
+                          class_suitability_3d=class_suitability_3d)
+            calibration_evaluation_counts['calls'] += 1
+
+            weighted_score = seals_utils.calc_calibration_weighted_score(lulc_baseline_array, lulc_projected_array, overall_similarity_score)
+            cache_calibration_score(spatial_layer_coefficients_2d, weighted_score)
+            return weighted_score
+
         for generation_id in range(p.num_generations):
             hb.log('Starting generation ' + str(generation_id) + ' for location ' + str(p.fine_blocks_list))
+            calibration_evaluation_counts['calls'] = 0
+            calibration_evaluation_counts['cache_hits'] = 0
             p.generation_parameters[generation_id] = OrderedDict()
             p.generation_parameter_notations[generation_id] = OrderedDict()
 
@@ -1118,209 +1206,213 @@ def calibration_zones(passed_p=None):
             # hb.clip_raster_by_cr_size(p.lulc_baseline_input.path, p.fine_blocks_list, p.lulc_baseline_path)
 
             # Load things that dont ever change over generations or final run
-            hectares_per_grid_cell = hb.load_geotiff_chunk_by_cr_size(p.aoi_ha_per_cell_fine_path, p.fine_blocks_list).astype(np.float64)
-
-
-            # Generate tries by +/- on each of the IxJ adjacency parameters
-            try_id = 1 # Not zero because zero is the generation starting param
-            for spatial_layer_id, spatial_layer_label in enumerate(spatial_layer_names):
-                for change_class_id, change_class_label in enumerate(p.change_class_labels):
-                    if spatial_layer_types[spatial_layer_id] == 'additive' or spatial_layer_types[spatial_layer_id][0:8] == 'gaussian':
-                        # QUIRK, notice that we copy the generation starting parameters EACH TIME we update a parameter. This is so that we have a fresh, unmodified set for the single thing we change.
-                        # Increment it down
-                        p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
-                        new_coefficient = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] - additive_coefficients_modulo
-                        p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] = new_coefficient
-                        p.generation_parameter_notations[generation_id][try_id] = {'new_coefficient': new_coefficient, 'old_coefficient': new_coefficient + additive_coefficients_modulo, 'spatial_layer_label': spatial_layer_label, 'spatial_layer_id': spatial_layer_id, 'change_class_id': change_class_id, 'change_class_label': change_class_label, 'spatial_layer_type': spatial_layer_types[spatial_layer_id]}
-
-                        try_id += 1
-
-                        # Increment it up
-                        p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
-                        new_coefficient = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] + additive_coefficients_modulo
-                        p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] = new_coefficient
-
-                        p.generation_parameter_notations[generation_id][try_id] = {'new_coefficient': new_coefficient, 'old_coefficient': new_coefficient - additive_coefficients_modulo, 'spatial_layer_label': spatial_layer_label, 'spatial_layer_id': spatial_layer_id, 'change_class_id': change_class_id, 'change_class_label': change_class_label, 'spatial_layer_type': spatial_layer_types[spatial_layer_id]}
-
-                        try_id += 1
-                    elif spatial_layer_types[spatial_layer_id] == 'multiplicative':
-                        pass
-                        # # Increment it down
-                        # p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
-                        # p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] \
-                        #     = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] * multiplicative_coefficients_modulo
-                        # try_id += 1
-                        #
-                        # # Increment it up
-                        # p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
-                        # p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] \
-                        #     = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] / multiplicative_coefficients_modulo
-
-            benchmark_score = None
-            current_best_score = 1e+100
-
-            try_scores = OrderedDict()
-            try_coefficients = OrderedDict()
-
-            # Run the model repeatedly, iterating through individual parameter changes
-            hb.debug('Starting to run allocation iteratively for individual parameter changes. ')
-            for k, spatial_layer_coefficients_2d in p.generation_parameters[generation_id].items():
-                p.call_string = str(k) + '_' + str(generation_id)
-
-                hb.debug('coarse_change_matrix_4d', coarse_change_matrix_4d.shape, coarse_change_matrix_4d.dtype)
-                hb.debug('lulc_baseline_array', lulc_baseline_array.shape, lulc_baseline_array.dtype)
-                hb.debug('spatial_layers_3d', spatial_layers_3d.shape, spatial_layers_3d.dtype)
-                hb.debug('spatial_layer_coefficients_2d', spatial_layer_coefficients_2d.shape, spatial_layer_coefficients_2d.dtype)
-                hb.debug('spatial_layer_function_types_1d', spatial_layer_function_types_1d.shape, spatial_layer_function_types_1d.dtype)
-                hb.debug('valid_mask_array', valid_mask_array.shape, valid_mask_array.dtype)
-                hb.debug('change_class_labels', p.change_class_labels.shape, p.change_class_labels.dtype)
-                hb.debug('observed_lulc_array', observed_lulc_array.shape, observed_lulc_array.dtype)
-                hb.debug('hectares_per_grid_cell', hectares_per_grid_cell.shape, hectares_per_grid_cell.dtype)
-                hb.debug('cur_dir', p.cur_dir)
-                hb.debug('calibration_reporting_level', p.calibration_reporting_level)
-                hb.debug('call_string', p.call_string)
+            if p.use_analytic_ha_per_cell:
+                # The change matrix kernels want a writable array, so the per-row areas are repeated across the columns here.
+                block_geotransform = hb.generate_geotransform_of_chunk_from_cr_size_and_larger_path(p.fine_blocks_list, p.aoi_ha_per_cell_fine_path)
+                hectares_per_grid_cell = np.repeat(seals_utils.calc_ha_per_cell_rows(block_geotransform, n_r)[:, np.newaxis], n_c, axis=1)
+            else:
+                hectares_per_grid_cell = hb.load_geotiff_chunk_by_cr_size(p.aoi_ha_per_cell_fine_path, p.fine_blocks_list).astype(np.float64)
+
+            # The observed side of the loss function is the same for every try in the zone, so it is only blurred once.
+            if calibration_loss_function is None:
+                loss_function_dtype = np.float32 if p.allocation_dtype_mode == 'compact' else np.float64
+                calibration_loss_function = seals_cython_functions.CalibrationLossFunction(lulc_baseline_array, observed_lulc_array, list(p.change_class_labels), p.loss_function_sigma, dtype=loss_function_dtype)
+
+
+            # The default 'sweep' search tries +/- additive_coefficients_modulo on every additive coefficient and then
+            # combines and rescales the improvements. The other optimizers of seals_utils.calibration_optimizers search the
+            # same additive coefficients directly, within calibration_optimizer_max_evaluations calls per generation.
+            if p.calibration_optimizer == 'sweep':
+                # Generate tries by +/- on each of the IxJ adjacency parameters
+                try_id = 1 # Not zero because zero is the generation starting param
+                for spatial_layer_id, spatial_layer_label in enumerate(spatial_layer_names):
+                    for change_class_id, change_class_label in enumerate(p.change_class_labels):
+                        if spatial_layer_types[spatial_layer_id] == 'additive' or spatial_layer_types[spatial_layer_id][0:8] == 'gaussian':
+                            # QUIRK, notice that we copy the generation starting parameters EACH TIME we update a parameter. This is so that we have a fresh, unmodified set for the single thing we change.
+                            # Increment it down
+                            p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
+                            new_coefficient = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] - additive_coefficients_modulo
+                            p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] = new_coefficient
+                            p.generation_parameter_notations[generation_id][try_id] = {'new_coefficient': new_coefficient, 'old_coefficient': new_coefficient + additive_coefficients_modulo, 'spatial_layer_label': spatial_layer_label, 'spatial_layer_id': spatial_layer_id, 'change_class_id': change_class_id, 'change_class_label': change_class_label, 'spatial_layer_type': spatial_layer_types[spatial_layer_id]}
+
+                            try_id += 1
+
+                            # Increment it up
+                            p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
+                            new_coefficient = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] + additive_coefficients_modulo
+                            p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] = new_coefficient
+
+                            p.generation_parameter_notations[generation_id][try_id] = {'new_coefficient': new_coefficient, 'old_coefficient': new_coefficient - additive_coefficients_modulo, 'spatial_layer_label': spatial_layer_label, 'spatial_layer_id': spatial_layer_id, 'change_class_id': change_class_id, 'change_class_label': change_class_label, 'spatial_layer_type': spatial_layer_types[spatial_layer_id]}
+
+                            try_id += 1
+                        elif spatial_layer_types[spatial_layer_id] == 'multiplicative':
+                            pass
+                            # # Increment it down
+                            # p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
+                            # p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] \
+                            #     = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] * multiplicative_coefficients_modulo
+                            # try_id += 1
+                            #
+                            # # Increment it up
+                            # p.generation_parameters[generation_id][try_id] = np.copy(p.generation_parameters[generation_id][0])
+                            # p.generation_parameters[generation_id][try_id][change_class_id, spatial_layer_id] \
+                            #     = p.generation_parameters[generation_id][0][change_class_id, spatial_layer_id] / multiplicative_coefficients_modulo
+
+                benchmark_score = None
+                current_best_score = 1e+100
+
+                try_scores = OrderedDict()
+                try_coefficients = OrderedDict()
+
+                # The candidates of the sweep are independent of each other, so with calibration_candidate_workers > 1 they are
+                # all evaluated up front by a pool of processes that share the read-only inputs. Worker processes of a parallel
+                # iterator can't start processes of their own, so there the sweep stays serial.
+                num_candidate_workers = p.calibration_candidate_workers if p.calibration_candidate_workers is not None else multiprocessing.cpu_count()
+                if num_candidate_workers > 1 and multiprocessing.current_process().daemon:
+                    hb.debug('Evaluating calibration candidates serially because this is already a worker process.')
+                    num_candidate_workers = 1
+                parallel_try_scores = {}
+                # Candidates that are already in the evaluation cache aren't sent to the pool.
+                uncached_candidate_ids = [k for k, spatial_layer_coefficients_2d in p.generation_parameters[generation_id].items() if get_cached_calibration_score(spatial_layer_coefficients_2d, count_hit=False) is None]
+                if num_candidate_workers > 1 and len(uncached_candidate_ids) > 0:
+                    candidates = [(p.generation_parameters[generation_id][k], str(k) + '_' + str(generation_id)) for k in uncached_candidate_ids]
+                    candidate_arrays = OrderedDict([('coarse_change_matrix_4d', coarse_change_matrix_4d), ('lulc_baseline_array', lulc_baseline_array), ('spatial_layers_3d', spatial_layers_3d),
+                                                    ('spatial_layer_function_types_1d', spatial_layer_function_types_1d), ('valid_mask_array', valid_mask_array), ('change_class_labels', p.change_class_labels),
+                                                    ('observed_lulc_array', observed_lulc_array), ('hectares_per_grid_cell', hectares_per_grid_cell)])
+                    candidate_constants = {'output_dir': p.cur_dir, 'loss_function_sigma': p.loss_function_sigma, 'loss_function_dtype': calibration_loss_function.dtype}
+                    hb.log('Evaluating ' + str(len(candidates)) + ' calibration candidates on ' + str(num_candidate_workers) + ' workers.')
+                    candidate_scores = seals_utils.evaluate_calibration_candidates_in_parallel(candidates, candidate_arrays, candidate_constants, min(num_candidate_workers, len(candidates)))
+                    parallel_try_scores = OrderedDict(zip(uncached_candidate_ids, candidate_scores))
+                    calibration_evaluation_counts['calls'] += len(candidates)
+                    for k, weighted_score in parallel_try_scores.items():
+                        cache_calibration_score(p.generation_parameters[generation_id][k], weighted_score)
+
+                # With use_batched_candidate_suitability, the suitabilities of the serially evaluated candidates are computed
+                # ahead, as many at a time as fit in candidate_suitability_memory_budget_gb, with one matrix product each.
+                candidate_ids = list(p.generation_parameters[generation_id].keys())
+                candidate_suitabilities = OrderedDict()
+                if p.use_batched_candidate_suitability:
+                    candidate_suitability_memory_budget_bytes = int(p.candidate_suitability_memory_budget_gb * 1024 ** 3) if p.candidate_suitability_memory_budget_gb is not None else None
+                    candidate_suitability_batch_size = seals_utils.get_candidate_suitability_batch_size(p.generation_parameters[generation_id][0].shape[0], n_r, n_c, candidate_suitability_memory_budget_bytes)
 
                 # Run the model repeatedly, iterating through individual parameter changes
-                overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
-                    calibrate_from_change_matrix(coarse_change_matrix_4d,
-                              lulc_baseline_array,
-                              spatial_layers_3d,
-                              spatial_layer_coefficients_2d,
-                              spatial_layer_function_types_1d,
-                              valid_mask_array,
-                              p.change_class_labels,
-                              observed_lulc_array,
-                              hectares_per_grid_cell,
-                              p.cur_dir,
-                              p.calibration_reporting_level,
-                              p.loss_function_sigma,
-                              p.call_string)
-
-                # Calculate score adjusting for number of predicted chagnes
-
-                # TODOO Review this logic
-                new_array = lulc_baseline_array - lulc_projected_array
-                uniques = hb.enumerate_array_as_odict(new_array)
-                total_change = sum([v for kk, v in uniques.items() if kk != 0])
-                weighted_score = total_change / (overall_similarity_score + 1)
-
-                hb.log('  Sweep found score ' + str(weighted_score) + ' for ' + str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label']) +
-                       ' with coeff ' + str(p.generation_parameter_notations[generation_id][k]['new_coefficient']) + ' on class '
-                       + str(p.generation_parameter_notations[generation_id][k]['change_class_label']) + ' for try ' + str(k) + ' on generation ' + str(generation_id))
-                try_scores[k] = weighted_score
-
-            # Iterate through all score-improving changes from best to worst, seeing if they further improve the score in conjunction.
-            hb.log('Iterating through all scores based on intial sweep value, testing to see if they make improvements in combination.')
-            ranked_tries = OrderedDict(sorted(try_scores.items(), key=lambda x: x[1], reverse=True))
-            best_score = 0
-            starting_spatial_layer_coefficients_2d = copy.deepcopy(p.generation_parameters[generation_id][0])
-            kept_spatial_layer_coefficients_2d = copy.deepcopy(p.generation_parameters[generation_id][0])
-
-            for k, score in ranked_tries.items():
-                changed_spatial_layer_coefficients_2d = p.generation_parameters[generation_id][k]
-                current_spatial_layer_coefficients_2d = np.where(changed_spatial_layer_coefficients_2d != starting_spatial_layer_coefficients_2d,
-                                                                 changed_spatial_layer_coefficients_2d,
-                                                                 kept_spatial_layer_coefficients_2d)
-
-                overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
-                    calibrate_from_change_matrix(coarse_change_matrix_4d,
-                              lulc_baseline_array,
-                              spatial_layers_3d,
-                              current_spatial_layer_coefficients_2d,
-                              spatial_layer_function_types_1d,
-                              valid_mask_array,
-                              p.change_class_labels,
-                              observed_lulc_array,
-                              hectares_per_grid_cell,
-                              p.cur_dir,
-                              p.calibration_reporting_level,
-                              p.loss_function_sigma,
-                              p.call_string)
-
-                new_array = lulc_baseline_array - lulc_projected_array
-                uniques = hb.enumerate_array_as_odict(new_array)
-                total_change = sum([v for k, v in uniques.items() if k != 0])
-                weighted_score = total_change / (overall_similarity_score + 1)
-
-                hb.log('  Score iterate found score ' + str(weighted_score) + ' for ' + str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label']) +
-                       ' with coeff ' + str(p.generation_parameter_notations[generation_id][k]['new_coefficient']) + ' on class '
-                       + str(p.generation_parameter_notations[generation_id][k]['change_class_label']) + ' for try ' + str(k) + ' on generation ' + str(generation_id))
-
-                if weighted_score > best_score:
-                    kept_spatial_layer_coefficients_2d = copy.deepcopy(current_spatial_layer_coefficients_2d)
-
-                    best_score = weighted_score
-
-                    hb.log('    Score improved by adding in ' + str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label']) +
-                       ' with coeff ' + str(p.generation_parameter_notations[generation_id][k]['new_coefficient']) + ' on class '
-                       + str(p.generation_parameter_notations[generation_id][k]['change_class_label']))
-
-                    # while True:
-                    for permutation_coefficient in [0.00001, 0.0001, 0.001, .01, .1, .5, .75, 1.5, 2, 10, 100, 1000, 10000, 100000]:
-                        current_spatial_layer_coefficients_2d = np.where(changed_spatial_layer_coefficients_2d != starting_spatial_layer_coefficients_2d,
-                                                                         changed_spatial_layer_coefficients_2d - additive_coefficients_modulo * permutation_coefficient,
-                                                                         kept_spatial_layer_coefficients_2d)
-
-                        overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
-                            calibrate_from_change_matrix(coarse_change_matrix_4d,
-                                      lulc_baseline_array,
-                                      spatial_layers_3d,
-                                      current_spatial_layer_coefficients_2d,
-                                      spatial_layer_function_types_1d,
-                                      valid_mask_array,
-                                      p.change_class_labels,
-                                      observed_lulc_array,
-                                      hectares_per_grid_cell,
-                                      p.cur_dir,
-                                      p.calibration_reporting_level,
-                                      p.loss_function_sigma,
-                                      p.call_string)
-
-                        new_array = lulc_baseline_array - lulc_projected_array
-                        uniques = hb.enumerate_array_as_odict(new_array)
-                        total_change = sum([v for k, v in uniques.items() if k != 0])
-                        weighted_score_1 = total_change / (overall_similarity_score + 1)
-
-                        if weighted_score_1 > best_score:
-                            kept_spatial_layer_coefficients_2d = copy.deepcopy(current_spatial_layer_coefficients_2d)
-                            best_score = weighted_score_1
-                            hb.log('      Found improvement in permutations by further scaling ' +
-                                   str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label'])
-                                   + ' coefficient by ' + str(permutation_coefficient))
-
-
-                        current_spatial_layer_coefficients_2d = np.where(changed_spatial_layer_coefficients_2d != starting_spatial_layer_coefficients_2d,
-                                                                         changed_spatial_layer_coefficients_2d + additive_coefficients_modulo * permutation_coefficient,
-                                                                         kept_spatial_layer_coefficients_2d)
-
-                        overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
-                            calibrate_from_change_matrix(coarse_change_matrix_4d,
-                                      lulc_baseline_array,
-                                      spatial_layers_3d,
-                                      current_spatial_layer_coefficients_2d,
-                                      spatial_layer_function_types_1d,
-                                      valid_mask_array,
-                                      p.change_class_labels,
-                                      observed_lulc_array,
-                                      hectares_per_grid_cell,
-                                      p.cur_dir,
-                                      p.calibration_reporting_level,
-                                      p.loss_function_sigma,
-                                      p.call_string)
-
-
-                        new_array = lulc_baseline_array - lulc_projected_array
-                        uniques = hb.enumerate_array_as_odict(new_array)
-                        total_change = sum([v for k, v in uniques.items() if k != 0])
-                        weighted_score_2 = total_change / (overall_similarity_score + 1)
-
-                        if weighted_score_2 > best_score:
-                            kept_spatial_layer_coefficients_2d = copy.deepcopy(current_spatial_layer_coefficients_2d)
-                            best_score = weighted_score_2
-                            hb.log('      SECOND PASS Found improvement in permutations by further scaling ' +
-                                   str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label'])
-                                   + ' coefficient by ' + str(permutation_coefficient))
+                hb.debug('Starting to run allocation iteratively for individual parameter changes. ')
+                for k, spatial_layer_coefficients_2d in p.generation_parameters[generation_id].items():
+                    p.call_string = str(k) + '_' + str(generation_id)
+
+                    if k in parallel_try_scores:
+                        weighted_score = parallel_try_scores[k]
+                    else:
+                        weighted_score = get_cached_calibration_score(spatial_layer_coefficients_2d)
+
+                    if weighted_score is None:
+                        class_suitability_3d = None
+                        if p.use_batched_candidate_suitability:
+                            if k not in candidate_suitabilities:
+                                batch_ids = candidate_ids[candidate_ids.index(k): candidate_ids.index(k) + candidate_suitability_batch_size]
+                                hb.debug('Calculating the suitabilities of ' + str(len(batch_ids)) + ' calibration candidates in one batch.')
+                                candidate_suitabilities.clear()
+                                batch_suitabilities = seals_utils.calc_candidate_suitabilities(spatial_layers_3d, np.stack([p.generation_parameters[generation_id][i] for i in batch_ids]), spatial_layer_function_types_1d)
+                                candidate_suitabilities.update(zip(batch_ids, batch_suitabilities))
+                            class_suitability_3d = candidate_suitabilities[k]
+
+                        hb.debug('coarse_change_matrix_4d', coarse_change_matrix_4d.shape, coarse_change_matrix_4d.dtype)
+                        hb.debug('lulc_baseline_array', lulc_baseline_array.shape, lulc_baseline_array.dtype)
+                        hb.debug('spatial_layers_3d', spatial_layers_3d.shape, spatial_layers_3d.dtype)
+                        hb.debug('spatial_layer_coefficients_2d', spatial_layer_coefficients_2d.shape, spatial_layer_coefficients_2d.dtype)
+                        hb.debug('spatial_layer_function_types_1d', spatial_layer_function_types_1d.shape, spatial_layer_function_types_1d.dtype)
+                        hb.debug('valid_mask_array', valid_mask_array.shape, valid_mask_array.dtype)
+                        hb.debug('change_class_labels', p.change_class_labels.shape, p.change_class_labels.dtype)
+                        hb.debug('observed_lulc_array', observed_lulc_array.shape, observed_lulc_array.dtype)
+                        hb.debug('hectares_per_grid_cell', hectares_per_grid_cell.shape, hectares_per_grid_cell.dtype)
+                        hb.debug('cur_dir', p.cur_dir)
+                        hb.debug('calibration_reporting_level', p.calibration_reporting_level)
+                        hb.debug('call_string', p.call_string)
+
+                        # Run the model repeatedly, iterating through individual parameter changes
+                        weighted_score = calibrate_and_score(spatial_layer_coefficients_2d, class_suitability_3d)
+
+                    hb.log('  Sweep found score ' + str(weighted_score) + ' for ' + str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label']) +
+                           ' with coeff ' + str(p.generation_parameter_notations[generation_id][k]['new_coefficient']) + ' on class '
+                           + str(p.generation_parameter_notations[generation_id][k]['change_class_label']) + ' for try ' + str(k) + ' on generation ' + str(generation_id))
+                    try_scores[k] = weighted_score
+
+                candidate_suitabilities.clear()
+
+                # Iterate through all score-improving changes from best to worst, seeing if they further improve the score in conjunction.
+                hb.log('Iterating through all scores based on intial sweep value, testing to see if they make improvements in combination.')
+                ranked_tries = OrderedDict(sorted(try_scores.items(), key=lambda x: x[1], reverse=True))
+                best_score = 0
+                starting_spatial_layer_coefficients_2d = copy.deepcopy(p.generation_parameters[generation_id][0])
+                kept_spatial_layer_coefficients_2d = copy.deepcopy(p.generation_parameters[generation_id][0])
+
+                for k, score in ranked_tries.items():
+                    changed_spatial_layer_coefficients_2d = p.generation_parameters[generation_id][k]
+                    current_spatial_layer_coefficients_2d = np.where(changed_spatial_layer_coefficients_2d != starting_spatial_layer_coefficients_2d,
+                                                                     changed_spatial_layer_coefficients_2d,
+                                                                     kept_spatial_layer_coefficients_2d)
+
+                    weighted_score = calibrate_and_score(current_spatial_layer_coefficients_2d)
+
+                    hb.log('  Score iterate found score ' + str(weighted_score) + ' for ' + str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label']) +
+                           ' with coeff ' + str(p.generation_parameter_notations[generation_id][k]['new_coefficient']) + ' on class '
+                           + str(p.generation_parameter_notations[generation_id][k]['change_class_label']) + ' for try ' + str(k) + ' on generation ' + str(generation_id))
+
+                    if weighted_score > best_score:
+                        kept_spatial_layer_coefficients_2d = copy.deepcopy(current_spatial_layer_coefficients_2d)
+
+                        best_score = weighted_score
+
+                        hb.log('    Score improved by adding in ' + str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label']) +
+                           ' with coeff ' + str(p.generation_parameter_notations[generation_id][k]['new_coefficient']) + ' on class '
+                           + str(p.generation_parameter_notations[generation_id][k]['change_class_label']))
+
+                        # while True:
+                        for permutation_coefficient in [0.00001, 0.0001, 0.001, .01, .1, .5, .75, 1.5, 2, 10, 100, 1000, 10000, 100000]:
+                            current_spatial_layer_coefficients_2d = np.where(changed_spatial_layer_coefficients_2d != starting_spatial_layer_coefficients_2d,
+                                                                             changed_spatial_layer_coefficients_2d - additive_coefficients_modulo * permutation_coefficient,
+                                                                             kept_spatial_layer_coefficients_2d)
+
+                            weighted_score_1 = calibrate_and_score(current_spatial_layer_coefficients_2d)
+
+                            if weighted_score_1 > best_score:
+                                kept_spatial_layer_coefficients_2d = copy.deepcopy(current_spatial_layer_coefficients_2d)
+                                best_score = weighted_score_1
+                                hb.log('      Found improvement in permutations by further scaling ' +
+                                       str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label'])
+                                       + ' coefficient by ' + str(permutation_coefficient))
+
+
+                            current_spatial_layer_coefficients_2d = np.where(changed_spatial_layer_coefficients_2d != starting_spatial_layer_coefficients_2d,
+                                                                             changed_spatial_layer_coefficients_2d + additive_coefficients_modulo * permutation_coefficient,
+                                                                             kept_spatial_layer_coefficients_2d)
+
+                            weighted_score_2 = calibrate_and_score(current_spatial_layer_coefficients_2d)
+
+                            if weighted_score_2 > best_score:
+                                kept_spatial_layer_coefficients_2d = copy.deepcopy(current_spatial_layer_coefficients_2d)
+                                best_score = weighted_score_2
+                                hb.log('      SECOND PASS Found improvement in permutations by further scaling ' +
+                                       str(p.generation_parameter_notations[generation_id][k]['spatial_layer_label'])
+                                       + ' coefficient by ' + str(permutation_coefficient))
 
+            else:
+                free_coefficients = np.zeros(p.generation_parameters[generation_id][0].shape, dtype=bool)
+                free_coefficients[:, spatial_layer_function_types_1d == 2] = True
+                starting_spatial_layer_coefficients_2d = copy.deepcopy(p.generation_parameters[generation_id][0])
+
+                def calibration_objective(x):
+                    current_spatial_layer_coefficients_2d = np.copy(starting_spatial_layer_coefficients_2d)
+                    current_spatial_layer_coefficients_2d[free_coefficients] = x
+                    return -calibrate_and_score(current_spatial_layer_coefficients_2d)
+
+                hb.log('Searching ' + str(np.sum(free_coefficients)) + ' coefficients with the ' + p.calibration_optimizer + ' optimizer for generation ' + str(generation_id))
+                p.call_string = p.calibration_optimizer + '_' + str(generation_id)
+                best_x, best_value, n_optimizer_evaluations = seals_utils.minimize_calibration_objective(calibration_objective, starting_spatial_layer_coefficients_2d[free_coefficients], p.calibration_optimizer,
+                                                                                                        additive_coefficients_modulo, p.calibration_optimizer_max_evaluations, p.calibration_optimizer_tolerance)
+                kept_spatial_layer_coefficients_2d = np.copy(starting_spatial_layer_coefficients_2d)
+                kept_spatial_layer_coefficients_2d[free_coefficients] = best_x
+                hb.log('  ' + p.calibration_optimizer + ' found score ' + str(-best_value) + ' after ' + str(n_optimizer_evaluations) + ' evaluations on generation ' + str(generation_id))
 
             # After finding best parameters, need to run 1 last time at the end of the generation to save the right layer.
             overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
@@ -1336,8 +1428,18 @@ def calibration_zones(passed_p=None):
                           p.cur_dir,
                           p.calibration_reporting_level,
                           p.loss_function_sigma,
-                          p.call_string)
-
+                          p.call_string,
+                          loss_function=calibration_loss_function)
+            calibration_evaluation_counts['calls'] += 1
+
+            generation_score = seals_utils.calc_calibration_weighted_score(lulc_baseline_array, lulc_projected_array, overall_similarity_score)
+            cache_calibration_score(kept_spatial_layer_coefficients_2d, generation_score)
+            n_calibration_lookups = calibration_evaluation_counts['calls'] + calibration_evaluation_counts['cache_hits']
+            cache_hit_rate = calibration_evaluation_counts['cache_hits'] / n_calibration_lookups if n_calibration_lookups > 0 else 0.0
+            hb.log('Generation ' + str(generation_id) + ' reached score ' + str(generation_score) + ' with ' + str(calibration_evaluation_counts['calls']) + ' calibrate_from_change_matrix calls using the ' + p.calibration_optimizer + ' optimizer'
+                   + ' and ' + str(calibration_evaluation_counts['cache_hits']) + ' evaluation cache hits (hit rate ' + str(round(cache_hit_rate, 3)) + ').')
+            calibration_evaluations_rows.append({'generation_id': generation_id, 'optimizer': p.calibration_optimizer, 'n_evaluations': calibration_evaluation_counts['calls'],
+                                                 'n_cache_hits': calibration_evaluation_counts['cache_hits'], 'cache_hit_rate': cache_hit_rate, 'score': generation_score})
 
             if p.write_calibration_generation_arrays:
                 p.lulc_projected_gen_path = os.path.join(p.cur_dir, 'lulc_projected_array_gen' + str(generation_id) + '.tif')
@@ -1362,6 +1464,7 @@ def calibration_zones(passed_p=None):
 
         # Write final coefficients
         output_df_2.to_csv(final_coefficients_path, index=False)
+        pd.DataFrame(calibration_evaluations_rows).to_csv(os.path.join(p.cur_dir, 'calibration_evaluations_zone_' + os.path.split(os.path.split(p.cur_dir)[0])[1] + '.csv'), index=False)
 
         # Write final lulc
         p.lulc_projected_path = os.path.join(p.cur_dir, 'lulc_projected.tif')
@@ -1413,6 +1516,7 @@ def allocations(p):
         p.iterator_replacements['model_label'] = []
         p.iterator_replacements['counterfactual_label'] = []
         p.iterator_replacements['year'] = []
+        p.iterator_replacements['years'] = []
         p.iterator_replacements['key_base_year'] = []
         p.iterator_replacements['previous_year'] = []
         p.iterator_replacements['calibration_parameters_source'] = []
@@ -1435,6 +1539,11 @@ def allocations(p):
 
 
                 for c, year in enumerate(p.years):
+
+                    # In tile_major mode each block walks all the years itself, so only the first year is iterated here.
+                    if p.allocation_execution_mode == 'tile_major' and c > 0:
+                        continue
+
                     if hasattr(p, 'regional_projections_input_path'):
                         
                         p.regional_projections_input_path = hb.replace_cat_ears_with_dict(p.regional_projections_input_path, {'year':year})
@@ -1487,6 +1596,7 @@ def allocations(p):
                     p.iterator_replacements['model_label'].append(p.model_label)
                     p.iterator_replacements['counterfactual_label'].append(p.counterfactual_label)
                     p.iterator_replacements['year'].append(year)
+                    p.iterator_replacements['years'].append(p.years)
                     if c == 0:
                         p.iterator_replacements['previous_year'].append(p.key_base_year)
                     else:
@@ -1655,48 +1765,50 @@ def allocation_zones(p):
             global_coarse_blocks_list = []
             global_processing_blocks_list = []
 
-            L.debug('Checking existing blocks for change in the LUH data and excluding if no change.')
-            for c, block in enumerate(old_coarse_blocks_list):
-                progress_percent = float(c) / float(len(old_coarse_blocks_list)) * 100.0
-                skip = []
+            # In tile_major mode a block is run for all years at once, so it is kept if any year has change.
+            if p.allocation_execution_mode == 'tile_major':
+                years_to_check = seals_utils.get_tile_major_years_and_previous_years(p)
+            else:
+                years_to_check = [(p.year, p.previous_year)]
 
-                current_coarse_change_rasters = []
+            coarse_change_paths_by_year_and_class = OrderedDict()
+            for year, previous_year in years_to_check:
                 for class_label in p.changing_class_labels:
+                    filename = class_label + '_' + str(year) + '_' + str(previous_year) + '_ha_diff_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '.tif'
 
-
-                    filename = class_label + '_' + str(p.year) + '_' + str(p.previous_year) + '_ha_diff_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '.tif'
-                    
-                    
                     # p.aggregation_method_string = 'covariate_multiply_regional_change_sum'
                     filename = hb.suri(filename, p.aggregation_method_string)
-                    
-                    gen_path = os.path.join(p.projected_coarse_change_dir, filename)
-                    current_coarse_change_rasters.append(gen_path)
-
-
-                for path in current_coarse_change_rasters:
-                    # for path in hb.list_filtered_paths_nonrecursively(p.projected_coarse_change_dir, include_extensions='.tif'):
-                    block = old_coarse_blocks_list[c]
-                    a = hb.load_geotiff_chunk_by_cr_size(path, block)
-                    changed = np.where((a != 0) & (a != -9999.) & (~np.isnan(a)), 1, 0)
-                    # hb.show(a)
-                    # 'C:\\Users\\jajohns\\Files\\Research\\cge\\seals\\projects\\test_seals_magpie\\intermediate\\magpie_as_simplified_proportion\\rcp45_ssp2\\2050\\SSP2_BiodivPol_ClimPol_NCPpol_LPJmL5\\urban_2050_2015_ha_difference.tif'
-
-                    # hb.show(changed)
-                    hb.debug('Checking to see if there is change in ', path)
-                    if np.nansum(changed) == 0:
-                        hb.debug('Skipping because no change in coarse projections:', path)
-                        skip.append(True)
-                    else:
-                        skip.append(False)
-
-                if not all(skip):
-                    fine_blocks_list.append(old_fine_blocks_list[c])
-                    coarse_blocks_list.append(old_coarse_blocks_list[c])
-                    processing_blocks_list.append(old_processing_blocks_list[c])
-                    global_fine_blocks_list.append(old_global_fine_blocks_list[c])
-                    global_coarse_blocks_list.append(old_global_coarse_blocks_list[c])
-                    global_processing_blocks_list.append(old_global_processing_blocks_list[c])
+                    coarse_change_paths_by_year_and_class[(year, class_label)] = os.path.join(os.path.split(p.projected_coarse_change_dir)[0], str(year), filename)
+
+            # Which blocks have change comes from a block activity index, built with one read per coarse change raster rather
+            # than one per raster per block, and kept next to the block lists until any of those rasters or blocks change.
+            block_activity_index_path = os.path.join(p.cur_dir, 'block_activity_index.csv')
+            block_activity_index_key = seals_utils.get_block_activity_index_key(list(coarse_change_paths_by_year_and_class.values()), old_coarse_blocks_list)
+            block_activity_df = None
+            if hb.path_exists(block_activity_index_path):
+                block_activity_df = pd.read_csv(block_activity_index_path)
+                if not (len(block_activity_df) > 0 and (block_activity_df['inputs_key'] == block_activity_index_key).all()):
+                    hb.log('Rebuilding ' + block_activity_index_path + ' because its inputs changed.')
+                    block_activity_df = None
+            if block_activity_df is None:
+                L.debug('Building the block activity index to exclude blocks without change in the coarse projections.')
+                block_activity_df = seals_utils.calc_block_activity_index(coarse_change_paths_by_year_and_class, old_coarse_blocks_list, old_global_processing_blocks_list)
+                block_activity_df['inputs_key'] = block_activity_index_key
+                block_activity_df.to_csv(block_activity_index_path, index=False)
+            p.block_activity_df = block_activity_df
+
+            # Keep the blocks with any change, starting the ones with the most change first so that a parallel run doesn't
+            # finish with a few large blocks running alone.
+            block_activity = block_activity_df.groupby('block_index')[['n_changed_cells', 'abs_change_ha']].sum()
+            block_activity = block_activity[block_activity['n_changed_cells'] > 0].sort_values('abs_change_ha', ascending=False, kind='stable')
+            for c in block_activity.index.values:
+                fine_blocks_list.append(old_fine_blocks_list[c])
+                coarse_blocks_list.append(old_coarse_blocks_list[c])
+                processing_blocks_list.append(old_processing_blocks_list[c])
+                global_fine_blocks_list.append(old_global_fine_blocks_list[c])
+                global_coarse_blocks_list.append(old_global_coarse_blocks_list[c])
+                global_processing_blocks_list.append(old_global_processing_blocks_list[c])
+            hb.log('Block activity index: ' + str(len(block_activity)) + ' of ' + str(len(old_coarse_blocks_list)) + ' blocks have change, totalling ' + str(block_activity['abs_change_ha'].sum()) + ' ha of absolute change.')
 
             # WORKS but disabled for troubleshooting
             # Write the blockslists to csvs to avoid future reprocessing (actually is quite slow (2 mins) when 64000 tiles).
@@ -1722,10 +1834,29 @@ def allocation_zones(p):
         global_coarse_blocks_list = []
         global_processing_blocks_list = []
 
+        # A tile_major block is only finished once its last year is.
+        if p.allocation_execution_mode == 'tile_major':
+            last_year = p.years[-1]
+        else:
+            last_year = p.year
+
+        # Finished blocks are read from the completion ledger of each year, which the allocation task appends to once a
+        # block's outputs are fully written, leaving out blocks whose outputs have changed since (by size and mtime, and
+        # by sha1 with verify_completion_ledger_checksums). Years without a ledger (from runs before it existed) fall back
+        # to checking for the output files. The allocation tasks use the same sets to skip finished years.
+        p.completed_allocation_blocks = {}
+        for year in p.years if p.allocation_execution_mode == 'tile_major' else [p.year]:
+            completion_ledger = seals_utils.read_completion_ledger(seals_utils.get_completion_ledger_path(seals_utils.replace_year_dir(p.cur_dir, p.year, year)), p.verify_completion_ledger_checksums)
+            p.completed_allocation_blocks[year] = set(completion_ledger.keys()) if completion_ledger is not None else None
+
         for c, fine_block in enumerate(old_global_processing_blocks_list):
             tile_dir = str(fine_block[0]) + '_' + str(fine_block[1])
-            expected_path = os.path.join(p.cur_dir, tile_dir, 'allocation', 'lulc_' + p.lulc_src_label + '_' + p.lulc_simplification_label + '_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '_' + str(p.year) + '.tif')
-            if not hb.path_exists(expected_path):
+            if p.completed_allocation_blocks[last_year] is not None:
+                finished = tile_dir in p.completed_allocation_blocks[last_year]
+            else:
+                expected_path = os.path.join(seals_utils.replace_year_dir(p.cur_dir, p.year, last_year), tile_dir, 'allocation', 'lulc_' + p.lulc_src_label + '_' + p.lulc_simplification_label + '_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '_' + str(last_year) + '.tif')
+                finished = hb.path_exists(expected_path)
+            if not finished:
                 fine_blocks_list.append(old_fine_blocks_list[c])
                 coarse_blocks_list.append(old_coarse_blocks_list[c])
                 processing_blocks_list.append(old_processing_blocks_list[c])
@@ -1794,6 +1925,30 @@ def allocation_zones(p):
 
             hb.log('Finished reading ' + calibration_parameters_path)
 
+        # With use_shared_coarse_inputs, the coarse change rasters this iteration allocates and the coarse ha per cell are
+        # read whole once into shared memory, and each block takes its cells from there instead of opening every raster.
+        # The previous iteration's blocks are done by now, so its shared memory can go.
+        seals_utils.release_shared_coarse_inputs()
+        p.shared_coarse_inputs = None
+        if p.use_shared_coarse_inputs and len(fine_blocks_list) > 0:
+            if p.allocation_execution_mode == 'tile_major':
+                years_to_share = seals_utils.get_tile_major_years_and_previous_years(p)
+            else:
+                years_to_share = [(p.year, p.previous_year)]
+            shared_coarse_input_paths = [p.aoi_ha_per_cell_coarse_path]
+            for year, previous_year in years_to_share:
+                filename_end = '_' + str(year) + '_' + str(previous_year) + '_ha_diff_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '.tif'
+                shared_coarse_input_paths += [os.path.join(os.path.split(p.projected_coarse_change_dir)[0], str(year), i + filename_end) for i in p.changing_class_labels]
+            shared_coarse_input_paths = [i for i in shared_coarse_input_paths if hb.path_exists(i)]
+            p.shared_coarse_inputs = seals_utils.create_shared_coarse_inputs(shared_coarse_input_paths)
+            hb.log('Shared ' + str(len(shared_coarse_input_paths)) + ' coarse inputs with the allocation workers.')
+
+        # With use_live_mosaic, each block writes its lulc into the scenario and year's live mosaic as soon as it finishes.
+        if p.use_live_mosaic:
+            p.live_mosaic_base_path = seals_utils.get_live_mosaic_base_path(p)
+        else:
+            p.live_mosaic_base_path = None
+
         p.iterator_replacements = collections.OrderedDict()
         p.iterator_replacements['fine_blocks_list'] = fine_blocks_list
         p.iterator_replacements['coarse_blocks_list'] = coarse_blocks_list
@@ -1824,6 +1979,58 @@ def allocation(passed_p=None):
     else:
         p = passed_p
 
+    if p.run_this and p.allocation_execution_mode == 'tile_major':
+        allocation_tile_major(p)
+    elif p.allocation_execution_mode in ['year_major', 'tile_major']:
+        allocation_year(p)
+    else:
+        raise NameError('allocation_execution_mode must be one of year_major or tile_major, got ' + str(p.allocation_execution_mode))
+
+
+def allocation_tile_major(p):
+    """Allocate every year of the current scenario on this block in order. The lulc, cumulative change and loaded inputs
+    of each year are handed to the next one in p.tile_state instead of being found again on disk, and the per-year
+    outputs are written by a background thread while the next year is allocated. Outputs go to the same per-year
+    tile dirs as in year_major mode."""
+    first_year = p.year
+    first_previous_year = p.previous_year
+    first_cur_dir = p.cur_dir
+    first_projected_coarse_change_dir = p.projected_coarse_change_dir
+
+    p.tile_state = {'writer': concurrent.futures.ThreadPoolExecutor(max_workers=1), 'write_futures': []}
+    try:
+        for year, previous_year in seals_utils.get_tile_major_years_and_previous_years(p):
+            p.year = year
+            p.previous_year = previous_year
+            p.cur_dir = seals_utils.replace_year_dir(first_cur_dir, first_year, year)
+            p.projected_coarse_change_dir = os.path.join(os.path.split(first_projected_coarse_change_dir)[0], str(year))
+            hb.create_directories(p.cur_dir)
+
+            allocation_year(p)
+
+        # Raise any error from the background writes here rather than lose it.
+        for future in p.tile_state['write_futures']:
+            future.result()
+    finally:
+        p.tile_state['writer'].shutdown(wait=True)
+        p.tile_state = None
+        p.year = first_year
+        p.previous_year = first_previous_year
+        p.cur_dir = first_cur_dir
+        p.projected_coarse_change_dir = first_projected_coarse_change_dir
+
+
+def allocation_year(passed_p=None):
+    # Allocate a single year on the current block.
+
+    if passed_p is None:
+        global p
+    else:
+        p = passed_p
+
+    # Only set while allocation_tile_major is walking the years of this block.
+    tile_state = getattr(p, 'tile_state', None)
+
     start = time.time()
     if p.run_this:
         # Set where CHUNK-specific maps will be saved.
@@ -1971,18 +2178,30 @@ def allocation(passed_p=None):
 
         lulc_projected_path = os.path.join(p.cur_dir, 'lulc_' + p.lulc_src_label + '_'  + p.lulc_simplification_label + '_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '_' + str(p.year) + '.tif')
 
-        if p.skip_created_downscaling_zones:
+        completed_allocation_blocks = getattr(p, 'completed_allocation_blocks', {}).get(p.year)
+        if p.skip_created_downscaling_zones and completed_allocation_blocks is not None:
+            skip_this_zone = zone_string in completed_allocation_blocks
+        elif p.skip_created_downscaling_zones:
             skip_this_zone = os.path.exists(lulc_projected_path)
         else:
             skip_this_zone = False
 
+        # A year finished by an earlier run breaks the in-memory chain, so the next year reads its starting lulc from disk.
+        if skip_this_zone and tile_state is not None:
+            tile_state.pop('lulc_array', None)
+            tile_state.pop('cumulative_change_happened_array', None)
+
         if p.run_this and not skip_this_zone:
 
             # Tricky logic here: I implemented an optimization that skips doing zones that have no change. But this means
             # that the previous year lulc will not always be there. The logic below finds the most recent LULC map that
             # exists, reverting to the key_base_year if needed.
             previous_year_dir = p.cur_dir.replace('\\', '/').replace('/' + str(p.year) + '/', '/' + str(p.previous_year) + '/')
-            if p.previous_year in p.lulc_simplified_paths: # Then it is the base year
+            if tile_state is not None and 'lulc_array' in tile_state:
+                # In tile_major mode the previous year of this block was just allocated in this process, so start from it.
+                lulc_baseline_array = tile_state['lulc_array']
+                tile_match_path = tile_state['tile_match_path']
+            elif p.previous_year in p.lulc_simplified_paths: # Then it is the base year
 
                 # On the first year, we need to clip from the AOI-wide LULC to the current processing tile.
                 aoi_previous_year_path = p.lulc_simplified_paths[p.previous_year]
@@ -2097,83 +2316,161 @@ def allocation(passed_p=None):
             # This has to be written to a file so that it can define the aoi of the coarse grid. I could optimize this as
             # it creates n-zones number of bloat files. Don't need fine file because that georeference we can
             # get from the baseline lulc.
-            hectares_per_grid_coarse_cell = hb.load_geotiff_chunk_by_cr_size(p.aoi_ha_per_cell_coarse_path, p.coarse_blocks_list, output_path=block_ha_per_cell_coarse_path).astype(np.float64)
+            if getattr(p, 'shared_coarse_inputs', None) is not None and p.output_writing_level < 5:
+                # Only the validation outputs use block_ha_per_cell_coarse_path, so without them there's no need to write it.
+                hectares_per_grid_coarse_cell = seals_utils.load_coarse_block(p, p.aoi_ha_per_cell_coarse_path, p.coarse_blocks_list)
+            else:
+                hectares_per_grid_coarse_cell = hb.load_geotiff_chunk_by_cr_size(p.aoi_ha_per_cell_coarse_path, p.coarse_blocks_list, output_path=block_ha_per_cell_coarse_path).astype(np.float64)
 
-            if p.output_writing_level > 0:
+            if p.use_analytic_ha_per_cell:
+                # Cell area only depends on the row, so it is computed from the block's geotransform instead of read.
+                block_geotransform = hb.generate_geotransform_of_chunk_from_cr_size_and_larger_path(p.fine_blocks_list, p.aoi_ha_per_cell_fine_path)
+                hectares_per_grid_cell = np.broadcast_to(seals_utils.calc_ha_per_cell_rows(block_geotransform, n_r)[:, np.newaxis], (n_r, n_c))
+            elif p.output_writing_level > 0:
                 hectares_per_grid_cell = hb.load_geotiff_chunk_by_cr_size(p.aoi_ha_per_cell_fine_path, p.fine_blocks_list, output_path=block_ha_per_cell_fine_path).astype(np.float64)
+            elif tile_state is not None and 'hectares_per_grid_cell' in tile_state:
+                hectares_per_grid_cell = tile_state['hectares_per_grid_cell']
             else:
                 hectares_per_grid_cell = hb.load_geotiff_chunk_by_cr_size(p.aoi_ha_per_cell_fine_path, p.fine_blocks_list).astype(np.float64)
+            if tile_state is not None:
+                tile_state['hectares_per_grid_cell'] = hectares_per_grid_cell
 
             # IMPORTANT NOTE CAVEAT: Although the final allocation does properly start from the 2015 lulc, the underlying ranking is still based on the 2000 class binaries.
             # Figure out a way to make the spatial_layers_3d smartly update the "new state" variables in a way that is forward looking for year-by-year iteration
 
+            # Note questionable choice here that the actual calibration parameters must be the last n-classes of columns
+            p.seals_class_names = spatial_regressors_df.columns.values[-len(changing_class_indices_array):]
+            spatial_regressor_trained_coefficients = spatial_regressors_df[p.seals_class_names].values.astype(np.float64).T
+            generation_best_parameters = np.copy(spatial_regressor_trained_coefficients)
+
             # Build the numpy array for spatial layers.
-            spatial_layers_3d = np.zeros((len(spatial_layer_paths), n_r, n_c)).astype(np.float64)
+            if p.allocation_dtype_mode == 'compact':
+                spatial_layers_dtype = np.float32
+            elif p.allocation_dtype_mode == 'float64':
+                spatial_layers_dtype = np.float64
+            else:
+                raise NameError('allocation_dtype_mode must be one of float64 or compact, got ' + str(p.allocation_dtype_mode))
+
+            # The per-class suitability only depends on the coefficients and the regressors, so with use_suitability_cache it
+            # is stored per block the first time it is needed and every other scenario and year reads n_classes layers
+            # instead of every regressor. The kernel then takes it as additive layers with an identity coefficient table,
+            # which allocates exactly as the full stack would, and still applies the per-year masks itself.
+            possible_dirs = [p.intermediate_dir, p.fine_processed_inputs_dir, p.input_dir, p.base_data_dir]
+            resolved_spatial_layer_paths = [p.get_path(path, possible_dirs=possible_dirs) for path in spatial_layer_paths]
+            if p.use_suitability_cache or tile_state is not None:
+                suitability_cache_key = seals_utils.get_suitability_cache_key(generation_best_parameters, spatial_layer_function_types_1d, resolved_spatial_layer_paths, p.fine_blocks_list, spatial_layers_dtype)
+            if p.use_suitability_cache:
+                suitability_cache_path = os.path.join(p.intermediate_dir, 'suitability_cache', 'suitability_' + zone_string + '_' + suitability_cache_key + '.npy')
+            else:
+                suitability_cache_path = None
+
+            if tile_state is not None and tile_state.get('suitability_cache_key') == suitability_cache_key:
+                # In tile_major mode an earlier year of this block already loaded the same layers.
+                spatial_layers_3d = tile_state['spatial_layers_3d']
+            elif suitability_cache_path is not None and hb.path_exists(suitability_cache_path):
+                hb.debug('Loading cached suitability from ' + suitability_cache_path)
+                spatial_layers_3d = np.load(suitability_cache_path)
+            else:
+                spatial_layers_3d = np.zeros((len(spatial_layer_paths), n_r, n_c), dtype=spatial_layers_dtype)
 
-            # Chose not to normalize anything.
-            normalize_inputs = False
-            # Add either the normalized or not normalized array to the spatial_layers_3d
-            for c, path in enumerate(spatial_layer_paths):
-                hb.debug('Loading spatial layer at path ' + path)
+                # Chose not to normalize anything.
+                normalize_inputs = False
 
-                # path = hb.get_first_extant_path(path, [p.fine_processed_inputs_dir, p.input_dir, p.base_data_dir])
-                # if 'binary_esa_seals7_2015_urban' in path:
-                #     pass
+                # With use_regressor_bundles the stacked regressors of this block are read from one bundle file, written
+                # the first time the block is loaded, instead of one windowed read per regressor.
+                if p.use_regressor_bundles:
+                    regressor_bundle_path = seals_utils.get_regressor_bundle_path(os.path.join(p.intermediate_dir, 'regressor_bundles'), resolved_spatial_layer_paths, p.fine_blocks_list, p.global_fine_blocks_list, spatial_layers_dtype, normalize_inputs)
+                else:
+                    regressor_bundle_path = None
+                if regressor_bundle_path is not None and hb.path_exists(regressor_bundle_path):
+                    hb.debug('Loading regressor bundle ' + regressor_bundle_path)
+                    spatial_layers_3d = seals_utils.load_regressor_bundle(regressor_bundle_path, spatial_layer_names)
+                else:
+                    # Add either the normalized or not normalized array to the spatial_layers_3d
+                    for c, path in enumerate(spatial_layer_paths):
+                        hb.debug('Loading spatial layer at path ' + path)
+
+                        # path = hb.get_first_extant_path(path, [p.fine_processed_inputs_dir, p.input_dir, p.base_data_dir])
+                        # if 'binary_esa_seals7_2015_urban' in path:
+                        #     pass
+
+                        # if 'soil_organic_content' in path:
+                        #     pass
+
+                        # PROBLEM Sometimes it NEEDS to look in fine_processed_inputs_dir, but other times it needs to download it no matter what. how deal with this?
+                        # Am I possibly using get_path to deal with THREE types of data
+                        # 1. Data that needs to be created
+                        # 2. Data that needs t be put in base_data_dir
+                        # I confused....
+                        path = resolved_spatial_layer_paths[c]
+                        current_bb = hb.get_bounding_box(path)
+
+                        if current_bb == hb.global_bounding_box:
+                            correct_fine_block_list = p.global_fine_blocks_list
+                            correct_coarse_block_list = p.global_coarse_blocks_list
+                        else:
+                            correct_fine_block_list = p.fine_blocks_list
+                            correct_coarse_block_list = p.coarse_blocks_list
 
-                # if 'soil_organic_content' in path:
-                #     pass
+                        add_randomness = 0 # DECIDED NOT TO DO THIS. Don't try it again. I'm warning you! Increment the following comment up 1 for each unsuccessful attempt at doing this: 3
+                        if spatial_layer_types[c] == 'additive' or spatial_layer_types[c] == 'multiplicative':
+                            if normalize_inputs is True:
+                                spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
+                            else:
 
-                # PROBLEM Sometimes it NEEDS to look in fine_processed_inputs_dir, but other times it needs to download it no matter what. how deal with this?
-                # Am I possibly using get_path to deal with THREE types of data
-                # 1. Data that needs to be created
-                # 2. Data that needs t be put in base_data_dir
-                # I confused....
-                possible_dirs = [p.intermediate_dir, p.fine_processed_inputs_dir, p.input_dir, p.base_data_dir]
-                path = p.get_path(path, possible_dirs=possible_dirs)
-                current_bb = hb.get_bounding_box(path)
+                                if add_randomness:
+                                    a = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
+                                    a = a * (1 - (np.random.random(a.shape)/100))
+                                    spatial_layers_3d[c] = a
+                                else:
+                                    spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
 
-                if current_bb == hb.global_bounding_box:
-                    correct_fine_block_list = p.global_fine_blocks_list
-                    correct_coarse_block_list = p.global_coarse_blocks_list
-                else:
-                    correct_fine_block_list = p.fine_blocks_list
-                    correct_coarse_block_list = p.coarse_blocks_list
+                        # NOTE: Currently gaussian is not used as it is just considered additive
+                        elif spatial_layer_types[c][0:8] == 'gaussian':
+                            # updated_path = os.path.join(p.cur_dir, 'class_' + spatial_layer_names[c].split('_')[1] + '_gaussian_' + spatial_layer_names[c].split('_')[3] + '_convolution.tif')
 
-                add_randomness = 0 # DECIDED NOT TO DO THIS. Don't try it again. I'm warning you! Increment the following comment up 1 for each unsuccessful attempt at doing this: 3
-                if spatial_layer_types[c] == 'additive' or spatial_layer_types[c] == 'multiplicative':
-                    if normalize_inputs is True:
-                        spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
-                    else:
+                            if normalize_inputs is True:
+                                spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
+                                # spatial_layers_3d[c] = hb.normalize_array(hb.as_array(updated_path))
+                            else:
+                                if add_randomness:
+                                    a = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
+                                    a = a * (1 - (np.random.random(a.shape)/100))
+                                    spatial_layers_3d[c] = a
+                                else:
+                                    spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
 
-                        if add_randomness:
-                            a = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
-                            a = a * (1 - (np.random.random(a.shape)/100))
-                            spatial_layers_3d[c] = a
                         else:
-                            spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
+                            raise NameError('unspecified type')
 
-                # NOTE: Currently gaussian is not used as it is just considered additive
-                elif spatial_layer_types[c][0:8] == 'gaussian':
-                    # updated_path = os.path.join(p.cur_dir, 'class_' + spatial_layer_names[c].split('_')[1] + '_gaussian_' + spatial_layer_names[c].split('_')[3] + '_convolution.tif')
+                    if regressor_bundle_path is not None:
+                        seals_utils.write_regressor_bundle(regressor_bundle_path, spatial_layers_3d, spatial_layer_names, resolved_spatial_layer_paths)
 
-                    if normalize_inputs is True:
-                        spatial_layers_3d[c] = hb.normalize_array(hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list))
-                        # spatial_layers_3d[c] = hb.normalize_array(hb.as_array(updated_path))
-                    else:
-                        if add_randomness:
-                            a = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
-                            a = a * (1 - (np.random.random(a.shape)/100))
-                            spatial_layers_3d[c] = a
-                        else:
-                            spatial_layers_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, correct_fine_block_list)
+                if suitability_cache_path is not None:
+                    spatial_layers_3d = seals_cython_functions.calc_class_suitability_3d(spatial_layers_3d, generation_best_parameters, spatial_layer_function_types_1d, num_threads=p.allocation_num_threads)
 
-                else:
-                    raise NameError('unspecified type')
+                    # Other scenarios may be writing the same block, so write to a temporary file and move it into place.
+                    hb.create_directories(os.path.dirname(suitability_cache_path))
+                    suitability_cache_temp_path = suitability_cache_path.replace('.npy', '_' + str(os.getpid()) + '.npy')
+                    np.save(suitability_cache_temp_path, spatial_layers_3d)
+                    os.replace(suitability_cache_temp_path, suitability_cache_path)
+
+            if tile_state is not None:
+                tile_state['suitability_cache_key'] = suitability_cache_key
+                tile_state['spatial_layers_3d'] = spatial_layers_3d
 
-            if p.base_data_dir in p.lulc_simplified_paths[p.key_base_year]:
+            if suitability_cache_path is not None:
+                generation_best_parameters = np.eye(len(changing_class_indices_array), dtype=np.float64)
+                spatial_layer_function_types_1d = np.full(len(changing_class_indices_array), 2, dtype=np.int64)
+
+            if tile_state is not None and 'observed_lulc_array' in tile_state:
+                observed_lulc_array = tile_state['observed_lulc_array']
+            elif p.base_data_dir in p.lulc_simplified_paths[p.key_base_year]:
                 observed_lulc_array = hb.load_geotiff_chunk_by_cr_size(p.lulc_simplified_paths[p.key_base_year], p.global_fine_blocks_list, output_path=None).astype(np.int64)
             else:
                 observed_lulc_array = hb.load_geotiff_chunk_by_cr_size(p.lulc_simplified_paths[p.key_base_year], p.fine_blocks_list, output_path=None).astype(np.int64)
+            if tile_state is not None:
+                tile_state['observed_lulc_array'] = observed_lulc_array
 
 
             valid_mask_array = np.where((observed_lulc_array != p.lulc_ndv), 1, 0).astype(np.int64)
@@ -2212,12 +2509,18 @@ def allocation(passed_p=None):
                         # altered_path =
                         projected_coarse_change_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, p.coarse_blocks_list, output_path=current_output_path).astype(np.float64)
                     else:
-                        projected_coarse_change_3d[c] = hb.load_geotiff_chunk_by_cr_size(path, p.coarse_blocks_list).astype(np.float64)
+                        projected_coarse_change_3d[c] = seals_utils.load_coarse_block(p, path, p.coarse_blocks_list)
 
-            # Note questionable choice here that the actual calibration parameters must be the last n-classes of columns
-            p.seals_class_names = spatial_regressors_df.columns.values[-len(changing_class_indices_array):]
-            spatial_regressor_trained_coefficients = spatial_regressors_df[p.seals_class_names].values.astype(np.float64).T
-            generation_best_parameters = np.copy(spatial_regressor_trained_coefficients)
+            # Sparse index of the (coarse_r, coarse_c, class) entries that actually have change. The allocation kernel only
+            # visits these coarse cells, and it is reported so that it's clear how sparse each tile is.
+            active_coarse_cells = seals_cython_functions.build_active_coarse_cell_index(projected_coarse_change_3d)
+            n_active_coarse_cells = len(np.unique(active_coarse_cells[:, :2], axis=0))
+            hb.log('Tile ' + zone_string + ' has change in ' + str(n_active_coarse_cells) + ' of ' + str(coarse_n_r * coarse_n_c) + ' coarse cells (' + str(len(active_coarse_cells)) + ' cell-class entries).')
+            if p.output_writing_level >= 1:
+                active_coarse_cells_df = pd.DataFrame(active_coarse_cells, columns=['coarse_r', 'coarse_c', 'class_position'])
+                active_coarse_cells_df['class_label'] = [p.changing_class_labels[i] for i in active_coarse_cells[:, 2]]
+                active_coarse_cells_df['ha_change'] = projected_coarse_change_3d[active_coarse_cells[:, 2], active_coarse_cells[:, 0], active_coarse_cells[:, 1]]
+                active_coarse_cells_df.to_csv(os.path.join(p.cur_dir, 'active_coarse_cells.csv'), index=False)
 
             p.call_string = ''
 
@@ -2237,43 +2540,97 @@ def allocation(passed_p=None):
             hb.debug('p.call_string', type(p.call_string), p.call_string)
 
             previous_cumulative_change_happened_path = os.path.join(previous_year_dir, 'cumulative_change_happened.tif')
-            if hb.path_exists(previous_cumulative_change_happened_path):
+            if tile_state is not None and 'cumulative_change_happened_array' in tile_state:
+                previous_cumulative_change_happened_array = tile_state['cumulative_change_happened_array']
+                valid_mask_array = np.where(previous_cumulative_change_happened_array == 1, 0, valid_mask_array)
+            elif hb.path_exists(previous_cumulative_change_happened_path):
                 previous_cumulative_change_happened_array = hb.as_array(previous_cumulative_change_happened_path)
                 valid_mask_array = np.where(previous_cumulative_change_happened_array == 1, 0, valid_mask_array)
             else:
                 previous_cumulative_change_happened_array = np.zeros_like(valid_mask_array)
+
+            if p.allocation_dtype_mode == 'compact':
+                if np.min(lulc_baseline_array) < 0 or np.max(lulc_baseline_array) > 255:
+                    raise NameError('allocation_dtype_mode compact needs lulc values between 0 and 255 but the starting lulc of zone ' + zone_string + ' has values outside it.')
+                lulc_baseline_array = lulc_baseline_array.astype(np.uint8)
+                valid_mask_array = valid_mask_array.astype(np.uint8)
             # previous_change_year_path = os.path.join(previous_year_dir, 'change_year.tif')
             # if hb.path_exists(previous_change_year_path):
             #     previous_change_year_array = hb.as_array(previous_change_year_path)
 
             allow_contracting = np.int64(p.allow_contracting)
-            # Strange choice, but the allocation function both calibrates AND RUNS the final projection using the calibration. If instead you want to
-            # Run on precalibrated parameters, you have to reload coarse_change_3d.
-            overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots, output_change_arrays, change_happened = \
-                calibrate(projected_coarse_change_3d,
-                        lulc_baseline_array,
-                        spatial_layers_3d,
-                        generation_best_parameters,
-                        spatial_layer_function_types_1d,
-                        valid_mask_array,
-                        changing_class_indices_array,
-                        p.changing_class_labels,
-                        observed_lulc_array,
-                        hectares_per_grid_cell,
-                        p.cur_dir,
-                        p.cython_reporting_level,
-                        allow_contracting,
-                        p.loss_function_sigma,
-                        output_match_path=tile_match_path,
-                        call_string=p.call_string)
+
+            # The fit against observed lulc is expensive (several full-extent gaussian blurs per class) and production runs
+            # don't use it, so only calculate it when asked for via allocation_fit_mode.
+            if p.allocation_fit_mode == 'always':
+                calculate_fit = True
+            elif p.allocation_fit_mode == 'validation':
+                calculate_fit = p.output_writing_level >= 5
+            elif p.allocation_fit_mode == 'sampled':
+                # Hash the zone string rather than drawing randomly so reruns sample the same tiles.
+                calculate_fit = zlib.crc32(zone_string.encode()) % 10000 < p.allocation_fit_sample_fraction * 10000
+            elif p.allocation_fit_mode == 'never':
+                calculate_fit = False
+            else:
+                raise NameError('allocation_fit_mode must be one of never, always, validation or sampled, got ' + str(p.allocation_fit_mode))
+
+            if calculate_fit:
+                # Strange choice, but the allocation function both calibrates AND RUNS the final projection using the calibration. If instead you want to
+                # Run on precalibrated parameters, you have to reload coarse_change_3d.
+                overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots, output_change_arrays, change_happened = \
+                    calibrate(projected_coarse_change_3d,
+                            lulc_baseline_array,
+                            spatial_layers_3d,
+                            generation_best_parameters,
+                            spatial_layer_function_types_1d,
+                            valid_mask_array,
+                            changing_class_indices_array,
+                            p.changing_class_labels,
+                            observed_lulc_array,
+                            hectares_per_grid_cell,
+                            p.cur_dir,
+                            p.cython_reporting_level,
+                            allow_contracting,
+                            p.loss_function_sigma,
+                            output_match_path=tile_match_path,
+                            call_string=p.call_string,
+                            num_threads=p.allocation_num_threads,
+                            active_coarse_cells=active_coarse_cells,
+                            return_change_arrays=p.output_writing_level >= 5)
+
+                allocation_fit_df = pd.DataFrame({'class_label': list(p.changing_class_labels) + ['overall'],
+                                                  'similarity_score': list(class_similarity_scores) + [overall_similarity_score]})
+                allocation_fit_df.to_csv(os.path.join(p.cur_dir, 'allocation_fit.csv'), index=False)
+            else:
+                lulc_projected_array, output_change_arrays, change_happened = \
+                    seals_cython_functions.seals_allocation_gridded_input(projected_coarse_change_3d,
+                            lulc_baseline_array,
+                            spatial_layers_3d,
+                            generation_best_parameters,
+                            spatial_layer_function_types_1d,
+                            valid_mask_array,
+                            changing_class_indices_array,
+                            p.changing_class_labels,
+                            hectares_per_grid_cell,
+                            p.cur_dir,
+                            p.cython_reporting_level,
+                            allow_contracting,
+                            tile_match_path,
+                            p.call_string,
+                            num_threads=p.allocation_num_threads,
+                            active_coarse_cells=active_coarse_cells,
+                            return_change_arrays=p.output_writing_level >= 5)
 
             # LEARNING POINT: GDAL silently fails to write if you have a file path too long. This happened below. Fix by enabling long-filepaths in OS.
 
             # Write generated arrays to disk
             generated_gt = hb.generate_geotransform_of_chunk_from_cr_size_and_larger_path(p.fine_blocks_list, p.base_year_lulc_path)
             generated_projection = hb.common_projection_wkts['wgs84']
+            if tile_state is not None:
+                tile_state['lulc_array'] = lulc_projected_array
+                tile_state['tile_match_path'] = tile_match_path
             lulc_projected_array = lulc_projected_array.astype(np.int8)
-            hb.save_array_as_geotiff(lulc_projected_array, lulc_projected_path, tile_match_path, projection_override=generated_projection, ndv=255, data_type=1, compress=True, verbose=False)
+            seals_utils.save_tile_array_as_geotiff(p, lulc_projected_array, lulc_projected_path, tile_match_path, projection_override=generated_projection, ndv=255, data_type=1, compress=True, verbose=False)
 
             # lulc_baseline_path = os.path.join(p.cur_dir, 'lulc_' + p.lulc_simplification_label + '_baseline_' + p.model_label + '_' + str(p.year) + '.tif')
             # # lulc_baseline_path = os.path.join(p.cur_dir, 'lulc_' + p.lulc_simplification_label + '_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '_' + str(p.year) + '.tif')
@@ -2284,19 +2641,18 @@ def allocation(passed_p=None):
             if p.output_writing_level >= 1:
                 change_year_path = os.path.join(p.cur_dir, 'change_year.tif')
                 if not hb.path_exists(change_year_path):
-                    change_year_array = np.zeros(lulc_projected_array.shape, dtype=np.int64)
-                    for c, class_id in enumerate(p.changing_class_indices):
-                        change_year_array += np.where(output_change_arrays[c] == 1, p.year, 0)
-                    hb.save_array_as_geotiff(change_year_array, change_year_path, tile_match_path, projection_override=generated_projection, ndv=-9999, data_type=5, compress=True, verbose=False)
+                    # Every allocated cell is in change_happened exactly once, so this is the sum over the per-class allocations.
+                    change_year_array = np.where(change_happened == 1, p.year, 0).astype(np.int64)
+                    seals_utils.save_tile_array_as_geotiff(p, change_year_array, change_year_path, tile_match_path, projection_override=generated_projection, ndv=-9999, data_type=5, compress=True, verbose=False)
 
             if p.output_writing_level >= 1:
                 change_happened_path = os.path.join(p.cur_dir, 'change_happened.tif')
                 if not hb.path_exists(change_happened_path):
-                    hb.save_array_as_geotiff(change_happened, change_happened_path, tile_match_path, projection_override=generated_projection, ndv=-9999, data_type=5, compress=True, verbose=False)
+                    seals_utils.save_tile_array_as_geotiff(p, change_happened, change_happened_path, tile_match_path, projection_override=generated_projection, ndv=-9999, data_type=5, compress=True, verbose=False)
 
             if p.output_writing_level >= 5:
                 for i, label in enumerate(p.changing_class_labels):
-                    hb.save_array_as_geotiff(output_change_arrays[i], os.path.join(p.cur_dir, 'allocations_for_class_' + p.changing_class_labels[i] + '.tif'), tile_match_path)
+                    seals_utils.save_tile_array_as_geotiff(p, output_change_arrays[i], os.path.join(p.cur_dir, 'allocations_for_class_' + p.changing_class_labels[i] + '.tif'), tile_match_path)
 
                     # naive_upscale = hb.upscale_array(output_change_arrays[i], upscale_factor=resolution, upscale_method='mode')
                     # hb.show(output_change_arrays[i], output_path=hb.ruri(os.path.join(output_dir, 'allocations_for_class_' + str(i) + '.png')), vmin=0, vmax=1, title='allocations for class ' + str(i))
@@ -2306,9 +2662,11 @@ def allocation(passed_p=None):
 
             # This is the one other required written file because it is used in the next iteration.
             cumulative_change_happened_path = os.path.join(p.cur_dir, 'cumulative_change_happened.tif')
+            updated_cumulative_change_happened = np.where(change_happened == 1, 1, previous_cumulative_change_happened_array)
+            if tile_state is not None:
+                tile_state['cumulative_change_happened_array'] = updated_cumulative_change_happened
             if not hb.path_exists(cumulative_change_happened_path):
-                updated_cumulative_change_happened = np.where(change_happened == 1, 1, previous_cumulative_change_happened_array)
-                hb.save_array_as_geotiff(updated_cumulative_change_happened, cumulative_change_happened_path, tile_match_path, projection_override=generated_projection, ndv=-9999, data_type=5, compress=True, verbose=False)
+                seals_utils.save_tile_array_as_geotiff(p, updated_cumulative_change_happened, cumulative_change_happened_path, tile_match_path, projection_override=generated_projection, ndv=-9999, data_type=5, compress=True, verbose=False)
 
                 if p.output_writing_level >= 5:
                     validation_dir = os.path.join(p.cur_dir, 'validation')
@@ -2330,14 +2688,24 @@ def allocation(passed_p=None):
 
                             was_class_coarse = aspect_ratio_array_functions.upscale_retaining_sum(was_class, upscale_factor)
                             is_class_coarse = aspect_ratio_array_functions.upscale_retaining_sum(is_class, upscale_factor)
-                            hectares_per_grid_cell_upscaled = aspect_ratio_array_functions.upscale_using_mean(hectares_per_grid_cell, upscale_factor)
+                            hectares_per_grid_cell_upscaled = aspect_ratio_array_functions.upscale_using_mean(np.ascontiguousarray(hectares_per_grid_cell), upscale_factor)
                             net = is_class_coarse - was_class_coarse
                             net_ha = net * hectares_per_grid_cell_upscaled
 
 
                             hb.save_array_as_geotiff(net_ha, projected_recoarsening_path, block_ha_per_cell_coarse_path, projection_override=generated_projection, ndv=-9999, data_type=5, compress=True, verbose=False)
 
+            allocation_zones_dir = os.path.split(os.path.split(p.cur_dir)[0])[0]
+            if getattr(p, 'live_mosaic_base_path', None) is not None:
+                live_mosaic_path = seals_utils.get_live_mosaic_path(allocation_zones_dir, os.path.split(lulc_projected_path)[1])
+                seals_utils.run_tile_write(p, seals_utils.write_tile_to_live_mosaic, live_mosaic_path, p.live_mosaic_base_path, lulc_projected_path)
 
+            # Only now is the block finished for this year, so record it in the completion ledger used for restarting and stitching.
+            tile_output_paths = [lulc_projected_path, cumulative_change_happened_path]
+            if p.output_writing_level >= 1:
+                tile_output_paths += [change_year_path, change_happened_path]
+            completion_ledger_path = seals_utils.get_completion_ledger_path(allocation_zones_dir)
+            seals_utils.record_tile_completion(p, completion_ledger_path, zone_string, p.year, tile_output_paths, start)
 
                 # seals_utils.calc_observed_lulc_change_for_two_lulc_paths(previous_year_path, lulc_projected_path, block_ha_per_cell_coarse_path, p.changing_class_indices, validation_dir)
 
@@ -2369,7 +2737,12 @@ def stitched_lulc_simplified_scenarios(p):
                     target_dir = os.path.join(p.allocations_dir, p.exogenous_label, p.climate_label, p.model_label, p.counterfactual_label, str(year))
 
 
-                    p.layers_to_stitch = hb.list_filtered_paths_recursively(target_dir, include_strings=include_string, include_extensions='.tif', depth=None)
+                    # Stitch the tiles recorded as finished in the completion ledger, or everything that matches if there is none.
+                    completion_ledger = seals_utils.read_completion_ledger(seals_utils.get_completion_ledger_path(os.path.join(target_dir, 'allocation_zones')), p.verify_completion_ledger_checksums)
+                    if completion_ledger is not None:
+                        p.layers_to_stitch = [path for record in completion_ledger.values() for path in record['outputs'] if os.path.split(path)[1] == include_string]
+                    else:
+                        p.layers_to_stitch = hb.list_filtered_paths_recursively(target_dir, include_strings=include_string, include_extensions='.tif', depth=None)
 
 
                     stitched_output_name = 'lulc_' + p.lulc_src_label + '_' + p.lulc_simplification_label + '_' + p.exogenous_label + '_' + p.climate_label + '_' + p.model_label + '_' + p.counterfactual_label + '_' + str(year)
@@ -2377,6 +2750,13 @@ def stitched_lulc_simplified_scenarios(p):
 
                     p.lulc_projected_stitched_path = os.path.join(p.cur_dir, stitched_output_name + '.tif')
 
+                    # With use_live_mosaic the tiles are already in place in the live mosaic, so the stitched map is written
+                    # as a COG straight from it with the base map underneath.
+                    if p.use_live_mosaic and len(p.layers_to_stitch) > 0 and not hb.path_exists(p.lulc_projected_stitched_path):
+                        live_mosaic_path = seals_utils.get_live_mosaic_path(os.path.join(target_dir, 'allocation_zones'), include_string)
+                        hb.log('Finalizing live mosaic ' + live_mosaic_path + ' to ' + p.lulc_projected_stitched_path)
+                        seals_utils.finalize_live_mosaic(live_mosaic_path, seals_utils.get_live_mosaic_base_path(p), p.layers_to_stitch, p.lulc_projected_stitched_path)
+
                     if not hb.path_exists(p.lulc_projected_stitched_path):
                         if len(p.layers_to_stitch) > 0:
                             hb.log('Stitching for year ' + str(year))
@@ -2485,9 +2865,15 @@ def stitched_lulc_simplified_scenarios(p):
         for file_path in vrt_paths_to_remove:
             hb.remove_path(file_path)
         
-        # Even with 256gb memory, running 30 parallel pogers at once hits a ZSTD-related compression memory error.
+        # Even with 256gb memory, running 30 parallel pogers at once hits a ZSTD-related compression memory error, so
+        # conversions are started against an estimate of their peak memory rather than a fixed number of workers.
         if current_force_to_global_bb:
-            hb.make_paths_pogs_in_parallel(p.cur_dir, exclude_strings='2025', max_workers=16, dont_actually_do_it=False, verbose=True, verbose_pog_check=True)
+            if p.cog_conversion_memory_budget_gb is not None:
+                cog_conversion_memory_budget_bytes = p.cog_conversion_memory_budget_gb * 1024 ** 3
+            else:
+                cog_conversion_memory_budget_bytes = None
+            paths_to_convert = hb.list_filtered_paths_nonrecursively(p.cur_dir, include_extensions='.tif', exclude_strings='2025')
+            seals_utils.convert_paths_to_cogs_within_memory_budget(paths_to_convert, cog_conversion_memory_budget_bytes, max_workers=p.cog_conversion_max_workers)
 
 def luh_seals_baseline_adjustment(p):
     # SHORTCUT, this should have been put in GTAP project but i'm racing.
@@ -3223,33 +3609,31 @@ def stitched_lulc_esa_scenarios(p):
                         (p.aligned_esa_output_base_map_path, 1),
                     ]
 
-                    target_raster_pre_path = hb.temp('.tif', esa_include_string + '_prereclass', True, p.cur_dir)
-
                     p.lulc_projected_stitched_path = os.path.join(p.cur_dir, esa_include_string + '.tif')
 
                     datatype_target = 1
                     nodata_target = 255
 
-                    # TODOO Massive optimization here would be to just have the reclass happen in the fill_where_not_changed function..., and or make it parallel.
-                    if not hb.path_exists(target_raster_pre_path) and not hb.path_exists(p.lulc_projected_stitched_path):
-                        hb.log('Starting raster calculator with ' + str(target_raster_pre_path) + ' and ' + str(base_raster_path_band_const_list))
+                    rules_extended_with_existing_esa_classes = dict(hb.seals_simplified_to_esa_rules)
+                    rules_extended_with_existing_esa_classes.update({i: i for i in hb.esacci_extended_classes})
+                    rules_extended_with_existing_esa_classes.update({255: 255})
+                    esa_lookup_table = seals_utils.rules_to_uint8_lookup_table(rules_extended_with_existing_esa_classes)
+
+                    def fill_where_not_changed_and_reclassify(changed, baseline, esa):
+                        return esa_lookup_table[fill_where_not_changed(changed, baseline, esa)]
+
+                    # The fill and the reclassification to ESA classes happen in the same pass over the blocks, so no
+                    # filled but not yet reclassified intermediate is written.
+                    if not hb.path_exists(p.lulc_projected_stitched_path):
+                        hb.log('Starting raster calculator with ' + str(p.lulc_projected_stitched_path) + ' and ' + str(base_raster_path_band_const_list))
 
                         hb.raster_calculator_hb(
-                            base_raster_path_band_const_list, fill_where_not_changed, target_raster_pre_path,
+                            base_raster_path_band_const_list, fill_where_not_changed_and_reclassify, p.lulc_projected_stitched_path,
                             datatype_target, nodata_target,
                             gtiff_creation_options=hb.DEFAULT_GTIFF_CREATION_OPTIONS,
                             calc_raster_stats=False,
                             largest_block=hb.LARGEST_ITERBLOCK)
 
-                    rules_extended_with_existing_esa_classes = dict(hb.seals_simplified_to_esa_rules)
-                    rules_extended_with_existing_esa_classes.update({i: i for i in hb.esacci_extended_classes})
-                    rules_extended_with_existing_esa_classes.update({255: 255})
-                    if not hb.path_exists(p.lulc_projected_stitched_path):
-                        # TODOO I broke the previous functionality where it could either replace with zeros or replace with default when a value wasn't in the dictionary.
-                        hb.log('Starting reclassify_raster_hb with ' + str(target_raster_pre_path) + ' and ' + str(p.lulc_projected_stitched_path))
-
-                        hb.reclassify_raster_hb(target_raster_pre_path, rules_extended_with_existing_esa_classes, p.lulc_projected_stitched_path, output_data_type=1)
-
                     if p.write_global_lulc_overviews_and_tifs:
                         if p.aoi == 'global':
                             hb.make_path_global_pyramid(p.lulc_projected_stitched_path)
@@ -1,7 +1,11 @@
-import logging, os, math, sys
+import logging, os, math, sys, hashlib, json, time, atexit, contextlib, threading, concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
 from osgeo import gdal
 import numpy as np
 import scipy
+import scipy.fft
+import scipy.optimize
+import scipy.signal
 import scipy.stats as st
 import scipy.ndimage
 import hazelbean as hb
@@ -381,6 +385,256 @@ def fft_gaussian(signal_path, kernel_path, target_path, target_nodata=-9999.0, c
         raster_driver_creation_tuple=raster_driver_creation_tuple)
 
 
+
+
+def get_signal_by_kernel_target_paths(convolutions):
+    """From a list of (signal_path, kernel_path, target_path), return the unique signal_paths and kernel_paths in order
+    of appearance and target_paths[i][j] for signal i and kernel j (None where that pair isn't in convolutions), as
+    taken by convolve_signals_with_kernels and filter_signals_with_sum_of_gaussians."""
+    signal_paths = list(dict.fromkeys(i[0] for i in convolutions))
+    kernel_paths = list(dict.fromkeys(i[1] for i in convolutions))
+    target_paths = [[None] * len(kernel_paths) for i in signal_paths]
+    for signal_path, kernel_path, target_path in convolutions:
+        target_paths[signal_paths.index(signal_path)][kernel_paths.index(kernel_path)] = target_path
+    return signal_paths, kernel_paths, target_paths
+
+def get_convolution_tile_size(kernel_shapes, n_kernels, memory_budget_bytes, tile_sizes=(8192, 4096, 2048, 1024, 512, 256)):
+    """Return the largest of tile_sizes for which convolve_signals_with_kernels needs less than memory_budget_bytes
+    (the cached kernel spectra, a padded signal window and its spectrum, and one inverse transform), and its fft size."""
+    # The window adds each side's halo to the tile, and the linear convolution of that with a kernel is as long again as
+    # the kernel, all of which has to fit in the fft without wrapping around.
+    halo = max(max(shape[i] - 1 - shape[i] // 2 for shape in kernel_shapes) + max(shape[i] // 2 for shape in kernel_shapes) + max(shape[i] for shape in kernel_shapes) - 1 for i in (0, 1))
+    for tile_size in tile_sizes:
+        fft_size = scipy.fft.next_fast_len(tile_size + halo, real=True)
+        n_spectrum_bytes = fft_size * (fft_size // 2 + 1) * 16
+        if (n_kernels + 2) * n_spectrum_bytes + 2 * fft_size ** 2 * 8 <= memory_budget_bytes:
+            return tile_size, fft_size
+    return tile_sizes[-1], scipy.fft.next_fast_len(tile_sizes[-1] + halo, real=True)
+
+
+def convolve_signals_with_kernels(signal_paths, kernel_paths, target_paths, target_nodata=-9999.0, memory_budget_bytes=None, n_threads=None):
+    """Convolve each raster in signal_paths with each kernel in kernel_paths, writing the Float32 result of signal i and
+    kernel j to target_paths[i][j] (skipped where that is None). Gives the same result as fft_gaussian on each pair
+    (edges padded with zeros, nodata read as zero, the kernel centred on n // 2, no normalisation), but the signals are
+    processed in tiles with halos as large as the largest kernel, and each tile is forward transformed once and then
+    multiplied by the cached spectra of all kernels, so the cost grows with the number of signals rather than with the
+    number of signal-kernel pairs. Tiles are as large as fit in memory_budget_bytes (a quarter of the physical memory if
+    None) and the transforms use n_threads threads (all cores if None). All signals must be on the same grid."""
+    if memory_budget_bytes is None:
+        physical_memory_bytes = get_physical_memory_bytes()
+        memory_budget_bytes = physical_memory_bytes // 4 if physical_memory_bytes else 4 * 1024 ** 3
+    n_threads = n_threads or os.cpu_count() or 1
+
+    kernels = []
+    for kernel_path in kernel_paths:
+        kernel_ds = gdal.OpenEx(kernel_path, gdal.OF_RASTER)
+        kernel = kernel_ds.GetRasterBand(1).ReadAsArray().astype(np.float64)
+        kernel_ndv = kernel_ds.GetRasterBand(1).GetNoDataValue()
+        if kernel_ndv is not None:
+            kernel[kernel == kernel_ndv] = 0.0
+        kernels.append(kernel)
+        kernel_ds = None
+
+    # Rows and cols the signal window needs above/left (lo) and below/right (hi) of the tile for every kernel.
+    lo = [max(kernel.shape[i] - 1 - kernel.shape[i] // 2 for kernel in kernels) for i in (0, 1)]
+    hi = [max(kernel.shape[i] // 2 for kernel in kernels) for i in (0, 1)]
+    tile_size, fft_size = get_convolution_tile_size([kernel.shape for kernel in kernels], len(kernels), memory_budget_bytes)
+    fft_shape = (fft_size, fft_size)
+    kernel_spectra = [scipy.fft.rfft2(kernel, s=fft_shape, workers=n_threads) for kernel in kernels]
+    kernel_centres = [(kernel.shape[0] // 2, kernel.shape[1] // 2) for kernel in kernels]
+    kernels = None
+
+    signal_dss = [gdal.OpenEx(signal_path, gdal.OF_RASTER) for signal_path in signal_paths]
+    n_c, n_r = signal_dss[0].RasterXSize, signal_dss[0].RasterYSize
+    for signal_ds, signal_path in zip(signal_dss, signal_paths):
+        if (signal_ds.RasterXSize, signal_ds.RasterYSize) != (n_c, n_r):
+            raise NameError('Signals convolved together must share a grid, but ' + signal_path + ' is not the size of ' + signal_paths[0])
+    signal_ndvs = [signal_ds.GetRasterBand(1).GetNoDataValue() for signal_ds in signal_dss]
+
+    driver = gdal.GetDriverByName('GTiff')
+    temp_suffix = '_' + str(os.getpid()) + '.tif'
+    target_dss = []
+    for i, signal_ds in enumerate(signal_dss):
+        target_dss.append([])
+        for target_path in target_paths[i]:
+            if target_path is None:
+                target_dss[i].append(None)
+                continue
+            hb.create_directories(os.path.dirname(target_path))
+            target_ds = driver.Create(os.path.splitext(target_path)[0] + temp_suffix, n_c, n_r, 1, gdal.GDT_Float32, options=hb.DEFAULT_GTIFF_CREATION_OPTIONS)
+            target_ds.SetGeoTransform(signal_ds.GetGeoTransform())
+            target_ds.SetProjection(signal_ds.GetProjection())
+            target_ds.GetRasterBand(1).SetNoDataValue(target_nodata)
+            target_dss[i].append(target_ds)
+
+    window = np.zeros((tile_size + lo[0] + hi[0], tile_size + lo[1] + hi[1]), dtype=np.float64)
+    for tile_r in range(0, n_r, tile_size):
+        for tile_c in range(0, n_c, tile_size):
+            tile_n_r, tile_n_c = min(tile_size, n_r - tile_r), min(tile_size, n_c - tile_c)
+
+            # Part of the window inside the raster, as raster offsets and as window offsets.
+            read_r, read_c = max(tile_r - lo[0], 0), max(tile_c - lo[1], 0)
+            read_n_r = min(tile_r + tile_n_r + hi[0], n_r) - read_r
+            read_n_c = min(tile_c + tile_n_c + hi[1], n_c) - read_c
+            window_r, window_c = read_r - (tile_r - lo[0]), read_c - (tile_c - lo[1])
+
+            for i, signal_ds in enumerate(signal_dss):
+                if all(target_ds is None for target_ds in target_dss[i]):
+                    continue
+                window[:] = 0.0
+                signal = signal_ds.GetRasterBand(1).ReadAsArray(read_c, read_r, read_n_c, read_n_r)
+                window[window_r: window_r + read_n_r, window_c: window_c + read_n_c] = signal
+                if signal_ndvs[i] is not None:
+                    window[window_r: window_r + read_n_r, window_c: window_c + read_n_c][signal == signal_ndvs[i]] = 0.0
+                signal_spectrum = scipy.fft.rfft2(window, s=fft_shape, workers=n_threads)
+
+                for j, target_ds in enumerate(target_dss[i]):
+                    if target_ds is None:
+                        continue
+                    convolved = scipy.fft.irfft2(signal_spectrum * kernel_spectra[j], s=fft_shape, workers=n_threads)
+                    start_r = lo[0] + kernel_centres[j][0]
+                    start_c = lo[1] + kernel_centres[j][1]
+                    target_ds.GetRasterBand(1).WriteArray(convolved[start_r: start_r + tile_n_r, start_c: start_c + tile_n_c].astype(np.float32), tile_c, tile_r)
+
+    signal_dss = None
+    for i in range(len(target_dss)):
+        for j, target_ds in enumerate(target_dss[i]):
+            if target_ds is not None:
+                target_ds.FlushCache()
+                target_dss[i][j] = None
+                os.replace(os.path.splitext(target_paths[i][j])[0] + temp_suffix, target_paths[i][j])
+
+
+def get_sum_of_gaussians_kernel_terms(kernel, halflife, n_terms=10):
+    """Return [(weight, sigma), ...] such that the sum of weight * exp(-(x ** 2 + y ** 2) / (2 * sigma ** 2)) over the terms
+    least-squares fits kernel (a square array centred on n // 2), and the largest absolute error of that fit. The sigmas
+    are spaced geometrically over a range set by halflife. Each term is separable, so the kernel can then be applied
+    with 1d gaussian filters (see filter_signals_with_sum_of_gaussians) instead of a 2d convolution."""
+    offsets = np.arange(kernel.shape[0]) - kernel.shape[0] // 2
+    sigmas = halflife * np.geomspace(0.15, 1.5, n_terms)
+    basis = np.stack([np.outer(np.exp(-offsets ** 2 / (2 * sigma ** 2)), np.exp(-offsets ** 2 / (2 * sigma ** 2))).ravel() for sigma in sigmas], axis=1)
+    weights = np.linalg.lstsq(basis, kernel.ravel(), rcond=None)[0]
+    max_error = float(np.max(np.abs(basis @ weights - kernel.ravel())))
+    return [(float(weight), float(sigma)) for weight, sigma in zip(weights, sigmas)], max_error
+
+
+def gaussian_filter_1d(array, sigma, axis):
+    """Filter array along axis with a gaussian of sigma that sums to 1, treating values beyond the array as zero. Above
+    a sigma of 3, this uses the 4th order recursive approximation of Deriche (1993), which costs the same per pixel
+    whatever sigma is and is within about 0.3% of the peak of the exact gaussian. Below it, the truncated kernel is
+    applied directly."""
+    if sigma < 3.0:
+        radius = int(math.ceil(6.0 * sigma))
+        weights = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma ** 2))
+        return scipy.ndimage.correlate1d(array, weights / np.sum(weights), axis=axis, mode='constant', cval=0.0)
+
+    # The approximation h(n) = sum of Re(alpha * pole ** |n|) over two pairs of complex poles, filtered as a causal part
+    # for n >= 0 plus an anticausal part for n < 0, each of which only sees the array, so no padding is needed.
+    alphas = np.array([1.3530 - 1.8151j, -0.3531 - 0.0902j])
+    poles = np.exp(np.array([-1.3932 + 0.6681j, -1.3732 + 2.0787j]) / sigma)
+    b, a = scipy.signal.invresz(np.concatenate([alphas, np.conj(alphas)]) / 2, np.concatenate([poles, np.conj(poles)]), [])
+    b, a = np.real(b), np.real(a)
+    h_0 = np.real(np.sum(alphas))
+    h_sum = 2 * np.real(np.sum(alphas / (1 - poles))) - h_0
+    anticausal_b = np.concatenate([b, np.zeros(len(a) - len(b))]) - h_0 * a
+
+    causal = scipy.signal.lfilter(b, a, array, axis=axis)
+    anticausal = np.flip(scipy.signal.lfilter(anticausal_b, a, np.flip(array, axis=axis), axis=axis), axis=axis)
+    return (causal + anticausal) / h_sum
+
+
+def sum_of_gaussians_filter(array, kernel_terms):
+    """Return the convolution of array with the kernel fitted by get_sum_of_gaussians_kernel_terms, as separable gaussian
+    filters, treating values beyond the array as zero."""
+    output = np.zeros(array.shape, dtype=np.float64)
+    for weight, sigma in kernel_terms:
+        # gaussian_filter_1d sums to 1, the fitted terms have a peak of 1.
+        scale = weight * np.sum(np.exp(-np.arange(-int(math.ceil(6.0 * sigma)), int(math.ceil(6.0 * sigma)) + 1) ** 2 / (2 * sigma ** 2))) ** 2
+        output += scale * gaussian_filter_1d(gaussian_filter_1d(array, sigma, 1), sigma, 0)
+    return output
+
+
+def get_sum_of_gaussians_filter_error(signal_path, kernel, kernel_terms, sample_size=1024):
+    """Return the largest absolute difference, relative to the largest value, between the FFT convolution of kernel and
+    sum_of_gaussians_filter with kernel_terms over a sample_size square from the centre of signal_path."""
+    signal_ds = gdal.OpenEx(signal_path, gdal.OF_RASTER)
+    n_c, n_r = min(sample_size, signal_ds.RasterXSize), min(sample_size, signal_ds.RasterYSize)
+    signal_band = signal_ds.GetRasterBand(1)
+    sample = signal_band.ReadAsArray((signal_ds.RasterXSize - n_c) // 2, (signal_ds.RasterYSize - n_r) // 2, n_c, n_r).astype(np.float64)
+    if signal_band.GetNoDataValue() is not None:
+        sample[sample == signal_band.GetNoDataValue()] = 0.0
+    signal_ds = None
+
+    expected = scipy.signal.fftconvolve(sample, kernel, 'full')[kernel.shape[0] // 2: kernel.shape[0] // 2 + n_r, kernel.shape[1] // 2: kernel.shape[1] // 2 + n_c]
+    filtered = sum_of_gaussians_filter(sample, kernel_terms)
+    return float(np.max(np.abs(filtered - expected)) / max(np.max(np.abs(expected)), 1e-12))
+
+
+def filter_signals_with_sum_of_gaussians(signal_paths, kernel_terms_list, target_paths, target_nodata=-9999.0, memory_budget_bytes=None):
+    """Like convolve_signals_with_kernels, but each kernel is given as the gaussian terms of
+    get_sum_of_gaussians_kernel_terms and applied with sum_of_gaussians_filter, so the cost per pixel doesn't grow with
+    the size of the kernel and no kernel raster is needed. Signals are processed in full-width strips of rows, with
+    halos of rows for the filter along columns, as tall as fit in memory_budget_bytes (a quarter of the physical memory
+    if None)."""
+    if memory_budget_bytes is None:
+        physical_memory_bytes = get_physical_memory_bytes()
+        memory_budget_bytes = physical_memory_bytes // 4 if physical_memory_bytes else 4 * 1024 ** 3
+
+    signal_dss = [gdal.OpenEx(signal_path, gdal.OF_RASTER) for signal_path in signal_paths]
+    n_c, n_r = signal_dss[0].RasterXSize, signal_dss[0].RasterYSize
+    for signal_ds, signal_path in zip(signal_dss, signal_paths):
+        if (signal_ds.RasterXSize, signal_ds.RasterYSize) != (n_c, n_r):
+            raise NameError('Signals filtered together must share a grid, but ' + signal_path + ' is not the size of ' + signal_paths[0])
+    signal_ndvs = [signal_ds.GetRasterBand(1).GetNoDataValue() for signal_ds in signal_dss]
+
+    # Gaussians are negligible beyond 6 sigma.
+    halo = int(math.ceil(6.0 * max(sigma for kernel_terms in kernel_terms_list for weight, sigma in kernel_terms)))
+    # About six float64 copies of the window are alive at once while filtering.
+    n_strip_rows = max(256, (memory_budget_bytes // (6 * 8 * n_c) - 2 * halo) // 256 * 256)
+
+    driver = gdal.GetDriverByName('GTiff')
+    temp_suffix = '_' + str(os.getpid()) + '.tif'
+    target_dss = []
+    for i, signal_ds in enumerate(signal_dss):
+        target_dss.append([])
+        for target_path in target_paths[i]:
+            if target_path is None:
+                target_dss[i].append(None)
+                continue
+            hb.create_directories(os.path.dirname(target_path))
+            target_ds = driver.Create(os.path.splitext(target_path)[0] + temp_suffix, n_c, n_r, 1, gdal.GDT_Float32, options=hb.DEFAULT_GTIFF_CREATION_OPTIONS)
+            target_ds.SetGeoTransform(signal_ds.GetGeoTransform())
+            target_ds.SetProjection(signal_ds.GetProjection())
+            target_ds.GetRasterBand(1).SetNoDataValue(target_nodata)
+            target_dss[i].append(target_ds)
+
+    for strip_r in range(0, n_r, n_strip_rows):
+        strip_n_r = min(n_strip_rows, n_r - strip_r)
+        read_r = max(strip_r - halo, 0)
+        read_n_r = min(strip_r + strip_n_r + halo, n_r) - read_r
+        window = np.zeros((strip_n_r + 2 * halo, n_c), dtype=np.float64)
+        window_r = read_r - (strip_r - halo)
+        for i, signal_ds in enumerate(signal_dss):
+            if all(target_ds is None for target_ds in target_dss[i]):
+                continue
+            window[:] = 0.0
+            signal = signal_ds.GetRasterBand(1).ReadAsArray(0, read_r, n_c, read_n_r)
+            window[window_r: window_r + read_n_r] = signal
+            if signal_ndvs[i] is not None:
+                window[window_r: window_r + read_n_r][signal == signal_ndvs[i]] = 0.0
+            for j, target_ds in enumerate(target_dss[i]):
+                if target_ds is not None:
+                    filtered = sum_of_gaussians_filter(window, kernel_terms_list[j])
+                    target_ds.GetRasterBand(1).WriteArray(filtered[halo: halo + strip_n_r].astype(np.float32), 0, strip_r)
+
+    signal_dss = None
+    for i in range(len(target_dss)):
+        for j, target_ds in enumerate(target_dss[i]):
+            if target_ds is not None:
+                target_ds.FlushCache()
+                target_dss[i][j] = None
+                os.replace(os.path.splitext(target_paths[i][j])[0] + temp_suffix, target_paths[i][j])
+
 def get_array_from_two_dim_first_order_kernel_function(radius, starting_value, halflife):
     diameter = radius * 2
     x = np.linspace(-radius, radius + 1, diameter)
@@ -1352,74 +1606,107 @@ def set_attributes_to_dynamic_many_year_default(p):
     p.base_year_lulc_path = p.key_base_year_lulc_src_path
 
 
-def calc_observed_lulc_change_for_two_lulc_paths(lulc_1_path, lulc_2_path, coarse_ha_per_cell_path, classes_that_might_change, output_dir):
+def make_threaded_window_reader(path):
+    """Return a function read_window(c, r, n_c, n_r) returning that window of band 1 of the raster at path, safe to call
+    from several threads at once. GDAL datasets can't be shared between threads, so each calling thread opens the raster
+    the first time and keeps it open."""
+    thread_data = threading.local()
+
+    def read_window(c, r, n_c, n_r):
+        if not hasattr(thread_data, 'ds'):
+            thread_data.ds = gdal.OpenEx(path, gdal.OF_RASTER)
+        return thread_data.ds.GetRasterBand(1).ReadAsArray(c, r, n_c, n_r)
+    return read_window
+
+
+def calc_coarse_change_matrices(lulc_1_path, lulc_2_path, classes_that_might_change, n_coarse_rows, n_coarse_cols, fine_cells_per_coarse_side, max_fine_cells_per_band=2 ** 24, num_threads=4):
+    """Return an int64 array of shape (n_coarse_rows, n_coarse_cols, n_classes, n_classes) in which [r, c, i, j] counts the
+    fine cells of coarse cell r, c that were classes_that_might_change[i] in lulc_1_path and classes_that_might_change[j]
+    in lulc_2_path. Cells in other classes aren't counted. The two fine maps are read in aligned bands of whole coarse
+    rows, in parallel, and the counts of each band come from one np.bincount of coarse cell and from-to codes, so neither
+    map is ever held whole."""
+    n_classes = len(classes_that_might_change)
+    n_codes = (n_classes + 1) ** 2  # Position n_classes stands for any class not in classes_that_might_change.
+    classes_array = np.asarray(classes_that_might_change, dtype=np.int64)
+    min_class = int(np.min(classes_array))
+    positions_lookup_table = np.full(int(np.max(classes_array)) - min_class + 1, n_classes, dtype=np.uint16)
+    positions_lookup_table[classes_array - min_class] = np.arange(n_classes, dtype=np.uint16)
+
+    n_fine_cols = n_coarse_cols * fine_cells_per_coarse_side
+    n_coarse_rows_per_band = max(1, max_fine_cells_per_band // (n_fine_cols * fine_cells_per_coarse_side))
+    fine_coarse_cols = (np.arange(n_fine_cols) // fine_cells_per_coarse_side).astype(np.int64)
+
+    def get_positions(array):
+        positions = np.full(array.shape, n_classes, dtype=np.uint16)
+        in_range = (array >= min_class) & (array < min_class + len(positions_lookup_table))
+        positions[in_range] = positions_lookup_table[array[in_range].astype(np.int64) - min_class]
+        return positions
+
+    n_fine_rows_total = gdal.OpenEx(lulc_1_path, gdal.OF_RASTER).RasterYSize
+    read_lulc_1 = make_threaded_window_reader(lulc_1_path)
+    read_lulc_2 = make_threaded_window_reader(lulc_2_path)
+
+    def count_band(band_coarse_r):
+        band_n_coarse_rows = min(n_coarse_rows_per_band, n_coarse_rows - band_coarse_r)
+        fine_r = band_coarse_r * fine_cells_per_coarse_side
+        n_fine_rows = min(band_n_coarse_rows * fine_cells_per_coarse_side, n_fine_rows_total - fine_r)
+        lulc_1 = read_lulc_1(0, fine_r, n_fine_cols, n_fine_rows)
+        lulc_2 = read_lulc_2(0, fine_r, n_fine_cols, n_fine_rows)
+        codes = get_positions(lulc_1) * np.uint16(n_classes + 1) + get_positions(lulc_2)
+        fine_coarse_rows = np.arange(n_fine_rows, dtype=np.int64) // fine_cells_per_coarse_side
+        cell_codes = (fine_coarse_rows[:, None] * n_coarse_cols + fine_coarse_cols[None, :]) * n_codes + codes
+        counts = np.bincount(cell_codes.ravel(), minlength=band_n_coarse_rows * n_coarse_cols * n_codes)
+        return band_coarse_r, counts.reshape(band_n_coarse_rows, n_coarse_cols, n_classes + 1, n_classes + 1)[:, :, 0: n_classes, 0: n_classes]
+
+    change_matrices = np.zeros((n_coarse_rows, n_coarse_cols, n_classes, n_classes), dtype=np.int64)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for band_coarse_r, counts in executor.map(count_band, range(0, n_coarse_rows, n_coarse_rows_per_band)):
+            change_matrices[band_coarse_r: band_coarse_r + counts.shape[0]] = counts
+    return change_matrices
+
+
+def calc_net_change_of_change_matrices(change_matrices, ha_per_fine_cell):
+    """Return an (n_classes, n_coarse_rows, n_coarse_cols) array of the net change in ha of each class of the
+    calc_coarse_change_matrices counts change_matrices, indexed by the class's position in classes_that_might_change:
+    what it gained from the other classes less what it lost to them (the diagonal cancels), times ha_per_fine_cell."""
+    n_classes = change_matrices.shape[2]
+    net_change = np.zeros((n_classes, change_matrices.shape[0], change_matrices.shape[1]))
+    for c in range(n_classes):
+        net_change[c] = (np.sum(change_matrices[:, :, :, c], axis=2) - np.sum(change_matrices[:, :, c, :], axis=2)) * ha_per_fine_cell
+    return net_change
+
+
+def get_full_change_matrix(change_matrices):
+    """Return the calc_coarse_change_matrices counts change_matrices as one float64 2d array, with the matrix of each
+    coarse cell r, c at rows r * n_classes and cols c * n_classes."""
+    n_coarse_rows, n_coarse_cols, n_classes = change_matrices.shape[0:3]
+    return change_matrices.transpose(0, 2, 1, 3).reshape(n_coarse_rows * n_classes, n_coarse_cols * n_classes).astype(np.float64)
 
-    lulc_paths = [lulc_1_path, lulc_2_path]
 
-
-    # ha_per_cell_15m = hb.ArrayFrame(p.global_ha_per_cell_15m_path)
+def calc_observed_lulc_change_for_two_lulc_paths(lulc_1_path, lulc_2_path, coarse_ha_per_cell_path, classes_that_might_change, output_dir):
 
     # TODOO, current problems: Change vector method needs to be expanded to Change matrix, full from-to relationships
     # but when doing from-to, that only works when doing observed time-period validation. What would be the assumption for going into
     # the future? Possibly attempt to match prior change matrices, but only as a slight increase in probability? Secondly, why is my
     # search algorithm not itself finding the from-to relationships just by minimizing difference? Basically, need to take seriously deallocation.
 
-    full_change_matrix_no_diagonal_path = os.path.join(output_dir, 'full_change_matrix_no_diagonal.tif')
-
-    from hazelbean.calculation_core.cython_functions import \
-        calc_change_matrix_of_two_int_arrays
-
-    # if p.run_this and not os.path.exists(full_change_matrix_no_diagonal_path):
-    # Clip all 30km change paths, then just use the last one to set the propoer (coarse) extent of the lulc.
-    lulc_1 = hb.as_array(lulc_1_path)
-    lulc_2 = hb.as_array(lulc_2_path)
     coarse_ha_per_cell = hb.as_array(coarse_ha_per_cell_path)
 
-    # # Clip all 30km change paths, then just use the last one to set the propoer (coarse) extent of the lulc.
-    # for c, path in enumerate(p.global_lulc_paths):
-    #     hb.load_geotiff_chunk_by_cr_size(path, p.fine_blocks_list, output_path=p.lulc_paths[c])
-
-    # lulc_afs = [hb.ArrayFrame(path) for path in p.lulc_paths]
-
     fine_cell_size = hb.get_cell_size_from_path(lulc_1_path)
     coarse_cell_size = hb.get_cell_size_from_path(coarse_ha_per_cell_path)
 
-
-
     fine_cells_per_coarse_cell = round((coarse_cell_size/ fine_cell_size) ** 2)
-    aspect_ratio = int(lulc_1.shape[1] / coarse_ha_per_cell.shape[1])
-
-    net_change_output_arrays = np.zeros((len(classes_that_might_change), coarse_ha_per_cell.shape[0], coarse_ha_per_cell.shape[1]))
+    aspect_ratio = int(hb.get_shape_from_dataset_path(lulc_1_path)[1] / coarse_ha_per_cell.shape[1])
 
-    full_change_matrix = np.zeros((len(classes_that_might_change * coarse_ha_per_cell.shape[0]), len(classes_that_might_change) * coarse_ha_per_cell.shape[1]))
-    full_change_matrix_no_diagonal = np.zeros((len(classes_that_might_change * coarse_ha_per_cell.shape[0]), len(classes_that_might_change) * coarse_ha_per_cell.shape[1]))
+    # All from-to counts of all coarse cells, streamed from the two fine maps.
+    change_matrices = calc_coarse_change_matrices(lulc_1_path, lulc_2_path, classes_that_might_change, coarse_ha_per_cell.shape[0], coarse_ha_per_cell.shape[1], aspect_ratio)
+    n_classes = len(classes_that_might_change)
 
-    for r in range(coarse_ha_per_cell.shape[0]):
-        for c in range(coarse_ha_per_cell.shape[1]):
+    net_change_output_arrays = calc_net_change_of_change_matrices(change_matrices, coarse_ha_per_cell / fine_cells_per_coarse_cell)
 
-            t1_subarray = lulc_1[int(r * aspect_ratio): int((r + 1) * aspect_ratio), int(c * aspect_ratio): int((c + 1) * aspect_ratio)]
-            t2_subarray = lulc_2[int(r * aspect_ratio): int((r + 1) * aspect_ratio), int(c * aspect_ratio): int((c + 1) * aspect_ratio)]
-            # ha_per_coarse_cell_this_subarray = p.coarse_cell_size.data[r, c]
-
-            change_matrix, counters = calc_change_matrix_of_two_int_arrays(t1_subarray.astype(np.int32), t2_subarray.astype(np.int32), classes_that_might_change)
-            vector = calc_change_vector_of_change_matrix(change_matrix)
-
-            ha_per_cell_this_subarray = coarse_ha_per_cell[r, c] / fine_cells_per_coarse_cell
-
-            if vector:
-                for i in classes_that_might_change:
-                    net_change_output_arrays[i - 1, r, c] = vector[i - 1] * ha_per_cell_this_subarray
-            else:
-                net_change_output_arrays[i, r, c] = 0.0
-
-            n_classes = len(classes_that_might_change)
-            full_change_matrix[r * n_classes: (r + 1) * n_classes, c * n_classes: (c + 1) * n_classes] = change_matrix
-
-            # Fill diagonal with zeros.
-            for i in range(n_classes):
-                change_matrix[i, i] = 0
-
-            full_change_matrix_no_diagonal[r * n_classes: (r + 1) * n_classes, c * n_classes: (c + 1) * n_classes] = change_matrix
+    full_change_matrix = get_full_change_matrix(change_matrices)
+    change_matrices[:, :, np.arange(n_classes), np.arange(n_classes)] = 0
+    full_change_matrix_no_diagonal = get_full_change_matrix(change_matrices)
 
     for c, i in enumerate(classes_that_might_change):
         current_net_change_array_path = os.path.join(output_dir, str(i) + '_observed_change.tif')
@@ -1453,6 +1740,940 @@ def calc_observed_lulc_change_for_two_lulc_paths(lulc_1_path, lulc_2_path, coars
 
 # p.ha_per_cell_15m = None
 
+def get_paths_fingerprint(paths):
+    """Return the sha1 hex digest of paths, each by absolute path, size and modification time (see get_file_signature),
+    so that cache keys built on it change whenever any of the files is regenerated. Missing files are fingerprinted as
+    missing rather than raising."""
+    hasher = hashlib.sha1()
+    for path in paths:
+        hasher.update((os.path.abspath(path) + '|' + str(get_file_signature(path)) + '\n').encode())
+    return hasher.hexdigest()
+
+
+def get_suitability_cache_key(spatial_layer_coefficients_2d, spatial_layer_function_types_1d, spatial_layer_paths, fine_blocks_list, dtype):
+    """Return a short hash identifying the per-class suitability of a block. It changes whenever the coefficients, the
+    layer function types, any regressor file (by path, size and modification time), the block or the dtype do."""
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(spatial_layer_coefficients_2d, dtype=np.float64).tobytes())
+    hasher.update(np.ascontiguousarray(spatial_layer_function_types_1d, dtype=np.int64).tobytes())
+    hasher.update(get_paths_fingerprint(spatial_layer_paths).encode())
+    hasher.update((str([int(i) for i in fine_blocks_list[0:4]]) + '|' + np.dtype(dtype).name).encode())
+    return hasher.hexdigest()[0:16]
+
+
+
+def get_regressor_bundle_path(bundle_dir, spatial_layer_paths, fine_blocks_list, global_fine_blocks_list, dtype, normalized):
+    """Return the path of the regressor bundle holding spatial_layer_paths for a block, stacked in the given dtype and
+    optionally normalized. The name includes a hash of the inputs (each regressor by path, size and modification time) so
+    a bundle is never reused once any of them change."""
+    hasher = hashlib.sha1(get_paths_fingerprint(spatial_layer_paths).encode())
+    hasher.update((str([int(i) for i in fine_blocks_list[0:4]]) + '|' + str([int(i) for i in global_fine_blocks_list[0:4]]) + '|' + np.dtype(dtype).name + '|' + str(bool(normalized))).encode())
+    return os.path.join(bundle_dir, 'regressors_' + str(int(global_fine_blocks_list[0])) + '_' + str(int(global_fine_blocks_list[1])) + '_' + hasher.hexdigest()[0:16] + '.npy')
+
+
+def write_regressor_bundle(bundle_path, spatial_layers_3d, spatial_layer_names, spatial_layer_paths):
+    """Write spatial_layers_3d as one contiguous .npy at bundle_path, with a .json header next to it listing the layer
+    names, source paths, dtype and shape. Other workers may be writing the same block, so both go to temporary files
+    that are moved into place, header first so a bundle is never without its header."""
+    hb.create_directories(os.path.dirname(bundle_path))
+    header = OrderedDict()
+    header['layer_names'] = [str(i) for i in spatial_layer_names]
+    header['layer_paths'] = [str(i) for i in spatial_layer_paths]
+    header['dtype'] = np.dtype(spatial_layers_3d.dtype).name
+    header['shape'] = [int(i) for i in spatial_layers_3d.shape]
+    header_path = os.path.splitext(bundle_path)[0] + '.json'
+    temp_suffix = '_' + str(os.getpid())
+    with open(header_path + temp_suffix, 'w') as f:
+        json.dump(header, f, indent=4)
+    os.replace(header_path + temp_suffix, header_path)
+    temp_bundle_path = os.path.splitext(bundle_path)[0] + temp_suffix + '.npy'
+    np.save(temp_bundle_path, np.ascontiguousarray(spatial_layers_3d))
+    os.replace(temp_bundle_path, bundle_path)
+
+
+def load_regressor_bundle(bundle_path, spatial_layer_names):
+    """Return the spatial_layers_3d stored at bundle_path with one sequential read, checking against its header that it
+    holds spatial_layer_names in that order."""
+    with open(os.path.splitext(bundle_path)[0] + '.json') as f:
+        header = json.load(f)
+    if header['layer_names'] != [str(i) for i in spatial_layer_names]:
+        raise NameError('Regressor bundle ' + bundle_path + ' holds layers ' + str(header['layer_names']) + ' but ' + str(list(spatial_layer_names)) + ' were asked for.')
+    return np.load(bundle_path)
+
+
+def calc_ha_per_cell_rows(geotransform, n_rows):
+    """Return the area in hectares of a cell in each of the n_rows rows of a lat/lon grid with the given GDAL
+    geotransform, on the WGS84 ellipsoid. Cell area only depends on latitude, so this vector holds everything a
+    ha_per_cell raster of the same grid would; np.broadcast_to(vector[:, np.newaxis], (n_rows, n_cols)) gives the 2D
+    array without materializing it."""
+    a = 6378137.0
+    b = 6356752.314245179
+    e = math.sqrt(1.0 - (b / a) ** 2)
+
+    def area_to_equator(lat):
+        # Area in m2 of the band between the equator and lat over the full 360 degrees of longitude (a hemisphere at lat 90).
+        sin_lat = np.sin(np.radians(lat))
+        zm = 1.0 - e * sin_lat
+        zp = 1.0 + e * sin_lat
+        return np.pi * b ** 2 * (np.log(zp / zm) / (2.0 * e) + sin_lat / (zp * zm))
+
+    row_edges = geotransform[3] + np.arange(n_rows + 1, dtype=np.float64) * geotransform[5]
+    band_areas = np.abs(area_to_equator(row_edges[:-1]) - area_to_equator(row_edges[1:]))
+    return band_areas * abs(geotransform[1]) / 360.0 / 10000.0
+
+
+def rules_to_uint8_lookup_table(rules):
+    """Return a 256-long uint8 array that maps each byte value through the reclassification dict rules, leaving values
+    not in rules unchanged, so that lookup_table[array] reclassifies a uint8 array in one indexing pass."""
+    lookup_table = np.arange(256, dtype=np.uint8)
+    for src, dst in rules.items():
+        if not (0 <= int(src) <= 255 and 0 <= int(dst) <= 255):
+            raise NameError('A uint8 lookup table can only hold classes from 0 to 255, got rule ' + str(src) + ': ' + str(dst))
+        lookup_table[int(src)] = int(dst)
+    return lookup_table
+
+def get_block_activity_index_key(coarse_change_paths, coarse_blocks_list):
+    """Return a short hash identifying a block activity index. It changes whenever any of the coarse change rasters (by
+    path, size and modification time) or the block list do."""
+    hasher = hashlib.sha1(get_paths_fingerprint(coarse_change_paths).encode())
+    hasher.update(str([[int(i) for i in block[0:4]] for block in coarse_blocks_list]).encode())
+    return hasher.hexdigest()[0:16]
+
+
+def sum_array_over_blocks(input_array, blocks_list):
+    """Return the sum of input_array within each [c, r, n_c, n_r] block of blocks_list, using a summed-area table so that
+    each block costs the same regardless of its size. Parts of blocks outside the array are ignored."""
+    n_r, n_c = input_array.shape
+    summed_area = np.zeros((n_r + 1, n_c + 1), dtype=np.result_type(input_array.dtype, np.int64))
+    summed_area[1:, 1:] = np.cumsum(np.cumsum(input_array, axis=0), axis=1)
+
+    blocks = np.asarray([[int(i) for i in block[0:4]] for block in blocks_list], dtype=np.int64).reshape(-1, 4)
+    c_start = np.clip(blocks[:, 0], 0, n_c)
+    r_start = np.clip(blocks[:, 1], 0, n_r)
+    c_end = np.clip(blocks[:, 0] + blocks[:, 2], 0, n_c)
+    r_end = np.clip(blocks[:, 1] + blocks[:, 3], 0, n_r)
+    return summed_area[r_end, c_end] - summed_area[r_start, c_end] - summed_area[r_end, c_start] + summed_area[r_start, c_start]
+
+
+def calc_block_activity_index(coarse_change_paths_by_year_and_class, coarse_blocks_list, processing_blocks_list):
+    """coarse_change_paths_by_year_and_class maps (year, class_label) to a coarse change raster. Return a DataFrame with
+    one row per block and raster giving the number of coarse cells with change and the summed absolute change in the
+    block. Each raster is read once. Zeros, NaNs and the -9999 nodata value don't count as change, as in allocation."""
+    block_ids = [str(block[0]) + '_' + str(block[1]) for block in processing_blocks_list]
+    dfs = []
+    for (year, class_label), path in coarse_change_paths_by_year_and_class.items():
+        coarse_change = hb.as_array(path).astype(np.float64)
+        changed = (coarse_change != 0) & (coarse_change != -9999.) & (~np.isnan(coarse_change))
+        dfs.append(pd.DataFrame({'block_index': np.arange(len(block_ids)),
+                                 'block_id': block_ids,
+                                 'year': year,
+                                 'class_label': class_label,
+                                 'n_changed_cells': sum_array_over_blocks(changed.astype(np.int64), coarse_blocks_list),
+                                 'abs_change_ha': sum_array_over_blocks(np.where(changed, np.abs(coarse_change), 0.0), coarse_blocks_list)}))
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=['block_index', 'block_id', 'year', 'class_label', 'n_changed_cells', 'abs_change_ha'])
+    return pd.concat(dfs, ignore_index=True)
+
+
+def replace_year_dir(path, from_year, to_year):
+    """Return path with its from_year directory replaced by to_year, e.g. to go from a tile's dir in one year to the same
+    tile's dir in another. Also normalizes the separators to /."""
+    return path.replace('\\', '/').replace('/' + str(from_year) + '/', '/' + str(to_year) + '/')
+
+
+def get_tile_major_years_and_previous_years(p):
+    """Return the (year, previous_year) pairs a tile_major allocation walks through for the current scenario."""
+    years_and_previous_years = []
+    for c, year in enumerate(p.years):
+        if c == 0:
+            years_and_previous_years.append((year, p.key_base_year))
+        else:
+            years_and_previous_years.append((year, p.years[c - 1]))
+    return years_and_previous_years
+
+
+def run_tile_write(p, function, *args, **kwargs):
+    """Call function(*args, **kwargs), or while a tile_major allocation is running, queue it on the tile's background
+    writer so the next year can start. The writer has one thread, so queued writes run in the order they were queued."""
+    tile_state = getattr(p, 'tile_state', None)
+    if tile_state is not None:
+        tile_state['write_futures'].append(tile_state['writer'].submit(function, *args, **kwargs))
+    else:
+        function(*args, **kwargs)
+
+
+def save_tile_array_as_geotiff(p, *args, **kwargs):
+    """Same as hb.save_array_as_geotiff, but queued with run_tile_write. The array must not be modified afterwards."""
+    run_tile_write(p, hb.save_array_as_geotiff, *args, **kwargs)
+
+
+
+
+# Shared memory created by this process (by name) and attached to by this process, so that the views stay valid.
+shared_coarse_inputs_owned = {}
+shared_coarse_inputs_attached = {}
+
+
+def create_shared_coarse_inputs(paths):
+    """Read each raster in paths whole, as float64, into one multiprocessing.shared_memory segment and return a small
+    picklable descriptor of it to put on p. Worker processes get block views of it with load_coarse_block instead of
+    opening the rasters again. The segment lives until release_shared_coarse_inputs or the end of this process."""
+    arrays = OrderedDict((os.path.abspath(path), hb.as_array(path).astype(np.float64)) for path in paths)
+    entries = OrderedDict()
+    offset = 0
+    for path, array in arrays.items():
+        entries[path] = (offset, array.shape)
+        offset += array.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for path, array in arrays.items():
+        np.ndarray(array.shape, dtype=np.float64, buffer=shm.buf, offset=entries[path][0])[:] = array
+    shared_coarse_inputs_owned[shm.name] = shm
+    return {'name': shm.name, 'entries': entries}
+
+
+def release_shared_coarse_inputs():
+    """Free the shared memory created by create_shared_coarse_inputs in this process."""
+    for name in list(shared_coarse_inputs_owned.keys()):
+        shm = shared_coarse_inputs_owned.pop(name)
+        shm.close()
+        shm.unlink()
+
+
+atexit.register(release_shared_coarse_inputs)
+
+
+def load_coarse_block(p, path, coarse_blocks_list):
+    """Same as hb.load_geotiff_chunk_by_cr_size(path, coarse_blocks_list).astype(np.float64), but if path is in the
+    shared coarse inputs on p (see create_shared_coarse_inputs), return a view of it without opening the raster."""
+    shared_coarse_inputs = getattr(p, 'shared_coarse_inputs', None)
+    if shared_coarse_inputs is None or os.path.abspath(path) not in shared_coarse_inputs['entries']:
+        return hb.load_geotiff_chunk_by_cr_size(path, coarse_blocks_list).astype(np.float64)
+
+    shm = get_shared_memory(shared_coarse_inputs['name'])
+    offset, shape = shared_coarse_inputs['entries'][os.path.abspath(path)]
+    array = np.ndarray(tuple(shape), dtype=np.float64, buffer=shm.buf, offset=offset)
+    c, r, n_c, n_r = [int(i) for i in coarse_blocks_list[0:4]]
+    return array[r: r + n_r, c: c + n_c]
+
+
+def get_shared_memory(name):
+    """Return the shared memory segment called name, attaching to it (once per process) if this process didn't create it."""
+    if name in shared_coarse_inputs_owned:
+        return shared_coarse_inputs_owned[name]
+    if name not in shared_coarse_inputs_attached:
+        shm = shared_memory.SharedMemory(name=name)
+        # Only the creating process may unlink it, so stop this one's resource tracker from doing so when it exits.
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        shared_coarse_inputs_attached[name] = shm
+    return shared_coarse_inputs_attached[name]
+
+
+def create_shared_arrays(arrays):
+    """Copy each array of the dict arrays into one shared memory segment and return a small picklable descriptor of it,
+    from which attach_shared_arrays gives the same dict of arrays in another process without copying. The segment lives
+    until release_shared_arrays(descriptor) or the end of this process."""
+    entries = OrderedDict()
+    offset = 0
+    for key, array in arrays.items():
+        entries[key] = (offset, array.shape, np.dtype(array.dtype).str)
+        offset += array.nbytes + (-array.nbytes % 64)  # Keep each array 64-byte aligned.
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    shared_coarse_inputs_owned[shm.name] = shm
+    descriptor = {'name': shm.name, 'entries': entries}
+    for key, array in attach_shared_arrays(descriptor).items():
+        array[...] = arrays[key]
+    return descriptor
+
+
+def attach_shared_arrays(descriptor):
+    """Return the dict of arrays in the shared memory described by descriptor (see create_shared_arrays). The arrays are
+    views of the shared memory, so they must be treated as read-only."""
+    shm = get_shared_memory(descriptor['name'])
+    return OrderedDict((key, np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)) for key, (offset, shape, dtype) in descriptor['entries'].items())
+
+
+def release_shared_arrays(descriptor):
+    """Free the shared memory created by create_shared_arrays for descriptor."""
+    shm = shared_coarse_inputs_owned.pop(descriptor['name'], None)
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+# Inputs that are the same for every calibration candidate of a zone, set in each worker by init_calibration_candidate_worker.
+calibration_candidate_inputs = {}
+
+
+def init_calibration_candidate_worker(shared_arrays, constants):
+    """Initializer of the calibration candidate workers: attach to the shared arrays and keep them with the constants."""
+    from seals.seals_cython_functions import CalibrationLossFunction
+    calibration_candidate_inputs.clear()
+    calibration_candidate_inputs.update(attach_shared_arrays(shared_arrays))
+    calibration_candidate_inputs.update(constants)
+    calibration_candidate_inputs['loss_function'] = CalibrationLossFunction(calibration_candidate_inputs['lulc_baseline_array'], calibration_candidate_inputs['observed_lulc_array'],
+                                                                            list(calibration_candidate_inputs['change_class_labels']), calibration_candidate_inputs['loss_function_sigma'],
+                                                                            dtype=calibration_candidate_inputs['loss_function_dtype'])
+
+
+def calc_calibration_weighted_score(lulc_baseline_array, lulc_projected_array, overall_similarity_score):
+    """Return the weighted score calibration_zones ranks coefficients by: the number of cells that changed between
+    lulc_baseline_array and lulc_projected_array over the loss (overall_similarity_score) plus one."""
+    # TODOO Review this logic
+    new_array = lulc_baseline_array - lulc_projected_array
+    uniques = hb.enumerate_array_as_odict(new_array)
+    total_change = sum([v for k, v in uniques.items() if k != 0])
+    return total_change / (overall_similarity_score + 1)
+
+
+def evaluate_calibration_candidate(spatial_layer_coefficients_2d, call_string):
+    """Run calibrate_from_change_matrix for one candidate set of coefficients on the inputs of this worker and return its
+    calc_calibration_weighted_score. Reporting is off in the workers, as they would all write the same per-try files to
+    output_dir at once."""
+    from seals.seals_cython_functions import calibrate_from_change_matrix
+    inputs = calibration_candidate_inputs
+    overall_similarity_score, lulc_projected_array, overall_similarity_plot, class_similarity_scores, class_similarity_plots = \
+        calibrate_from_change_matrix(inputs['coarse_change_matrix_4d'],
+                                     inputs['lulc_baseline_array'],
+                                     inputs['spatial_layers_3d'],
+                                     spatial_layer_coefficients_2d,
+                                     inputs['spatial_layer_function_types_1d'],
+                                     inputs['valid_mask_array'],
+                                     inputs['change_class_labels'],
+                                     inputs['observed_lulc_array'],
+                                     inputs['hectares_per_grid_cell'],
+                                     inputs['output_dir'],
+                                     0,
+                                     inputs['loss_function_sigma'],
+                                     call_string,
+                                     loss_function=inputs['loss_function'])
+    return calc_calibration_weighted_score(inputs['lulc_baseline_array'], lulc_projected_array, overall_similarity_score)
+
+
+def evaluate_calibration_candidates_in_parallel(candidates, arrays, constants, num_workers):
+    """Return the evaluate_calibration_candidate score of each (spatial_layer_coefficients_2d, call_string) in candidates,
+    in order, computed by num_workers processes. The arrays (a dict of the read-only array inputs of
+    calibrate_from_change_matrix, by argument name) are put in shared memory once rather than copied to each worker."""
+    shared_arrays = create_shared_arrays(arrays)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=init_calibration_candidate_worker, initargs=(shared_arrays, constants)) as executor:
+            return list(executor.map(evaluate_calibration_candidate, [i[0] for i in candidates], [i[1] for i in candidates]))
+    finally:
+        release_shared_arrays(shared_arrays)
+
+
+def calc_candidate_suitabilities(spatial_layers_3d, candidate_coefficients_3d, spatial_layer_function_types_1d):
+    """Return the n_candidates x n_classes x rows x cols suitability of every candidate coefficient table in
+    candidate_coefficients_3d (n_candidates x n_classes x n_regressors), as seals_allocation_from_change_matrix builds it
+    before masking.
+
+    The additive part of all candidates and classes is one matrix product of the (n_candidates * n_classes) x
+    n_additive coefficients with the n_additive x pixels layers. A multiplicative layer scales the sum by
+    1 + (coefficient - 1) * layer, which is applied once per distinct row of multiplicative coefficients (in the sweep
+    these never change, so every candidate of a class shares one). Additive terms are summed in a different order than
+    the kernel does, so suitabilities match it to rounding rather than bit for bit."""
+    n_candidates, n_classes, n_regressors = candidate_coefficients_3d.shape
+    n_rows, n_cols = spatial_layers_3d.shape[1], spatial_layers_3d.shape[2]
+    layers_2d = spatial_layers_3d.reshape(n_regressors, n_rows * n_cols)
+    coefficients_2d = np.asarray(candidate_coefficients_3d, dtype=np.float64).reshape(n_candidates * n_classes, n_regressors)
+
+    additive_ids = np.flatnonzero(spatial_layer_function_types_1d == 2)
+    multiplicative_ids = np.flatnonzero(spatial_layer_function_types_1d == 1)
+
+    if len(additive_ids) > 0:
+        suitabilities = np.dot(coefficients_2d[:, additive_ids], layers_2d[additive_ids])
+    else:
+        suitabilities = np.zeros((n_candidates * n_classes, n_rows * n_cols), dtype=np.float64)
+
+    if len(multiplicative_ids) > 0:
+        multiplicative_rows, row_ids = np.unique(coefficients_2d[:, multiplicative_ids], axis=0, return_inverse=True)
+        row_ids = row_ids.reshape(-1)
+        for unique_row_id, multiplicative_row in enumerate(multiplicative_rows):
+            suitability_ids = np.flatnonzero(row_ids == unique_row_id)
+            for coefficient, regressor_k in zip(multiplicative_row, multiplicative_ids):
+                suitabilities[suitability_ids] *= 1.0 - ((coefficient - 1) * -1.0) * layers_2d[regressor_k]
+
+    return suitabilities.reshape(n_candidates, n_classes, n_rows, n_cols)
+
+
+def get_candidate_suitability_batch_size(n_classes, n_rows, n_cols, memory_budget_bytes=None):
+    """Return how many candidates calc_candidate_suitabilities can take at once for their float64 suitabilities to fit in
+    memory_budget_bytes (a quarter of the physical memory if None). At least one."""
+    if memory_budget_bytes is None:
+        physical_memory_bytes = get_physical_memory_bytes()
+        memory_budget_bytes = physical_memory_bytes // 4 if physical_memory_bytes else 4 * 1024 ** 3
+    return max(1, int(memory_budget_bytes // (n_classes * n_rows * n_cols * 8)))
+
+
+def minimize_with_nelder_mead(objective, x0, x0_value, step_size, max_evaluations, tolerance, rng):
+    """Nelder-Mead simplex search from x0, starting from a simplex with edges of step_size along each coordinate. Stops
+    when the simplex's values are within tolerance of each other (relative to the value at x0) and its vertices are
+    within tolerance * step_size, or after max_evaluations."""
+    x0 = np.asarray(x0, dtype=np.float64)
+    initial_simplex = np.vstack([x0, x0 + step_size * np.eye(len(x0))])
+    scipy.optimize.minimize(objective, x0, method='Nelder-Mead',
+                            options={'maxfev': max(1, max_evaluations), 'initial_simplex': initial_simplex, 'xatol': tolerance * step_size,
+                                     'fatol': tolerance * max(abs(x0_value), 1e-12)})
+
+
+def minimize_with_evolution_strategy(objective, x0, x0_value, step_size, max_evaluations, tolerance, rng):
+    """CMA-ES: sample a population around the mean from a multivariate normal whose covariance and step size adapt to
+    the successful steps (rank-one and rank-mu updates with cumulative step-size adaptation, Hansen's defaults). Starts
+    at x0 with a step size of step_size. Stops when the best value of the recent generations has stayed within
+    tolerance of the best (relative), when the step size falls below tolerance * step_size, or when the next population
+    would not fit in max_evaluations."""
+    mean = np.asarray(x0, dtype=np.float64)
+    n = len(mean)
+    n_population = 4 + int(3 * math.log(n))
+    n_parents = n_population // 2
+    weights = math.log(n_parents + 0.5) - np.log(np.arange(1, n_parents + 1))
+    weights /= np.sum(weights)
+    mu_eff = 1.0 / np.sum(weights ** 2)
+
+    c_c = (4 + mu_eff / n) / (n + 4 + 2 * mu_eff / n)
+    c_sigma = (mu_eff + 2) / (n + mu_eff + 5)
+    c_1 = 2 / ((n + 1.3) ** 2 + mu_eff)
+    c_mu = min(1 - c_1, 2 * (mu_eff - 2 + 1 / mu_eff) / ((n + 2) ** 2 + mu_eff))
+    d_sigma = 1 + 2 * max(0, math.sqrt((mu_eff - 1) / (n + 1)) - 1) + c_sigma
+    expected_norm = math.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+    sigma = float(step_size)
+    p_c = np.zeros(n)
+    p_sigma = np.zeros(n)
+    covariance = np.eye(n)
+    eigenvectors = np.eye(n)
+    eigenvalue_roots = np.ones(n)
+    n_history = 10 + int(math.ceil(30 * n / n_population))
+    best_values = []
+
+    n_evaluations = 0
+    generation = 0
+    while n_evaluations + n_population <= max_evaluations:
+        z = rng.standard_normal((n_population, n))
+        y = (z * eigenvalue_roots) @ eigenvectors.T
+        population = mean + sigma * y
+        values = np.array([objective(x) for x in population])
+        n_evaluations += n_population
+        generation += 1
+
+        order = np.argsort(values)
+        best_values.append(values[order[0]])
+        y_parents = y[order[:n_parents]]
+        y_mean = weights @ y_parents
+        mean = mean + sigma * y_mean
+
+        inverse_root_y_mean = eigenvectors @ ((eigenvectors.T @ y_mean) / eigenvalue_roots)
+        p_sigma = (1 - c_sigma) * p_sigma + math.sqrt(c_sigma * (2 - c_sigma) * mu_eff) * inverse_root_y_mean
+        h_sigma = np.linalg.norm(p_sigma) / math.sqrt(1 - (1 - c_sigma) ** (2 * generation)) / expected_norm < 1.4 + 2 / (n + 1)
+        p_c = (1 - c_c) * p_c + h_sigma * math.sqrt(c_c * (2 - c_c) * mu_eff) * y_mean
+        covariance = ((1 - c_1 - c_mu) * covariance
+                      + c_1 * (np.outer(p_c, p_c) + (1 - h_sigma) * c_c * (2 - c_c) * covariance)
+                      + c_mu * (y_parents.T * weights) @ y_parents)
+        sigma *= math.exp((c_sigma / d_sigma) * (np.linalg.norm(p_sigma) / expected_norm - 1))
+
+        covariance = np.triu(covariance) + np.triu(covariance, 1).T
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        eigenvalue_roots = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+        recent_best_values = best_values[-n_history:]
+        if len(recent_best_values) == n_history and max(recent_best_values) - min(recent_best_values) <= tolerance * max(abs(min(best_values)), 1e-12):
+            break
+        if sigma * np.max(eigenvalue_roots) < tolerance * step_size:
+            break
+
+
+def minimize_with_golden_section(objective, x0, x0_value, step_size, max_evaluations, tolerance, rng):
+    """Coordinate descent with a golden-section line search on each coordinate over +/- the step size, which is halved
+    after each pass over the coordinates. A coordinate only moves if the point found beats the current one, since the
+    objective needn't be unimodal along it. Stops when a pass improves by no more than tolerance (relative), when the
+    step size falls below tolerance * step_size, or after max_evaluations."""
+    inverse_golden_ratio = (math.sqrt(5) - 1) / 2
+    x = np.asarray(x0, dtype=np.float64).copy()
+    value = x0_value
+    n_evaluations = 0
+    current_step_size = float(step_size)
+
+    def objective_at(coordinate, position):
+        x_try = x.copy()
+        x_try[coordinate] = position
+        return objective(x_try)
+
+    while n_evaluations < max_evaluations and current_step_size >= tolerance * step_size:
+        pass_starting_value = value
+        for coordinate in range(len(x)):
+            low, high = x[coordinate] - current_step_size, x[coordinate] + current_step_size
+            inner_low = high - inverse_golden_ratio * (high - low)
+            inner_high = low + inverse_golden_ratio * (high - low)
+            inner_low_value, inner_high_value = objective_at(coordinate, inner_low), objective_at(coordinate, inner_high)
+            n_evaluations += 2
+            while high - low > tolerance * step_size and n_evaluations < max_evaluations:
+                if inner_low_value < inner_high_value:
+                    high, inner_high, inner_high_value = inner_high, inner_low, inner_low_value
+                    inner_low = high - inverse_golden_ratio * (high - low)
+                    inner_low_value = objective_at(coordinate, inner_low)
+                else:
+                    low, inner_low, inner_low_value = inner_low, inner_high, inner_high_value
+                    inner_high = low + inverse_golden_ratio * (high - low)
+                    inner_high_value = objective_at(coordinate, inner_high)
+                n_evaluations += 1
+            if min(inner_low_value, inner_high_value) < value:
+                value = min(inner_low_value, inner_high_value)
+                x[coordinate] = inner_low if inner_low_value < inner_high_value else inner_high
+            if n_evaluations >= max_evaluations:
+                return
+        if pass_starting_value - value <= tolerance * max(abs(pass_starting_value), 1e-12):
+            return
+        current_step_size /= 2
+
+
+# Optimizers minimize_calibration_objective can use, by name. Each is called with (objective, x0, x0_value, step_size,
+# max_evaluations, tolerance, rng), where x0 has already been evaluated to x0_value, and only needs to search: the best
+# point it evaluates is tracked for it.
+calibration_optimizers = {
+    'nelder_mead': minimize_with_nelder_mead,
+    'evolution_strategy': minimize_with_evolution_strategy,
+    'golden_section': minimize_with_golden_section,
+}
+
+
+def minimize_calibration_objective(objective, x0, optimizer, step_size, max_evaluations, tolerance, seed=0):
+    """Minimize objective (a function of a 1d coefficient vector) from x0 with the named optimizer of
+    calibration_optimizers, calling objective at most max_evaluations times. Returns the best point evaluated, its value
+    and the number of evaluations. x0 is evaluated first, so the point returned is never worse than x0, and optimizers
+    that evaluate x0 again get its value without another call. Calls past the budget return inf without evaluating, so
+    an optimizer that overshoots its budget sees them as failures."""
+    if optimizer not in calibration_optimizers:
+        raise NameError('Unknown calibration optimizer ' + str(optimizer) + '. Use one of ' + str(list(calibration_optimizers)) + '.')
+    x0 = np.asarray(x0, dtype=np.float64).copy()
+    x0_value = objective(x0.copy())
+    state = {'n_evaluations': 1, 'best_x': x0.copy(), 'best_value': x0_value}
+
+    def budgeted_objective(x):
+        x = np.asarray(x, dtype=np.float64)
+        if np.array_equal(x, x0):
+            return x0_value
+        if state['n_evaluations'] >= max_evaluations:
+            return np.inf
+        state['n_evaluations'] += 1
+        value = objective(x.copy())
+        if value < state['best_value']:
+            state['best_x'] = x.copy()
+            state['best_value'] = value
+        return value
+
+    calibration_optimizers[optimizer](budgeted_objective, x0.copy(), x0_value, step_size, max_evaluations - 1, tolerance, np.random.default_rng(seed))
+    return state['best_x'], state['best_value'], state['n_evaluations']
+
+
+def get_calibration_evaluation_cache_path(calibration_zone_dir):
+    """Return the path of the evaluation cache of a calibration zone, which lives in its calibration_zones dir."""
+    return os.path.join(calibration_zone_dir, 'calibration_evaluation_cache.jsonl')
+
+
+def get_calibration_evaluation_settings_key(zone_id, spatial_layer_names, spatial_layer_paths, spatial_layer_types, loss_settings):
+    """Return the sha1 hex digest of everything other than the coefficients that a calibration score depends on: the zone,
+    the regressors (name, path, type and, where the file exists, its size and modification time, so that regenerated
+    regressors don't reuse old scores) and the loss settings (a dict of json-serializable values, which should also hold
+    everything else the score depends on, e.g. a get_paths_fingerprint of the training lulc and change matrix files)."""
+    regressors = [[str(name), str(path), str(layer_type)] for name, path, layer_type in zip(spatial_layer_names, spatial_layer_paths, spatial_layer_types)]
+    settings = {'zone_id': str(zone_id), 'regressors': regressors, 'regressor_files': get_paths_fingerprint(spatial_layer_paths), 'loss_settings': loss_settings}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_calibration_evaluation_key(settings_key, spatial_layer_coefficients_2d):
+    """Return the cache key of scoring spatial_layer_coefficients_2d under settings_key (see
+    get_calibration_evaluation_settings_key): the sha1 hex digest of the settings key, the shape and the float64 bytes of
+    the coefficients, with -0.0 counted as 0.0."""
+    coefficients = np.ascontiguousarray(spatial_layer_coefficients_2d, dtype=np.float64) + 0.0
+    hasher = hashlib.sha1(settings_key.encode())
+    hasher.update(str(coefficients.shape).encode())
+    hasher.update(coefficients.tobytes())
+    return hasher.hexdigest()
+
+
+def append_to_calibration_evaluation_cache(cache_path, key, score):
+    """Append the score of a calibration evaluation to the cache at cache_path as one json line, written with a single
+    os.write in append mode like append_to_completion_ledger, so a crash can at worst leave a truncated last line."""
+    fd = os.open(cache_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps({'key': key, 'score': float(score)}) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def read_calibration_evaluation_cache(cache_path):
+    """Return a dict of cache key to score from the cache at cache_path, empty if there is none. Lines that don't parse
+    (e.g. cut short by a crash) are skipped."""
+    cache = {}
+    if not os.path.exists(cache_path):
+        return cache
+    with open(cache_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                cache[record['key']] = record['score']
+            except (ValueError, KeyError, TypeError):
+                continue
+    return cache
+
+
+def get_completion_ledger_path(allocation_zones_dir):
+    """Return the path of the completion ledger of a scenario and year, which lives in its allocation_zones dir."""
+    return os.path.join(allocation_zones_dir, 'completion_ledger.jsonl')
+
+
+def get_file_signature(path):
+    """Return [size in bytes, mtime] of the file at path, or None if it doesn't exist. Cheap enough to check for every
+    tile, unlike a checksum, and enough to notice an output that was deleted, rewritten or cut short."""
+    if not os.path.exists(path):
+        return None
+    return [os.path.getsize(path), os.path.getmtime(path)]
+
+
+def get_file_checksum(path):
+    """Return the sha1 hex digest of the file at path, read in 1 MB chunks."""
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_peak_memory_mb():
+    """Return the peak resident memory of this process in MB, or None where the resource module doesn't exist (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # Bytes on macOS, kilobytes elsewhere.
+        return peak / 1048576.0
+    return peak / 1024.0
+
+
+def append_to_completion_ledger(ledger_path, block_id, year, output_paths, wall_time):
+    """Append a record that block_id finished allocating year, with the size, mtime and sha1 of each of its outputs
+    ([size, mtime, sha1] by path relative to the ledger), the wall time and the peak memory of the worker. Must only be called once the outputs are fully written. Each record
+    is a single line written with one os.write in append mode, so records from parallel workers don't interleave and a
+    crash can at worst leave a truncated last line, which read_completion_ledger ignores."""
+    ledger_dir = os.path.dirname(ledger_path)
+    record = OrderedDict()
+    record['block_id'] = block_id
+    record['year'] = int(year)
+    record['outputs'] = OrderedDict((os.path.relpath(path, ledger_dir).replace('\\', '/'), get_file_signature(path) + [get_file_checksum(path)]) for path in output_paths)
+    record['wall_time'] = round(wall_time, 3)
+    record['peak_memory_mb'] = get_peak_memory_mb()
+    record['finished_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    fd = os.open(ledger_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def read_completion_ledger(ledger_path, verify_checksums=False):
+    """Return an OrderedDict of block_id to its latest ledger record, with the output paths made absolute, or None if
+    there is no ledger at ledger_path. Lines that don't parse (e.g. cut short by a crash) are skipped, and so are blocks
+    whose outputs no longer match the size and mtime recorded for them, so they get allocated again. With
+    verify_checksums, the sha1 of every output is also checked, which catches changes that keep the size and mtime
+    but reads all the outputs in full."""
+    if not os.path.exists(ledger_path):
+        return None
+    ledger_dir = os.path.dirname(ledger_path)
+    completed = OrderedDict()
+    with open(ledger_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            record['outputs'] = OrderedDict((os.path.join(ledger_dir, path), recorded) for path, recorded in record['outputs'].items())
+            completed.pop(record['block_id'], None)
+            completed[record['block_id']] = record
+
+    def is_unchanged(path, recorded):
+        if not isinstance(recorded, list) or len(recorded) != 3 or get_file_signature(path) != recorded[0:2]:
+            return False
+        return not verify_checksums or get_file_checksum(path) == recorded[2]
+
+    for block_id, record in list(completed.items()):
+        if not all(is_unchanged(path, recorded) for path, recorded in record['outputs'].items()):
+            del completed[block_id]
+    return completed
+
+
+def record_tile_completion(p, ledger_path, block_id, year, output_paths, start_time):
+    """Same as append_to_completion_ledger, but queued with run_tile_write behind the outputs it describes, so it is
+    only written once they are."""
+    run_tile_write(p, append_to_completion_ledger, ledger_path, block_id, year, output_paths, time.time() - start_time)
+
+
+@contextlib.contextmanager
+def exclusive_file_lock(lock_path):
+    """Hold an exclusive lock on lock_path (created if needed) for the duration of the with block, across processes."""
+    with open(lock_path, 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError: # LK_LOCK gives up after 10 seconds.
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def get_live_mosaic_path(allocation_zones_dir, lulc_filename):
+    """Return the path of the live mosaic the allocation tiles named lulc_filename in allocation_zones_dir are written to."""
+    return hb.suri(os.path.join(allocation_zones_dir, lulc_filename), 'live_mosaic')
+
+
+def get_live_mosaic_base_path(p):
+    """Return the base year lulc the stitched maps of the current scenario are stamped on, which also defines the grid of
+    its live mosaics: the global map if force_to_global_bb, otherwise the one in fine_processed_inputs."""
+    baseline_filename = 'lulc_' + p.lulc_src_label + '_' + p.lulc_simplification_label + '_' + str(p.key_base_year) + '.tif'
+    if p.force_to_global_bb:
+        return p.get_path('lulc', p.lulc_src_label, p.lulc_simplification_label, baseline_filename)
+    else:
+        return p.get_path(os.path.join('lulc', p.lulc_src_label, p.lulc_simplification_label, baseline_filename), prepend_possible_dirs=p.fine_processed_inputs_dir)
+
+
+def write_tile_to_live_mosaic(live_mosaic_path, base_path, tile_path):
+    """Write the finished allocation tile at tile_path into its window of the live mosaic, creating the mosaic on the grid
+    of base_path the first time. The mosaic is an uncompressed, tiled, sparse GeoTIFF so that windows are written in
+    place and only the blocks that get tiles take space; parallel workers take turns through a lock file. Each written
+    tile is appended to the .tiles file next to the mosaic."""
+    with exclusive_file_lock(live_mosaic_path + '.lock'):
+        if not os.path.exists(live_mosaic_path):
+            base_ds = gdal.OpenEx(base_path, gdal.OF_RASTER)
+            driver = gdal.GetDriverByName('GTiff')
+            live_mosaic_ds = driver.Create(live_mosaic_path, base_ds.RasterXSize, base_ds.RasterYSize, 1, gdal.GDT_Byte,
+                                           options=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'SPARSE_OK=TRUE', 'BIGTIFF=IF_SAFER'])
+            live_mosaic_ds.SetGeoTransform(base_ds.GetGeoTransform())
+            live_mosaic_ds.SetProjection(base_ds.GetProjection())
+            live_mosaic_ds.GetRasterBand(1).SetNoDataValue(255)
+            live_mosaic_ds = None
+            base_ds = None
+
+        tile_ds = gdal.OpenEx(tile_path, gdal.OF_RASTER)
+        tile_array = tile_ds.GetRasterBand(1).ReadAsArray()
+        tile_gt = tile_ds.GetGeoTransform()
+        tile_ds = None
+
+        live_mosaic_ds = gdal.OpenEx(live_mosaic_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+        live_mosaic_gt = live_mosaic_ds.GetGeoTransform()
+        c = int(round((tile_gt[0] - live_mosaic_gt[0]) / live_mosaic_gt[1]))
+        r = int(round((tile_gt[3] - live_mosaic_gt[3]) / live_mosaic_gt[5]))
+
+        # Parts of the tile outside the base map are dropped, as they would be when stamping it on the base map.
+        c_start, r_start = max(c, 0), max(r, 0)
+        c_end = min(c + tile_array.shape[1], live_mosaic_ds.RasterXSize)
+        r_end = min(r + tile_array.shape[0], live_mosaic_ds.RasterYSize)
+        if c_end > c_start and r_end > r_start:
+            live_mosaic_ds.GetRasterBand(1).WriteArray(tile_array[r_start - r: r_end - r, c_start - c: c_end - c], c_start, r_start)
+        live_mosaic_ds.FlushCache()
+        live_mosaic_ds = None
+
+        with open(live_mosaic_path + '.tiles', 'a') as f:
+            f.write(os.path.abspath(tile_path) + '\n')
+
+
+def finalize_live_mosaic(live_mosaic_path, base_path, tile_paths, output_path):
+    """Write the stitched map at output_path as a COG with overviews, in one pass over the base map with the live mosaic
+    on top. Any of tile_paths not yet in the mosaic (e.g. finished before the live mosaic was used) is written first.
+    The live mosaic and its .tiles and .lock files are removed afterwards."""
+    written_tile_paths = set()
+    if os.path.exists(live_mosaic_path + '.tiles'):
+        with open(live_mosaic_path + '.tiles') as f:
+            written_tile_paths = set(line.strip() for line in f)
+    for tile_path in tile_paths:
+        if os.path.abspath(tile_path) not in written_tile_paths:
+            write_tile_to_live_mosaic(live_mosaic_path, base_path, tile_path)
+
+    # Where the mosaic has no tile it is 255, which lets the base map show through.
+    vrt_path = hb.replace_ext(output_path, '.vrt')
+    vrt_ds = gdal.BuildVRT(vrt_path, [base_path, live_mosaic_path], srcNodata=255, VRTNodata=255)
+    vrt_ds = None
+    gdal.Translate(output_path, vrt_path, format='COG', creationOptions=['COMPRESS=ZSTD', 'BLOCKSIZE=512', 'BIGTIFF=IF_SAFER', 'RESAMPLING=MODE', 'NUM_THREADS=ALL_CPUS'])
+
+    for path in [vrt_path, live_mosaic_path, live_mosaic_path + '.tiles', live_mosaic_path + '.lock']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+
+def write_lulc_preprocessing_in_one_pass(src_path, bb, simplification_rules, clipped_path=None, simplified_path=None, binary_class_ids_by_path=None, n_rows_per_strip=1024, num_threads=4):
+    """Read the source lulc at src_path once, within bb ([xmin, ymin, xmax, ymax], or None for all of it), and write any
+    of the clipped lulc, the lulc simplified with simplification_rules (through a uint8 lookup table) and the 0/1 binary
+    of each simplified class id in binary_class_ids_by_path ({output_path: class_id}) in the same pass. Strips of
+    n_rows_per_strip rows are read and reclassified by num_threads threads and written in order. Each output is written
+    to a temporary file that is only moved into place once complete.
+
+    The clipped lulc keeps the data type and nodata value of the source. A source that isn't Byte can still be
+    simplified as long as its valid values are between 0 and 255 (its nodata becomes the simplified nodata, 255);
+    otherwise a NameError is raised and no output is written."""
+    binary_class_ids_by_path = binary_class_ids_by_path or {}
+    lookup_table = rules_to_uint8_lookup_table(simplification_rules)
+
+    src_ds = gdal.OpenEx(src_path, gdal.OF_RASTER)
+    src_gt = src_ds.GetGeoTransform()
+    projection = src_ds.GetProjection()
+    src_ndv = src_ds.GetRasterBand(1).GetNoDataValue()
+    src_data_type = src_ds.GetRasterBand(1).DataType
+    if bb is None:
+        c_start, r_start, n_c, n_r = 0, 0, src_ds.RasterXSize, src_ds.RasterYSize
+    else:
+        c_start = max(int(round((bb[0] - src_gt[0]) / src_gt[1])), 0)
+        r_start = max(int(round((bb[3] - src_gt[3]) / src_gt[5])), 0)
+        n_c = min(int(round((bb[2] - src_gt[0]) / src_gt[1])), src_ds.RasterXSize) - c_start
+        n_r = min(int(round((bb[1] - src_gt[3]) / src_gt[5])), src_ds.RasterYSize) - r_start
+    src_ds = None
+    output_gt = (src_gt[0] + c_start * src_gt[1], src_gt[1], 0.0, src_gt[3] + r_start * src_gt[5], 0.0, src_gt[5])
+
+    # (final path, gdal data type, ndv, function of the source and simplified strips giving the output strip)
+    outputs = []
+    if clipped_path is not None:
+        outputs.append((clipped_path, src_data_type, src_ndv, lambda src, simplified: src))
+    if simplified_path is not None:
+        outputs.append((simplified_path, gdal.GDT_Byte, 255, lambda src, simplified: simplified))
+    for binary_path, class_id in binary_class_ids_by_path.items():
+        outputs.append((binary_path, gdal.GDT_Byte, None, lambda src, simplified, class_id=class_id: (simplified == class_id).astype(np.uint8)))
+
+    driver = gdal.GetDriverByName('GTiff')
+    temp_suffix = '_' + str(os.getpid()) + '.tif'
+    output_dss = []
+    for path, data_type, ndv, function in outputs:
+        hb.create_directories(os.path.dirname(path))
+        ds = driver.Create(os.path.splitext(path)[0] + temp_suffix, n_c, n_r, 1, data_type, options=hb.DEFAULT_GTIFF_CREATION_OPTIONS)
+        ds.SetGeoTransform(output_gt)
+        ds.SetProjection(projection)
+        if ndv is not None:
+            ds.GetRasterBand(1).SetNoDataValue(ndv)
+        output_dss.append(ds)
+
+    read_src = make_threaded_window_reader(src_path)
+
+    def read_strip(strip_r):
+        strip_n_r = min(n_rows_per_strip, n_r - strip_r)
+        src = read_src(c_start, r_start + strip_r, n_c, strip_n_r)
+        if src.dtype == np.uint8:
+            simplified = lookup_table[src]
+        else:
+            valid = src != src_ndv if src_ndv is not None else np.ones(src.shape, dtype=bool)
+            if np.any((src[valid] < 0) | (src[valid] > 255)):
+                raise NameError('Can only simplify lulc values from 0 to 255 through a uint8 lookup table, but ' + src_path + ' has values outside that range.')
+            simplified = lookup_table[np.where(valid, src, 0).astype(np.uint8)]
+            simplified[~valid] = 255
+        return strip_r, [function(src, simplified) for path, data_type, ndv, function in outputs]
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            # Keep only a few strips ahead of the writer so memory stays bounded.
+            strip_rs = list(range(0, n_r, n_rows_per_strip))
+            futures = [executor.submit(read_strip, strip_r) for strip_r in strip_rs[0:2 * num_threads]]
+            next_strip = len(futures)
+            while futures:
+                strip_r, strip_arrays = futures.pop(0).result()
+                if next_strip < len(strip_rs):
+                    futures.append(executor.submit(read_strip, strip_rs[next_strip]))
+                    next_strip += 1
+                for ds, array in zip(output_dss, strip_arrays):
+                    ds.GetRasterBand(1).WriteArray(array, 0, strip_r)
+    except Exception:
+        output_dss = None
+        for path, data_type, ndv, function in outputs:
+            if os.path.exists(os.path.splitext(path)[0] + temp_suffix):
+                os.remove(os.path.splitext(path)[0] + temp_suffix)
+        raise
+
+    for ds in output_dss:
+        ds.FlushCache()
+    output_dss = None
+    for path, data_type, ndv, function in outputs:
+        os.replace(os.path.splitext(path)[0] + temp_suffix, path)
+
+# Rough peak memory of one compression context by codec, per compression thread.
+cog_codec_memory_bytes = {'ZSTD': 64 * 1024 ** 2, 'LZMA': 128 * 1024 ** 2, 'DEFLATE': 2 * 1024 ** 2, 'LZW': 2 * 1024 ** 2, 'NONE': 0}
+
+
+def estimate_cog_conversion_memory(path, codec='ZSTD', block_size=512, gdal_cache_bytes=256 * 1024 ** 2):
+    """Return an estimate in bytes of the peak memory of converting path to a COG with convert_path_to_cog. GDAL streams
+    the conversion a row of blocks at a time, so it is the GDAL block cache, a few rows of blocks of the full
+    resolution, two rows of blocks per overview level (each half the size of the last) and the codec's context."""
+    ds = gdal.OpenEx(path, gdal.OF_RASTER)
+    n_cols, n_rows, n_bands = ds.RasterXSize, ds.RasterYSize, ds.RasterCount
+    bytes_per_pixel = gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8
+    ds = None
+
+    block_row_bytes = n_cols * block_size * bytes_per_pixel * n_bands
+    n_overviews = max(0, int(math.ceil(math.log2(max(n_cols, n_rows) / float(block_size)))))
+    overview_bytes = sum(2 * block_row_bytes / 2 ** level for level in range(1, n_overviews + 1))
+    return int(gdal_cache_bytes + 3 * block_row_bytes + overview_bytes + cog_codec_memory_bytes.get(codec.upper(), cog_codec_memory_bytes['ZSTD']))
+
+
+def convert_path_to_cog(path, codec='ZSTD', block_size=512, gdal_cache_bytes=256 * 1024 ** 2, resampling='MODE'):
+    """Rewrite the GeoTIFF at path in place as a COG with overviews, unless it already is one. The GDAL block cache of
+    this process is capped at gdal_cache_bytes so the conversion stays within estimate_cog_conversion_memory."""
+    ds = gdal.OpenEx(path, gdal.OF_RASTER)
+    layout = ds.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE')
+    ds = None
+    if layout == 'COG':
+        return
+
+    gdal.SetCacheMax(int(gdal_cache_bytes))
+    temp_path = os.path.splitext(path)[0] + '_cog_' + str(os.getpid()) + '.tif'
+    gdal.Translate(temp_path, path, format='COG', creationOptions=['COMPRESS=' + codec, 'BLOCKSIZE=' + str(block_size), 'BIGTIFF=IF_SAFER', 'RESAMPLING=' + resampling, 'NUM_THREADS=1'])
+    os.replace(temp_path, path)
+
+
+def get_physical_memory_bytes():
+    """Return the physical memory of this machine in bytes, or None where it can't be found without extra packages."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def convert_paths_to_cogs_within_memory_budget(paths, memory_budget_bytes=None, max_workers=16, codec='ZSTD', block_size=512, gdal_cache_bytes=256 * 1024 ** 2):
+    """Convert each of paths to a COG with convert_path_to_cog in parallel processes, starting a conversion only while
+    the estimated peak memory of the running ones (see estimate_cog_conversion_memory) fits in memory_budget_bytes, and
+    never more than max_workers at once. Larger rasters are started first and smaller ones fill the remaining budget; a
+    raster that doesn't fit the budget on its own still runs, alone. If memory_budget_bytes is None, half the physical
+    memory is used (8 GB if it can't be found)."""
+    if memory_budget_bytes is None:
+        physical_memory_bytes = get_physical_memory_bytes()
+        memory_budget_bytes = physical_memory_bytes / 2 if physical_memory_bytes is not None else 8 * 1024 ** 3
+    pending = sorted([(estimate_cog_conversion_memory(path, codec, block_size, gdal_cache_bytes), path) for path in paths], reverse=True)
+    hb.log('Converting ' + str(len(pending)) + ' rasters to COGs within a memory budget of ' + str(round(memory_budget_bytes / 1024 ** 3, 1)) + ' GB.')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+        running = {}
+        while pending or running:
+            i = 0
+            while i < len(pending) and len(running) < max_workers:
+                estimated_bytes, path = pending[i]
+                if len(running) == 0 or sum(running.values()) + estimated_bytes <= memory_budget_bytes:
+                    running[executor.submit(convert_path_to_cog, path, codec, block_size, gdal_cache_bytes)] = estimated_bytes
+                    pending.pop(i)
+                else:
+                    i += 1
+            done, _ = concurrent.futures.wait(list(running.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                future.result()
+
+
 def load_blocks_list(p, input_dir):
     possible_prefixes = [
         "coarse_",
@@ -73,9 +73,255 @@ class TestSEALS(unittest.TestCase):
             required_result_path = os.path.join(p.stitched_lulc_simplified_scenarios_dir, 'lulc_esa_seals7_ssp2_rcp45_luh2-message_bau_shift_2050.tif')
             result = hb.path_exists(required_result_path)
             self.assertTrue(result)
-            
 
-    
+    def test_compact_allocation_matches_float64(self):
+        """Check that the compact-dtype allocation (uint8 lulc and masks, float32 regressors) matches the float64 one within tolerance."""
+        import numpy as np
+        from seals import seals_cython_functions
+
+        rng = np.random.default_rng(0)
+        n_coarse_r, n_coarse_c, resolution = 6, 8, 30
+        n_r, n_c = n_coarse_r * resolution, n_coarse_c * resolution
+        changing_class_indices = np.array([1, 2, 3, 4], dtype=np.int64)
+        changing_class_labels = ['urban', 'cropland', 'grassland', 'forest']
+
+        lulc = rng.integers(1, 8, (n_r, n_c)).astype(np.int64)
+        spatial_layers_3d = rng.random((4, n_r, n_c))
+        spatial_layers_3d[3] = (rng.random((n_r, n_c)) > 0.1).astype(np.float64)
+        spatial_layer_function_types_1d = np.array([2, 2, 2, 1], dtype=np.int64)
+        spatial_layer_coefficients_2d = rng.normal(size=(4, 4))
+        spatial_layer_coefficients_2d[:, 3] = [0, 1, 1, 0]
+        valid_mask_array = (rng.random((n_r, n_c)) > 0.05).astype(np.int64)
+        hectares_per_grid_cell = np.repeat(rng.uniform(50, 80, (n_r, 1)), n_c, axis=1)
+        coarse_change_3d = rng.uniform(-5000, 10000, (4, n_coarse_r, n_coarse_c))
+
+        def allocate(lulc, spatial_layers_3d, valid_mask_array):
+            return seals_cython_functions.seals_allocation_gridded_input(coarse_change_3d, lulc, spatial_layers_3d, spatial_layer_coefficients_2d,
+                                                                         spatial_layer_function_types_1d, valid_mask_array, changing_class_indices,
+                                                                         changing_class_labels, hectares_per_grid_cell, '', 0.0, np.int64(0), '', '')
+
+        projected_float64, change_arrays_float64, change_happened_float64 = allocate(lulc, spatial_layers_3d, valid_mask_array)
+        projected_compact, change_arrays_compact, change_happened_compact = allocate(lulc.astype(np.uint8), spatial_layers_3d.astype(np.float32), valid_mask_array.astype(np.uint8))
+
+        self.assertEqual(projected_compact.dtype, np.uint8)
+        self.assertLess(np.mean(projected_compact != projected_float64), 0.001)
+        for i in range(len(changing_class_indices)):
+            hectares_float64 = np.sum(hectares_per_grid_cell * change_arrays_float64[i])
+            hectares_compact = np.sum(hectares_per_grid_cell * change_arrays_compact[i])
+            self.assertAlmostEqual(hectares_compact, hectares_float64, delta=0.001 * hectares_float64 + 100.0)
+
+    def test_calibration_optimizers_never_worse_than_start(self):
+        """Check that no calibration optimizer returns a point worse than the one it started from, or exceeds its budget."""
+        import numpy as np
+        from seals import seals_utils
+
+        def objective(x):
+            return float(np.sum((x - 1.0) ** 2))
+
+        for optimizer in seals_utils.calibration_optimizers:
+            for x0 in [np.ones(6), np.zeros(6)]:
+                best_x, best_value, n_evaluations = seals_utils.minimize_calibration_objective(objective, x0, optimizer, 1.0, 20, 0.01)
+                self.assertLessEqual(best_value, objective(x0))
+                self.assertAlmostEqual(best_value, objective(best_x))
+                self.assertLessEqual(n_evaluations, 20)
+
+    def test_sum_of_gaussians_filter_matches_fft(self):
+        """Check that sum_of_gaussians_filter is within the default sum_of_gaussians_convolution_tolerance of the FFT
+        convolution with the kernel it fits, and that the recursive gaussian_filter_1d matches an exact gaussian."""
+        import numpy as np
+        import scipy.ndimage
+        import scipy.signal
+        from seals import seals_utils
+
+        rng = np.random.default_rng(0)
+        signal = (rng.random((256, 256)) > 0.7).astype(np.float64)
+        for halflife in [1, 2, 5, 10, 20]:
+            kernel = seals_utils.get_array_from_two_dim_first_order_kernel_function(int(9 * halflife), 1.0, halflife)
+            kernel_terms, _ = seals_utils.get_sum_of_gaussians_kernel_terms(kernel, halflife)
+            expected = scipy.signal.fftconvolve(signal, kernel, 'full')[kernel.shape[0] // 2: kernel.shape[0] // 2 + signal.shape[0], kernel.shape[1] // 2: kernel.shape[1] // 2 + signal.shape[1]]
+            filtered = seals_utils.sum_of_gaussians_filter(signal, kernel_terms)
+            self.assertLess(np.max(np.abs(filtered - expected)) / np.max(np.abs(expected)), 0.01)
+
+        impulse = np.zeros(601)
+        impulse[300] = 1.0
+        for sigma in [3.0, 5.0, 10.0, 30.0]:
+            radius = int(np.ceil(12 * sigma))
+            weights = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma ** 2))
+            expected = scipy.ndimage.correlate1d(impulse, weights / np.sum(weights), mode='constant', cval=0.0)
+            filtered = seals_utils.gaussian_filter_1d(impulse, sigma, 0)
+            self.assertLess(np.max(np.abs(filtered - expected)) / np.max(expected), 0.005)
+
+    def test_coarse_change_matrices_match_per_cell_count(self):
+        """Check calc_coarse_change_matrices against a per-cell count, with a partial last band, classes that aren't
+        tracked and more from-to codes than fit in a byte, and that the net change and full change matrix derived from
+        it index classes by their position in classes_that_might_change."""
+        import shutil, tempfile
+        import numpy as np
+        from osgeo import gdal
+        from seals import seals_utils
+
+        rng = np.random.default_rng(0)
+        n_coarse_rows, n_coarse_cols, fine_cells_per_coarse_side = 5, 4, 6
+        n_r, n_c = n_coarse_rows * fine_cells_per_coarse_side, n_coarse_cols * fine_cells_per_coarse_side
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for classes_that_might_change in [[2, 5, 7], list(range(1, 40, 2))]:
+                lulc_arrays = [rng.integers(0, 41, (n_r, n_c)).astype(np.uint8) for i in range(2)]
+                lulc_paths = [os.path.join(temp_dir, 'lulc_' + str(i) + '.tif') for i in range(2)]
+                for lulc_array, lulc_path in zip(lulc_arrays, lulc_paths):
+                    ds = gdal.GetDriverByName('GTiff').Create(lulc_path, n_c, n_r, 1, gdal.GDT_Byte)
+                    ds.GetRasterBand(1).WriteArray(lulc_array)
+                    ds = None
+
+                # Bands of two coarse rows, so the last of the five is a band of its own.
+                change_matrices = seals_utils.calc_coarse_change_matrices(lulc_paths[0], lulc_paths[1], classes_that_might_change, n_coarse_rows, n_coarse_cols,
+                                                                          fine_cells_per_coarse_side, max_fine_cells_per_band=2 * n_c * fine_cells_per_coarse_side, num_threads=2)
+
+                n_classes = len(classes_that_might_change)
+                positions = {class_id: i for i, class_id in enumerate(classes_that_might_change)}
+                expected = np.zeros((n_coarse_rows, n_coarse_cols, n_classes, n_classes), dtype=np.int64)
+                for r in range(n_r):
+                    for c in range(n_c):
+                        if lulc_arrays[0][r, c] in positions and lulc_arrays[1][r, c] in positions:
+                            expected[r // fine_cells_per_coarse_side, c // fine_cells_per_coarse_side, positions[lulc_arrays[0][r, c]], positions[lulc_arrays[1][r, c]]] += 1
+                self.assertTrue(np.array_equal(change_matrices, expected))
+
+                ha_per_fine_cell = rng.uniform(1.0, 2.0, (n_coarse_rows, n_coarse_cols))
+                net_change = seals_utils.calc_net_change_of_change_matrices(change_matrices, ha_per_fine_cell)
+                full_change_matrix = seals_utils.get_full_change_matrix(change_matrices)
+                for coarse_r in range(n_coarse_rows):
+                    for coarse_c in range(n_coarse_cols):
+                        change_vector = np.asarray(seals_utils.calc_change_vector_of_change_matrix(expected[coarse_r, coarse_c]), dtype=np.float64)
+                        np.testing.assert_allclose(net_change[:, coarse_r, coarse_c], change_vector * ha_per_fine_cell[coarse_r, coarse_c])
+                        cell_block = full_change_matrix[coarse_r * n_classes: (coarse_r + 1) * n_classes, coarse_c * n_classes: (coarse_c + 1) * n_classes]
+                        self.assertTrue(np.array_equal(cell_block, expected[coarse_r, coarse_c]))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_calibration_loss_function_matches_full_loss(self):
+        """Check that CalibrationLossFunction, which only re-blurs the window around pixels that changed since its last
+        call, gives the loss of calc_fit_of_projected_against_observed_loss_function, for changes both small enough to
+        be windowed and large enough to fall back to blurring everything."""
+        import numpy as np
+        from seals import seals_cython_functions
+
+        rng = np.random.default_rng(0)
+        n_r, n_c, sigma = 120, 120, 2.0
+        class_ids = [1, 2, 3]
+        baseline_array = rng.integers(1, 5, (n_r, n_c)).astype(np.int64)
+        observed_array = np.where(rng.random((n_r, n_c)) < 0.2, rng.integers(1, 5, (n_r, n_c)), baseline_array).astype(np.int64)
+        loss_function = seals_cython_functions.CalibrationLossFunction(baseline_array, observed_array, class_ids, sigma)
+
+        projected_array = np.where(rng.random((n_r, n_c)) < 0.2, rng.integers(1, 5, (n_r, n_c)), baseline_array).astype(np.int64)
+        for change in ['first_call', 'small', 'small', 'none', 'large', 'small']:
+            if change == 'small':
+                r, c = rng.integers(0, n_r - 5), rng.integers(0, n_c - 5)
+                projected_array[r: r + 5, c: c + 5] = rng.integers(1, 5, (5, 5))
+            elif change == 'large':
+                projected_array = np.where(rng.random((n_r, n_c)) < 0.2, rng.integers(1, 5, (n_r, n_c)), baseline_array).astype(np.int64)
+
+            score, plot, class_scores, class_plots = loss_function(projected_array)
+            expected_score, expected_plot, expected_class_scores, expected_class_plots = \
+                seals_cython_functions.calc_fit_of_projected_against_observed_loss_function(baseline_array, projected_array, observed_array, class_ids, sigma)
+            self.assertAlmostEqual(score, expected_score, delta=1e-9 * expected_score)
+            np.testing.assert_allclose(plot, expected_plot, rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(class_scores, expected_class_scores, rtol=1e-9)
+            for class_plot, expected_class_plot in zip(class_plots, expected_class_plots):
+                np.testing.assert_allclose(class_plot, expected_class_plot, rtol=1e-9, atol=1e-12)
+
+    def make_allocation_inputs(self, seed=0):
+        """Return random inputs of seals_allocation_gridded_input, as a dict by argument name, in which some coarse cells
+        have no change at all and others change only some classes."""
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        n_coarse_r, n_coarse_c, resolution = 6, 8, 30
+        n_r, n_c = n_coarse_r * resolution, n_coarse_c * resolution
+        spatial_layers_3d = rng.random((4, n_r, n_c))
+        spatial_layers_3d[3] = (rng.random((n_r, n_c)) > 0.1).astype(np.float64)
+        spatial_layer_coefficients_2d = rng.normal(size=(4, 4))
+        spatial_layer_coefficients_2d[:, 3] = [0, 1, 1, 0]
+        coarse_change_3d = rng.uniform(-5000, 10000, (4, n_coarse_r, n_coarse_c))
+        coarse_change_3d[:, rng.random((n_coarse_r, n_coarse_c)) < 0.4] = 0.0
+        coarse_change_3d[rng.random((4, n_coarse_r, n_coarse_c)) < 0.3] = 0.0
+        return {'coarse_change_3d': coarse_change_3d,
+                'input_lulc': rng.integers(1, 8, (n_r, n_c)).astype(np.int64),
+                'spatial_layers_3d': spatial_layers_3d,
+                'spatial_layer_coefficients_2d': spatial_layer_coefficients_2d,
+                'spatial_layer_function_types_1d': np.array([2, 2, 2, 1], dtype=np.int64),
+                'valid_mask_array': (rng.random((n_r, n_c)) > 0.05).astype(np.int64),
+                'changing_class_indices': np.array([1, 2, 3, 4], dtype=np.int64),
+                'changing_class_labels': ['urban', 'cropland', 'grassland', 'forest'],
+                'hectares_per_grid_cell': np.repeat(rng.uniform(50, 80, (n_r, 1)), n_c, axis=1)}
+
+    def allocate(self, inputs, **kwargs):
+        """Return seals_allocation_gridded_input of the make_allocation_inputs inputs, with kwargs replacing any of them."""
+        import numpy as np
+        from seals import seals_cython_functions
+
+        inputs = dict(inputs, **kwargs)
+        return seals_cython_functions.seals_allocation_gridded_input(inputs['coarse_change_3d'], inputs['input_lulc'], inputs['spatial_layers_3d'], inputs['spatial_layer_coefficients_2d'],
+                                                                     inputs['spatial_layer_function_types_1d'], inputs['valid_mask_array'], inputs['changing_class_indices'],
+                                                                     inputs['changing_class_labels'], inputs['hectares_per_grid_cell'], '', 0.0, np.int64(0), '', '',
+                                                                     partial_ranking=inputs.get('partial_ranking', True), active_coarse_cells=inputs.get('active_coarse_cells'))
+
+    def test_partial_ranking_matches_full_sort(self):
+        """Check that ranking only the eligible cells each class can use allocates exactly as sorting every window."""
+        import numpy as np
+
+        inputs = self.make_allocation_inputs()
+        projected_partial, change_arrays_partial, change_happened_partial = self.allocate(inputs, partial_ranking=True)
+        projected_full, change_arrays_full, change_happened_full = self.allocate(inputs, partial_ranking=False)
+        self.assertGreater(np.sum(change_happened_full), 0)
+        self.assertTrue(np.array_equal(projected_partial, projected_full))
+        self.assertTrue(np.array_equal(change_happened_partial, change_happened_full))
+
+    def test_active_coarse_cells_match_dense_visit(self):
+        """Check that visiting only the coarse cells in the active coarse-cell index allocates exactly as visiting every
+        coarse cell, and that the index lists exactly the cells and classes with change."""
+        import numpy as np
+        from seals import seals_cython_functions
+
+        inputs = self.make_allocation_inputs()
+        n_classes, n_coarse_r, n_coarse_c = inputs['coarse_change_3d'].shape
+        active_coarse_cells = seals_cython_functions.build_active_coarse_cell_index(inputs['coarse_change_3d'])
+        self.assertEqual(sorted(map(tuple, active_coarse_cells.tolist())), sorted(zip(*[i.tolist() for i in np.nonzero(inputs['coarse_change_3d'].transpose(1, 2, 0))])))
+        self.assertLess(len(np.unique(active_coarse_cells[:, 0:2], axis=0)), n_coarse_r * n_coarse_c)
+
+        dense_coarse_cells = np.array([(r, c, 0) for r in range(n_coarse_r) for c in range(n_coarse_c)], dtype=np.int64)
+        projected_active, change_arrays_active, change_happened_active = self.allocate(inputs, active_coarse_cells=active_coarse_cells)
+        projected_dense, change_arrays_dense, change_happened_dense = self.allocate(inputs, active_coarse_cells=dense_coarse_cells)
+        self.assertGreater(np.sum(change_happened_dense), 0)
+        self.assertTrue(np.array_equal(projected_active, projected_dense))
+        self.assertTrue(np.array_equal(change_happened_active, change_happened_dense))
+
+    def test_candidate_suitabilities_match_kernel(self):
+        """Check that the batched calc_candidate_suitabilities of several candidates match the suitability the kernel
+        computes for each, and that allocating from them (as additive layers with an identity coefficient table) matches
+        allocating from the layers and coefficients."""
+        import numpy as np
+        from seals import seals_cython_functions, seals_utils
+
+        inputs = self.make_allocation_inputs()
+        rng = np.random.default_rng(1)
+        candidate_coefficients_3d = np.stack([inputs['spatial_layer_coefficients_2d']] * 3)
+        candidate_coefficients_3d[1:, :, 0:3] += rng.normal(size=(2, 4, 3))
+        candidate_suitabilities = seals_utils.calc_candidate_suitabilities(inputs['spatial_layers_3d'], candidate_coefficients_3d, inputs['spatial_layer_function_types_1d'])
+        for candidate_suitability, spatial_layer_coefficients_2d in zip(candidate_suitabilities, candidate_coefficients_3d):
+            kernel_suitability = seals_cython_functions.calc_class_suitability_3d(inputs['spatial_layers_3d'], spatial_layer_coefficients_2d, inputs['spatial_layer_function_types_1d'])
+            np.testing.assert_allclose(candidate_suitability, kernel_suitability, rtol=1e-12, atol=1e-12)
+
+        n_classes = candidate_suitabilities.shape[1]
+        projected_layers, change_arrays_layers, change_happened_layers = self.allocate(inputs)
+        projected_suitability, change_arrays_suitability, change_happened_suitability = self.allocate(inputs, spatial_layers_3d=np.ascontiguousarray(candidate_suitabilities[0]),
+                                                                                                      spatial_layer_coefficients_2d=np.eye(n_classes),
+                                                                                                      spatial_layer_function_types_1d=np.full(n_classes, 2, dtype=np.int64))
+        self.assertGreater(np.sum(change_happened_layers), 0)
+        self.assertTrue(np.array_equal(projected_suitability, projected_layers))
+        self.assertTrue(np.array_equal(change_happened_suitability, change_happened_layers))
+
+
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,14 +1,34 @@
 # setup.py — only needed to register custom commands like build_ext
+import sys
+
 from setuptools import setup
 import numpy
 from Cython.Distutils import build_ext
 from setuptools.extension import Extension
 
-ext_modules = [Extension('seals.seals_cython_functions',
-                         ['seals/seals_cython_functions.pyx'],
-                         include_dirs=[numpy.get_include()])]
 
-setup(
-    cmdclass={'build_ext': build_ext},
-    ext_modules=ext_modules,
-)
\ No newline at end of file
+def get_openmp_args(platform=sys.platform):
+    """Return the (compile, link) args that enable OpenMP on platform. The allocation kernel uses OpenMP prange over
+    coarse cells. Apple clang ships without OpenMP, so there the prange simply runs serially. Also used by
+    seals/compile_cython_functions.py, so both builds use the same flags."""
+    if platform == 'win32':
+        return ['/openmp'], []
+    elif platform == 'darwin':
+        return [], []
+    else:
+        return ['-fopenmp'], ['-fopenmp']
+
+
+if __name__ == '__main__':
+    openmp_compile_args, openmp_link_args = get_openmp_args()
+
+    ext_modules = [Extension('seals.seals_cython_functions',
+                             ['seals/seals_cython_functions.pyx'],
+                             include_dirs=[numpy.get_include()],
+                             extra_compile_args=openmp_compile_args,
+                             extra_link_args=openmp_link_args)]
+
+    setup(
+        cmdclass={'build_ext': build_ext},
+        ext_modules=ext_modules,
+    )